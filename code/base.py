@@ -0,0 +1,344 @@
+"""
+base.py
+
+Behaviour shared by the model classes: checkpointing (save, restore, load), construction from a
+corpus.Dataset, vocabulary growth, and the optional scoring cache and metrics. Each model class keeps its own
+graph, batching and training data layout, and provides the hooks used here:
+
+    configure()        Label maps and hyperparameters.
+    build_graph()      Graph and session, with the optimizer if training (self.opt is None otherwise).
+    build_training()   Optimizer, training operations and a saver covering the optimizer state.
+    checkpoint_meta()  Model-specific fields saved with the vocabulary and hyperparameters.
+    use_dataset()      Configure the model, and take its training data from a corpus.Dataset.
+    use_checkpoint()   Configure the model from saved metadata, with only the replay sample as training data.
+    example_ids()      Word ids of training examples, for the replay sample saved with a checkpoint.
+    run_batch()        Score a batch of commands, bypassing the cache.
+
+and for partial_fit() on the dual models:
+
+    add_examples()     Append new labeled examples to the training data.
+    input_feed()       Feed for the input placeholders of a batch of training examples.
+"""
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from batching import replay_samples, replay_size
+from cache import ScoreCache
+from cells import check_cell
+from encoder import Encoder
+from metrics import Metrics
+from sessions import load_variables
+
+
+def saved_examples(meta, level):
+    """
+    Examples of a level in the replay sample saved with a checkpoint (see Model.replay_meta()), or none if
+    the checkpoint was saved without one.
+
+    :return: Tuple of (flat array of word ids, array of sentence lengths, labels, example weights).
+    """
+    replay = meta.get('replay', {}).get(level, {'ids': [], 'labels': [], 'weights': []})
+    lengths = np.array([len(ids) for ids in replay['ids']], dtype=np.int32)
+    flat = np.array([i for ids in replay['ids'] for i in ids], dtype=np.int32)
+    return flat, lengths, np.array(replay['labels'], dtype=np.int32), np.array(replay['weights'], dtype=np.float32)
+
+
+class Model(object):
+    @classmethod
+    def from_dataset(cls, dataset, session_config=None, **kwargs):
+        """
+        Instantiate the model from a corpus.Dataset (e.g. one opened from the on-disk cache), using its
+        vocabulary and vectorized arrays instead of tokenizing a corpus. If the dataset is compacted (see
+        corpus.Dataset.compact()), each row's loss is weighted by its count.
+
+        :param session_config: Optional tf.ConfigProto for the model's session.
+        :param kwargs: Hyperparameters, as for the constructor (and for RNNClassifier, the dataset level).
+        """
+        model = cls.__new__(cls)
+        model.use_dataset(dataset, **kwargs)
+        model.build_graph(session_config=session_config)
+        return model
+
+    @classmethod
+    def load(cls, path, training=False, session_config=None, cell=None):
+        """
+        Load a model saved with save(), without its training corpus (only the replay sample saved with it).
+        The graph is rebuilt from the saved vocabulary, label maps and hyperparameters, and the weights
+        restored from the checkpoint.
+
+        :param training: If True, also build the optimizer and restore its state. Otherwise this is
+                         deferred until the first call to fit().
+        :param session_config: Optional tf.ConfigProto for the model's session.
+        :param cell: For the recurrent models, the encoder backend to load the weights into, if not the one
+                     they were trained with. It must compute the same function (gru or gru_block, lstm_block
+                     or lstm_fused).
+        """
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        hparams = {str(k): v for k, v in meta['hparams'].items()}
+        if cell is not None:
+            check_cell(cell, hparams.get('cell', 'gru'))
+            hparams['cell'] = cell
+        model = cls.__new__(cls)
+        model.use_checkpoint(meta, **hparams)
+        model.build_graph(training, session_config)
+        model.restore(path)
+        return model
+
+    def set_encoder(self, encoder):
+        """
+        Use the given encoder (e.g. one built from a corpus, a dataset or a checkpoint) for the model's
+        vocabulary. Unless the number of ids is fixed, the spare_words ids the model was asked for are reserved
+        past the end of the vocabulary, so that partial_fit() can add new words without rebuilding the graph.
+        """
+        if encoder.size is None and self.spare_words:
+            encoder.size = len(encoder.id2word) + self.spare_words
+        self.encoder, self.word2id, self.id2word = encoder, encoder.word2id, encoder.id2word
+
+    def checkpoint_encoder(self, meta):
+        """
+        Rebuild the encoder saved in a checkpoint's metadata, with its spare capacity.
+        """
+        return Encoder([str(w) for w in meta['id2word']],
+                       meta.get('vocab_capacity', self.vocab_size or len(meta['id2word'])), self.hash_vocab)
+
+    def save(self, path):
+        """
+        Save the weights and optimizer state to a checkpoint at path, and the vocabulary, label maps,
+        hyperparameters, training progress and a replay sample of the training data to path.json.
+        """
+        self.saver.save(self.session, path, write_meta_graph=False)
+        meta = {'id2word': self.id2word, 'vocab_capacity': len(self.encoder), 'hparams': self.hparams,
+                'epochs_done': self.epochs_done}
+        meta.update(self.checkpoint_meta())
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    def replay_meta(self, levels):
+        """
+        Sample the training examples saved with a checkpoint, so that partial_fit() on a loaded model still
+        has old examples to replay: as many as a step replays by default (see batching.replay_size()), at
+        most 1024, drawn from all levels.
+
+        :param levels: List of (level, labels, example weights) tuples.
+        :return: Dictionary mapping level to a dictionary of the sampled examples' word ids, labels and
+                 weights.
+        """
+        sizes = [len(y) for _, y, _ in levels]
+        [sample] = replay_samples(np.random.RandomState(self.seed), sizes, replay_size(sum(sizes)), 1)
+        return {lvl: {'ids': [ids.tolist() for ids in self.example_ids(lvl, idx)], 'labels': y[idx].tolist(),
+                      'weights': w[idx].tolist()} for (lvl, y, w), idx in zip(levels, sample)}
+
+    def restore(self, path):
+        """
+        Restore the weights, optimizer state and training progress saved at path into this model.
+        """
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        if meta['id2word'] != self.id2word:
+            raise ValueError("Checkpoint %s was saved with a different vocabulary" % path)
+        self.saver.restore(self.session, path)
+        self.checkpoint_path = path
+        self.new_version()
+        self.epochs_done = meta['epochs_done']
+
+    def resume_training(self):
+        """
+        Add the training operations to a model loaded for scoring only, initializing the optimizer, and
+        restoring its state from the loaded checkpoint if it was saved.
+        """
+        with self.graph.as_default():
+            existing = set(tf.global_variables())
+            self.build_training()
+            self.session.run(tf.variables_initializer([v for v in tf.global_variables() if v not in existing]))
+            try:
+                self.saver.restore(self.session, self.checkpoint_path)
+            except tf.errors.NotFoundError:
+                pass
+
+    def extend_vocabulary(self, sentences):
+        """
+        Add the unknown words of the given token lists to the vocabulary, filling any spare embedding rows.
+        If there are not enough, the embedding is first grown to twice its size (see grow_vocabulary()).
+        A hashed vocabulary never grows, and a fixed vocab_size only fills its unused ids.
+        """
+        if self.vocab_size is None:
+            needed = len(self.id2word) + len(self.encoder.unknown(sentences))
+            if needed > len(self.encoder):
+                self.grow_vocabulary(max(needed, 2 * len(self.encoder)))
+        self.encoder.extend(sentences)
+
+    def grow_vocabulary(self, size):
+        """
+        Rebuild the graph with room for size word ids, keeping the trained weights and optimizer state.
+        The new embedding rows are initialized as usual.
+        """
+        with self.graph.as_default():
+            variables = tf.global_variables()
+            values = dict(zip([v.op.name for v in variables], self.session.run(variables)))
+        self.session.close()
+        self.encoder.size = size
+        self.build_graph(self.opt is not None, self.session_config)
+        with self.graph.as_default():
+            load_variables(self.session, tf.global_variables(), values)
+
+    def score(self, nl_command):
+        """
+        Given a natural language command, return predicted output and score.
+
+        :return: List of tokens representing predicted command, and score.
+        """
+        return self.score_batch([nl_command])[0]
+
+    def enable_cache(self, size=1024):
+        """
+        Cache the predictions of up to size distinct commands, evicting the least recently used. The
+        cache is invalidated whenever the weights change (fit, restore).
+
+        :return: The cache.ScoreCache, e.g. to read its hit and miss counts.
+        """
+        self.score_cache = ScoreCache(size)
+        return self.score_cache
+
+    def enable_metrics(self, metrics=None):
+        """
+        Record latency, level-selection, confidence and out-of-vocabulary metrics for every scoring call.
+
+        :param metrics: metrics.Metrics collector to record into, e.g. one shared with other models. Defaults
+                        to a new one.
+        :return: The metrics.Metrics, e.g. to snapshot() it or render it for Prometheus.
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        return self.metrics
+
+    def new_version(self):
+        """
+        Mark the weights as changed, invalidating any cached predictions.
+        """
+        self.model_version += 1
+        if self.score_cache is not None:
+            self.score_cache.clear()
+
+    def score_batch(self, nl_commands):
+        """
+        Given a list of natural language commands, encode them into a single batch, and return the
+        predicted output and score for each, using one forward pass (for the dual models, through the
+        level selector and all three heads).
+        If enable_cache() has been called, repeated commands are answered from the cache, and if
+        enable_metrics() has been called, the call is recorded.
+
+        :return: List of (command tokens, score) tuples, or for the dual models (command tokens, score,
+                 level, level score) tuples, one per command.
+        """
+        start = time.time()
+        if self.score_cache is not None:
+            predictions = self.score_cache.score_batch(self, nl_commands)
+        else:
+            predictions = self.run_batch(nl_commands)
+        if self.metrics is not None:
+            self.metrics.record_call(time.time() - start, predictions)
+        return predictions
+
+
+class DualModel(Model):
+    def partial_fit(self, new_pairs, steps=5, replay=None, learning_rate=0.001, keep_prob=1.0, seed=None):
+        """
+        Learn from a few new labeled commands (e.g. an operator's correction) without retraining. The new
+        examples are added to the training data, growing the vocabulary (into any spare embedding rows) and
+        max_len as needed, and the model takes a few optimizer steps, each on all the new examples plus a
+        sample of the old ones, so that it does not forget them. A model loaded with load() replays the
+        sample of old examples saved with its checkpoint.
+
+        :param new_pairs: Dictionary mapping level to a list of (source tokens, target tokens) tuples, where
+                          each target is one of that level's commands.
+        :param steps: Number of optimizer steps (one per level, unless fused).
+        :param replay: Number of old examples, drawn from all levels, replayed in every step. Defaults to 5%
+                       of the old examples, between 64 and 1024 (see batching.replay_size()). Each level's new
+                       examples are repeated to match its replayed ones, so that a single correction is not
+                       drowned out.
+        :param learning_rate: Adam learning rate of the steps. Raising it (or steps) makes a correction take
+                              hold sooner, at the cost of more drift on the old examples.
+        :param keep_prob: Dropout keep probability.
+        :param seed: Optional seed for the replay samples.
+        :return: List of the loss of every step.
+        """
+        new_pairs = {lvl: list(pairs) for lvl, pairs in new_pairs.items() if len(pairs)}
+        for lvl, pairs in new_pairs.items():
+            for _, ml in pairs:
+                if " ".join(ml) not in self.lvl_dict[lvl][2]:
+                    raise ValueError("Unknown %s command: %s" % (lvl, " ".join(ml)))
+        if self.opt is None:
+            self.resume_training()
+
+        # Grow the Vocabulary, and Append the New Examples
+        self.extend_vocabulary([nl for pairs in new_pairs.values() for nl, _ in pairs])
+        old = [len(self.train_y[lvl]) for lvl in ['L0', 'L1', 'L2']]
+        self.add_examples(new_pairs)
+
+        # Optimizer Steps on the New Examples, plus a Replayed Sample of the Old Ones
+        rng = np.random.RandomState(seed)
+        samples = replay_samples(rng, old, replay_size(sum(old)) if replay is None else replay, steps)
+        ops, losses = {lvl: (Y, loss, train_op) for lvl, Y, loss, train_op in self.level_ops()}, []
+        try:
+            for sample in samples:
+                parts = []
+                for k, lvl in enumerate(['L0', 'L1', 'L2']):
+                    new = np.arange(old[k], len(self.train_y[lvl]))
+                    if len(new):
+                        new = np.tile(new, max(len(sample[k]) // len(new), 1))
+                    if len(sample[k]) + len(new):
+                        idx = np.concatenate([sample[k], new])
+                        parts.append((lvl, idx, self.train_y[lvl][idx], k))
+
+                loss = 0.0
+                for group in ([parts] if self.fused and parts else [[part] for part in parts]):
+                    Y, loss_op, train_op = ops['L_ALL' if self.fused else group[0][0]]
+                    feed_dict = self.input_feed([(part[0], part[1]) for part in group])
+                    feed_dict.update({Y: np.concatenate([part[2] for part in group]),
+                                      self.LVL_Y: np.concatenate([np.zeros(len(part[2]), dtype=np.int32) + part[3]
+                                                                  for part in group]),
+                                      self.W: np.concatenate([self.train_w[part[0]][part[1]] for part in group]),
+                                      self.keep_prob: keep_prob, self.learning_rate: learning_rate})
+                    loss += self.session.run([loss_op, train_op], feed_dict)[0]
+                losses.append(loss)
+        finally:
+            self.new_version()
+        return losses
+
+    def level_ops(self):
+        """
+        Loss and training operations for each level (or for mixed-level batches, if fused), built once by
+        build_training().
+
+        :return: List of (level, label placeholder, loss, training operation) tuples.
+        """
+        if self.fused:
+            return [('L_ALL', self.CMD_Y, self.fused_loss, self.train_op)]
+        return [('L0', self.L0_Y, self.l0_total_loss, self.l0_train_op),
+                ('L1', self.L1_Y, self.l1_total_loss, self.l1_train_op),
+                ('L2', self.L2_Y, self.l2_total_loss, self.l2_train_op)]
+
+    def run_batch(self, nl_commands):
+        """
+        Score a batch of commands, bypassing the cache.
+        """
+        if len(nl_commands) == 0:
+            return []
+        return self.pick_predictions(*self.probs(nl_commands))
+
+    def pick_predictions(self, lvl, head_probs):
+        """
+        Select the level for each row of a batch, then the command from that level's head.
+
+        :param lvl: Array of shape [batch, 3] with the level-selection distribution.
+        :param head_probs: List of the three per-level arrays of shape [batch, len(<lvl>_commands)].
+        :return: List of (command tokens, score, level, level score) tuples, one per row.
+        """
+        head_commands = [self.l0_commands, self.l1_commands, self.l2_commands]
+        pred_levels = np.argmax(lvl, axis=1)
+        pred_commands = np.array([np.argmax(p, axis=1) for p in head_probs])[pred_levels, np.arange(len(lvl))]
+        return [(head_commands[k][c], head_probs[k][j][c], k, lvl[j][k])
+                for j, (k, c) in enumerate(zip(pred_levels, pred_commands))]
@@ -0,0 +1,76 @@
+"""
+batching.py
+
+Length-bucketed batching for the recurrent models, so each batch only needs to be padded to the
+longest sentence it contains, rather than to the longest sentence in the corpus. Also draws the samples of
+old examples that partial_fit replays alongside new ones.
+"""
+import numpy as np
+
+
+def bucket_ids(lengths, boundaries):
+    """
+    Assign each sequence to a bucket: bucket i holds lengths in (boundaries[i - 1], boundaries[i]], and
+    the final bucket holds everything longer than the last boundary.
+
+    :param lengths: Array of sequence lengths.
+    :param boundaries: Sorted list of bucket upper bounds.
+    :return: Array of bucket indices, one per sequence.
+    """
+    return np.searchsorted(np.asarray(boundaries), np.asarray(lengths), side='left')
+
+
+def bucket_batches(lengths, boundaries, batch_size=None, rng=None):
+    """
+    Group example indices into batches drawn from a single length bucket.
+
+    :param lengths: Array of sequence lengths.
+    :param boundaries: Sorted list of bucket upper bounds.
+    :param batch_size: Maximum number of examples per batch, or None for one batch per bucket.
+    :param rng: If given, a numpy RandomState used to shuffle examples within each bucket, and the order
+                of the batches across buckets. Otherwise batches are emitted in bucket order.
+    :return: List of arrays of example indices.
+    """
+    buckets, batches = bucket_ids(lengths, boundaries), []
+    for b in np.unique(buckets):
+        idx = np.where(buckets == b)[0]
+        if rng is not None:
+            rng.shuffle(idx)
+        step = batch_size or len(idx)
+        batches.extend(idx[i:i + step] for i in range(0, len(idx), step))
+    if rng is not None:
+        rng.shuffle(batches)
+    return batches
+
+
+def pad_batch(x, lengths):
+    """
+    Trim a batch of padded sequences down to the longest sequence in the batch.
+    """
+    return x[:, :max(np.max(lengths), 1)]
+
+
+def replay_size(n, fraction=0.05, minimum=64, maximum=1024):
+    """
+    Default number of old examples replayed in each partial_fit step: a fraction of the n old examples,
+    within [minimum, maximum], and no more than n.
+    """
+    return min(n, max(minimum, min(maximum, int(round(fraction * n)))))
+
+
+def replay_samples(rng, sizes, replay, steps):
+    """
+    Draw the old examples replayed in each of a number of training steps. Every step gets replay examples
+    drawn without replacement from all levels together, so each level is replayed in proportion to its size.
+
+    :param rng: Numpy RandomState.
+    :param sizes: List of the number of old examples of each level.
+    :return: List (one per step) of lists (one per level) of arrays of example indices within the level.
+    """
+    offsets, samples = np.cumsum([0] + list(sizes)), []
+    for _ in range(steps):
+        sample = rng.permutation(offsets[-1])[:replay]
+        samples.append([sample[(sample >= offsets[k]) & (sample < offsets[k + 1])] - offsets[k]
+                        for k in range(len(sizes))])
+    return samples
+
@@ -0,0 +1,190 @@
+"""
+benchmark.py
+
+Reproducible training and scoring benchmarks on the bundled data/ corpora. For each model and batch size
+this measures vectorization and graph build time, fit() throughput, single-command score() latency
+percentiles, and batched scoring throughput. Results are written as JSON, and can be compared against a
+stored baseline to flag regressions. With --compact, models train on the compacted corpora (see
+corpus.Dataset.compact()), and the rows saved and the speedup of each level are reported as well. With
+--cells, the recurrent models are benchmarked with each of the given encoder backends (see cells.py).
+
+Usage:
+    python benchmark.py run --out bench.json
+    python benchmark.py run --out compact.json --compact --baseline bench.json
+    python benchmark.py run --out cells.json --models RNNDual RNNClassifier --cells gru gru_block lstm_fused
+    python benchmark.py compare baseline.json bench.json --tolerance 0.1
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from cells import CELLS
+from corpus import vectorize
+from models import MODELS
+
+# Prefixes of the metrics where larger values are better (throughputs, and per-level compaction savings); all
+# other metrics are times, where smaller values are better
+HIGHER_IS_BETTER = ('fit_steps_per_sec', 'fit_examples_per_sec', 'batch_commands_per_sec', 'rows_saved_',
+                    'speedup_')
+
+# Models with a configurable encoder backend
+RECURRENT = ['RNNDual', 'RNNClassifier']
+
+
+def fit_steps(model, chunk_size):
+    """
+    Count the session.run calls and examples in one epoch of model.fit(chunk_size).
+    """
+    steps, examples = 0, 0
+    for step in model.batches(chunk_size):
+        batches = step.values() if isinstance(step, dict) else [step]
+        steps += len(batches)
+        examples += sum(len(batch[-1]) for batch in batches)
+    return steps, examples
+
+
+def bench_model(name, batch_size, epochs=2, chunk_size=100000, latency_samples=200, seed=0, compact=False,
+                cell=None):
+    """
+    Benchmark one model at one batch size, used both for training and for batched scoring.
+
+    :param compact: If True, train on the compacted corpora.
+    :param cell: Encoder backend of a recurrent model. Defaults to the model's default.
+    :return: Dictionary mapping metric name to value.
+    """
+    model_cls, levels = MODELS[name]
+    result = {}
+
+    start = time.time()
+    dataset = vectorize(levels)
+    result['vectorize_sec'] = time.time() - start
+    sentences = [s for lvl in dataset.levels for s in dataset.sentences(lvl)]
+    if compact:
+        dataset = dataset.compact()
+        for lvl, stats in dataset.compaction().items():
+            result['rows_saved_' + lvl], result['speedup_' + lvl] = stats['rows_saved'], stats['speedup']
+
+    start = time.time()
+    params = {'cell': cell} if cell is not None else {}
+    model = model_cls.from_dataset(dataset, epochs=epochs, batch_size=batch_size, seed=seed, **params)
+    result['build_graph_sec'] = time.time() - start
+
+    # Training Throughput
+    steps, examples = fit_steps(model, chunk_size)
+    start = time.time()
+    model.fit(chunk_size)
+    seconds = time.time() - start
+    result['fit_sec'] = seconds
+    result['fit_steps_per_sec'] = steps * epochs / seconds
+    result['fit_examples_per_sec'] = examples * epochs / seconds
+
+    # Single-Command Latency, after a warm-up call
+    rng = np.random.RandomState(seed)
+    model.score(sentences[0])
+    latencies = []
+    for j in rng.choice(len(sentences), latency_samples):
+        start = time.time()
+        model.score(sentences[j])
+        latencies.append((time.time() - start) * 1000)
+    for p in [50, 95, 99]:
+        result['score_p%d_ms' % p] = np.percentile(latencies, p)
+
+    # Batched Scoring Throughput
+    start = time.time()
+    for i in range(0, len(sentences), batch_size):
+        model.score_batch(sentences[i:i + batch_size])
+    result['batch_commands_per_sec'] = len(sentences) / (time.time() - start)
+    model.session.close()
+    return result
+
+
+def run(models, batch_sizes, epochs=2, chunk_size=100000, latency_samples=200, seed=0, compact=False,
+        cells=None):
+    """
+    Benchmark every model at every batch size.
+
+    :param cells: Optional list of encoder backends, each benchmarked for every recurrent model.
+    :return: Dictionary with the run settings under 'meta', and results under 'results', keyed by
+             '<model>/batch_size=<batch size>', or '<model>/cell=<cell>/batch_size=<batch size>' with cells.
+    """
+    np.random.seed(seed)
+    results = {}
+    for name in models:
+        for cell in cells if cells and name in RECURRENT else [None]:
+            for batch_size in batch_sizes:
+                key = '%s/%sbatch_size=%d' % (name, 'cell=%s/' % cell if cell else '', batch_size)
+                results[key] = bench_model(name, batch_size, epochs, chunk_size, latency_samples, seed, compact,
+                                           cell)
+                print key, json.dumps(results[key], sort_keys=True)
+    meta = {'seed': seed, 'epochs': epochs, 'chunk_size': chunk_size, 'latency_samples': latency_samples,
+            'compact': compact, 'cells': cells,
+            'python': platform.python_version(), 'tensorflow': tf.__version__, 'machine': platform.platform()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Compare two benchmark runs, metric by metric.
+
+    :param tolerance: Relative change allowed in the worse direction before a metric counts as a regression.
+    :return: List of (key, metric, baseline value, current value, relative change, regressed) tuples, where
+             a positive relative change is an improvement.
+    """
+    rows = []
+    for key in sorted(set(baseline['results']) & set(current['results'])):
+        old, new = baseline['results'][key], current['results'][key]
+        for metric in sorted(set(old) & set(new)):
+            change = (new[metric] - old[metric]) / float(old[metric]) if old[metric] else 0.0
+            if not metric.startswith(HIGHER_IS_BETTER):
+                change = -change
+            rows.append((key, metric, old[metric], new[metric], change, change < -tolerance))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Training and scoring benchmarks.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--out', required=True, help='Path of the JSON results')
+    run_parser.add_argument('--models', nargs='+', default=sorted(MODELS), choices=sorted(MODELS))
+    run_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64])
+    run_parser.add_argument('--epochs', type=int, default=2)
+    run_parser.add_argument('--chunk-size', type=int, default=100000)
+    run_parser.add_argument('--latency-samples', type=int, default=200)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--compact', action='store_true', help='Train on the compacted corpora')
+    run_parser.add_argument('--cells', nargs='+', default=None, choices=CELLS,
+                            help='Encoder backends to benchmark the recurrent models with')
+    run_parser.add_argument('--baseline', default=None, help='JSON results to compare against afterwards')
+    run_parser.add_argument('--tolerance', type=float, default=0.1)
+    compare_parser = commands.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        current = run(args.models, args.batch_sizes, args.epochs, args.chunk_size, args.latency_samples,
+                      args.seed, args.compact, args.cells)
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        baseline_path = args.baseline
+    else:
+        with open(args.current) as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = 0
+        for key, metric, old, new, change, regressed in compare(baseline, current, args.tolerance):
+            regressions += regressed
+            print '%-28s %-24s %12.4g -> %12.4g  %+7.1f%% %s' % (key, metric, old, new, change * 100,
+                                                              'REGRESSION' if regressed else '')
+        sys.exit(1 if regressions else 0)
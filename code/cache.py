@@ -0,0 +1,77 @@
+"""
+cache.py
+
+Bounded LRU caches for scoring. Predictions are keyed on the command's word ids (so unknown words share
+the UNK id, and hashed words their bucket) and the model version, which models bump whenever their
+weights change (fit, restore), so stale predictions are never returned.
+"""
+import collections
+import threading
+
+
+class LRUCache(object):
+    def __init__(self, size=1024):
+        """
+        Thread-safe cache holding at most size entries, evicting the least recently used.
+        """
+        self.size, self.entries, self.lock = size, collections.OrderedDict(), threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary with the size bound, number of entries, and hit and miss counts.
+        """
+        return {'size': self.size, 'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class ScoreCache(LRUCache):
+    def score_batch(self, model, nl_commands):
+        """
+        Score a batch through the cache. A command repeated within the batch is looked up (and counted as a
+        hit or miss) once, and only the distinct commands that miss are run through the model (with
+        model.run_batch).
+
+        :param model: Model with an encoder, a model_version, and a run_batch method.
+        :return: List of predictions, one per command, as from model.score_batch.
+        """
+        word_id = model.encoder.word_id
+        rows = collections.OrderedDict()
+        for j, nl_command in enumerate(nl_commands):
+            rows.setdefault((model.model_version, tuple(word_id(w) for w in nl_command)), []).append(j)
+        found = collections.OrderedDict((key, self.get(key)) for key in rows)
+
+        missing = [key for key, prediction in found.items() if prediction is None]
+        if missing:
+            for key, prediction in zip(missing, model.run_batch([nl_commands[rows[key][0]] for key in missing])):
+                self.put(key, prediction)
+                found[key] = prediction
+
+        predictions = [None] * len(nl_commands)
+        for key, prediction in found.items():
+            for j in rows[key]:
+                predictions[j] = prediction
+        return predictions
@@ -0,0 +1,169 @@
+"""
+callbacks.py
+
+Instrumentation for fit(). Callbacks receive per-step timings, split into input preparation (waiting on
+the input pipeline and building feeds) and session.run, and per-epoch loss and throughput. They can also
+request a full trace of selected steps, e.g. to write Chrome-trace timelines.
+"""
+import time
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class Callback(object):
+    """
+    Base class for fit() callbacks. Every hook does nothing by default.
+    """
+    def on_train_begin(self, model):
+        pass
+
+    def on_epoch_begin(self, model, epoch):
+        pass
+
+    def on_step_end(self, model, epoch, stats):
+        """
+        :param stats: Dictionary with the step index ('step'), its loss ('loss'), number of examples
+                      ('examples'), and seconds spent preparing input ('prep_sec') and in session.run
+                      ('run_sec').
+        """
+        pass
+
+    def on_epoch_end(self, model, epoch, stats):
+        """
+        :param stats: Dictionary with the average loss ('loss'), number of steps ('steps') and examples
+                      ('examples'), total seconds ('seconds', 'prep_sec', 'run_sec'), and throughput
+                      ('examples_per_sec').
+        """
+        pass
+
+    def on_train_end(self, model):
+        pass
+
+    def run_options(self, epoch, step, tag):
+        """
+        Return tf.RunOptions to run a step with (e.g. to trace it), or None.
+
+        :param tag: Label of the session.run call within the step (e.g. the level being trained).
+        """
+        return None
+
+    def on_run_metadata(self, epoch, step, tag, run_metadata):
+        """
+        Receive the tf.RunMetadata of a session.run call this callback returned run_options for.
+        """
+        pass
+
+
+class PrintLoss(Callback):
+    """
+    Print the average loss at the end of every epoch (the default when fit() is given no callbacks).
+    """
+    def on_epoch_end(self, model, epoch, stats):
+        print 'Epoch %s Average Loss:' % str(epoch), stats['loss']
+
+
+class History(Callback):
+    """
+    Record the stats of every step and epoch, in the lists steps and epochs.
+    """
+    def __init__(self):
+        self.steps, self.epochs = [], []
+
+    def on_step_end(self, model, epoch, stats):
+        self.steps.append(dict(stats, epoch=epoch))
+
+    def on_epoch_end(self, model, epoch, stats):
+        self.epochs.append(dict(stats, epoch=epoch))
+
+
+class TimelineCallback(Callback):
+    """
+    Trace selected steps, and write each traced session.run as a Chrome trace (load in chrome://tracing).
+    """
+    def __init__(self, steps, epochs=None, path='timeline-{epoch}-{step}-{tag}.json'):
+        """
+        :param steps: Indices of the steps to trace, within each traced epoch.
+        :param epochs: Epochs to trace. Defaults to every epoch.
+        :param path: Path template for the trace files, formatted with epoch, step and tag.
+        """
+        self.steps, self.epochs, self.path = set(steps), epochs and set(epochs), path
+        self.paths = []
+
+    def run_options(self, epoch, step, tag):
+        if step in self.steps and (self.epochs is None or epoch in self.epochs):
+            return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        return None
+
+    def on_run_metadata(self, epoch, step, tag, run_metadata):
+        path = self.path.format(epoch=epoch, step=step, tag=tag)
+        with open(path, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        self.paths.append(path)
+
+
+class CallbackList(object):
+    def __init__(self, callbacks=None):
+        """
+        Dispatches fit() events to a list of callbacks, timing each step along the way.
+
+        :param callbacks: List of Callback instances. If None, just PrintLoss().
+        """
+        self.callbacks = callbacks if callbacks is not None else [PrintLoss()]
+        self.epoch, self.step, self.mark = None, 0, time.time()
+
+    def begin_train(self, model):
+        for callback in self.callbacks:
+            callback.on_train_begin(model)
+
+    def begin_epoch(self, model, epoch):
+        self.epoch, self.step, self.epoch_start = epoch, 0, time.time()
+        self.loss, self.examples, self.prep, self.run_sec = 0.0, 0, 0.0, 0.0
+        self.step_prep, self.step_run = 0.0, 0.0
+        for callback in self.callbacks:
+            callback.on_epoch_begin(model, epoch)
+        self.mark = time.time()
+
+    def run(self, session, fetches, feed_dict, tag=None):
+        """
+        Run fetches for the current step, tracing the call if any callback asks to. Time since the end of
+        the previous call (or the start of the epoch) is counted as input preparation.
+        """
+        tracing = [(c, c.run_options(self.epoch, self.step, tag)) for c in self.callbacks]
+        tracing = [(c, options) for c, options in tracing if options is not None]
+
+        start = time.time()
+        if tracing:
+            run_metadata = tf.RunMetadata()
+            result = session.run(fetches, feed_dict=feed_dict, options=tracing[0][1], run_metadata=run_metadata)
+            for callback, _ in tracing:
+                callback.on_run_metadata(self.epoch, self.step, tag, run_metadata)
+        else:
+            result = session.run(fetches, feed_dict=feed_dict)
+        end = time.time()
+
+        self.step_prep, self.step_run = self.step_prep + start - self.mark, self.step_run + end - start
+        self.mark = end
+        return result
+
+    def end_step(self, model, loss, examples):
+        stats = {'step': self.step, 'loss': loss, 'examples': examples, 'prep_sec': self.step_prep,
+                 'run_sec': self.step_run}
+        self.loss, self.examples = self.loss + loss, self.examples + examples
+        self.prep, self.run_sec = self.prep + self.step_prep, self.run_sec + self.step_run
+        for callback in self.callbacks:
+            callback.on_step_end(model, self.epoch, stats)
+        self.step, self.step_prep, self.step_run = self.step + 1, 0.0, 0.0
+        self.mark = time.time()
+
+    def end_epoch(self, model):
+        seconds = time.time() - self.epoch_start
+        stats = {'loss': self.loss / max(self.step, 1), 'steps': self.step, 'examples': self.examples,
+                 'seconds': seconds, 'prep_sec': self.prep, 'run_sec': self.run_sec,
+                 'examples_per_sec': self.examples / seconds if seconds else 0.0}
+        for callback in self.callbacks:
+            callback.on_epoch_end(model, self.epoch, stats)
+
+    def end_train(self, model):
+        for callback in self.callbacks:
+            callback.on_train_end(model)
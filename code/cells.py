@@ -0,0 +1,103 @@
+"""
+cells.py
+
+Recurrent encoder backends for RNNDual and RNNClassifier, selected with their cell hyperparameter:
+    gru         tf.nn.rnn_cell.GRUCell in dynamic_rnn, running several small ops per token (the original).
+    gru_block   GRUBlockCell in dynamic_rnn: the same GRU, with each step fused into a single op.
+    lstm_block  LSTMBlockCell in dynamic_rnn: an LSTM, with each step fused into a single op.
+    lstm_fused  LSTMBlockFusedCell: the same LSTM, run over the whole (time-major) batch by a single op.
+
+Backends computing the same function save their variables under the same checkpoint names, so gru and
+gru_block restore each other's checkpoints, as do lstm_block and lstm_fused: a model trained with one can
+be loaded with the other (see <Model>.load()). The LSTM state is the cell state and the output concatenated,
+twice the rnn_size wide, and the heads read only the output.
+"""
+import tensorflow as tf
+
+CELLS = ['gru', 'gru_block', 'lstm_block', 'lstm_fused']
+FAMILIES = {'gru': 'gru', 'gru_block': 'gru', 'lstm_block': 'lstm', 'lstm_fused': 'lstm'}
+
+# GRUBlockCell variables (relative to the RNN scope), and the GRUCell names they are saved under
+BLOCK_GRU_NAMES = {"GRUBlockCell/w_ru": "GRUCell/Gates/Linear/Matrix",
+                   "GRUBlockCell/b_ru": "GRUCell/Gates/Linear/Bias",
+                   "GRUBlockCell/w_c": "GRUCell/Candidate/Linear/Matrix",
+                   "GRUBlockCell/b_c": "GRUCell/Candidate/Linear/Bias"}
+
+
+def check_cell(cell, saved=None):
+    """
+    Validate a backend name, and if given the backend a checkpoint was saved with, that it can restore it.
+    """
+    if cell not in CELLS:
+        raise ValueError("Unknown cell %r, expected one of %s" % (cell, CELLS))
+    if saved is not None and FAMILIES[cell] != FAMILIES[saved]:
+        raise ValueError("Cell '%s' cannot load a checkpoint saved with cell '%s'" % (cell, saved))
+
+
+def state_size(cell, rnn_size):
+    return 2 * rnn_size if FAMILIES[cell] == 'lstm' else rnn_size
+
+
+def rnn_cell(cell, rnn_size):
+    """
+    Single-step cell of a backend (for lstm_fused, the step-by-step cell with the same weights).
+    """
+    if cell == 'gru':
+        return tf.nn.rnn_cell.GRUCell(rnn_size)
+    if cell == 'gru_block':
+        return tf.contrib.rnn.GRUBlockCell(rnn_size)
+    return tf.contrib.rnn.LSTMBlockCell(rnn_size, use_compatible_names=True)
+
+
+def encode(cell, inputs, lengths, rnn_size):
+    """
+    Run a backend over a batch of embedded sequences, in the RNN variable scope.
+
+    :param inputs: Tensor of shape [batch, time, input size].
+    :param lengths: Tensor of shape [batch] with the length of each sequence.
+    :return: Tensor of shape [batch, state_size(cell, rnn_size)], with the state after each sequence.
+    """
+    if cell == 'lstm_fused':
+        with tf.variable_scope("RNN"):
+            _, (c, h) = tf.contrib.rnn.LSTMBlockFusedCell(rnn_size)(tf.transpose(inputs, [1, 0, 2]),
+                                                                     dtype=tf.float32, sequence_length=lengths,
+                                                                     scope="LSTMCell")
+        return tf.concat(1, [c, h])
+    _, state = tf.nn.dynamic_rnn(rnn_cell(cell, rnn_size), inputs, sequence_length=lengths, dtype=tf.float32)
+    return tf.concat(1, list(state)) if FAMILIES[cell] == 'lstm' else state
+
+
+def step(cell, inputs, state, rnn_size):
+    """
+    Advance a batch of states by one step, sharing the encoder's weights (call within a reusing scope).
+
+    :param inputs: Tensor of shape [batch, input size].
+    :param state: Tensor of shape [batch, state_size(cell, rnn_size)].
+    """
+    with tf.variable_scope("RNN"):
+        if FAMILIES[cell] == 'lstm':
+            _, (c, h) = rnn_cell(cell, rnn_size)(inputs, (state[:, :rnn_size], state[:, rnn_size:]))
+            return tf.concat(1, [c, h])
+        return rnn_cell(cell, rnn_size)(inputs, state)[1]
+
+
+def output(cell, state, rnn_size):
+    """
+    Encoding read by the heads from a batch of states: the GRU state, or the LSTM output.
+    """
+    return state[:, rnn_size:] if FAMILIES[cell] == 'lstm' else state
+
+
+def checkpoint_names(variables):
+    """
+    Map each variable's checkpoint name to it, for tf.train.Saver. GRUBlockCell variables (and their
+    optimizer slots) are saved under the GRUCell names; every other variable keeps its own name.
+    """
+    names = {}
+    for var in variables:
+        name = var.op.name
+        for block, canonical in BLOCK_GRU_NAMES.items():
+            if name == "RNN/" + block or name.startswith("RNN/%s/" % block):
+                name = "RNN/" + canonical + name[len("RNN/" + block):]
+        names[name] = var
+    return names
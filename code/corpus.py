@@ -0,0 +1,275 @@
+"""
+corpus.py
+
+Loader for the parallel corpora in data/ (<lvl>.en, <lvl>.ml, <lvl>.commands). Files are read as
+streams, and the vectorized id matrices, lengths and labels are cached on disk, keyed by the content
+hash of the files and the vocabulary. Later runs open the cache with np.load(mmap_mode='r'), so
+processes share the same pages and skip tokenization entirely.
+
+The corpora repeat many (command, label) pairs word for word. Dataset.compact() merges the repeats into
+one row with a count, and the models weight each row's loss by its count.
+"""
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from encoder import Encoder
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data')
+DUAL_LEVELS, SINGLE_LEVELS = ['L0', 'L1', 'L2'], ['L_ALL']
+CACHE_VERSION = 1
+
+
+def read_pairs(level, data_dir=DATA_DIR):
+    """
+    Stream the (source tokens, target tokens) pairs of a level from <level>.en and <level>.ml.
+    """
+    with open(os.path.join(data_dir, level + '.en')) as en, open(os.path.join(data_dir, level + '.ml')) as ml:
+        for nl, target in itertools.izip(en, ml):
+            yield nl.split(), target.split()
+
+
+def read_commands(level, pairs, data_dir=DATA_DIR):
+    """
+    Read the label set of a level: the commands listed in <level>.commands, followed (in sorted order) by
+    any target in the parallel corpus that the file does not list.
+    """
+    with open(os.path.join(data_dir, level + '.commands')) as f:
+        commands = [line.split() for line in f if line.strip()]
+    listed = {" ".join(c) for c in commands}
+    return commands + [c.split() for c in sorted({" ".join(ml) for _, ml in pairs} - listed)]
+
+
+def content_hash(levels, data_dir=DATA_DIR, vocab=None):
+    """
+    Hash the contents of the corpus files for the given levels, and the vocabulary (if one is given).
+    """
+    sha = hashlib.sha1(str(CACHE_VERSION))
+    for level in levels:
+        for ext in ['.en', '.ml', '.commands']:
+            with open(os.path.join(data_dir, level + ext), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), b''):
+                    sha.update(block)
+    if vocab is not None:
+        sha.update("\n".join(vocab))
+    return sha.hexdigest()
+
+
+class Dataset(object):
+    def __init__(self, id2word, commands, ids, lengths, labels, max_len, counts=None):
+        """
+        Vectorized parallel corpora, shared by all levels.
+
+        :param id2word: List of words, indexed by id (PAD and UNK first).
+        :param commands: Dictionary mapping level to its list of commands (labels).
+        :param ids: Dictionary mapping level to an [N, max_len] matrix of padded word ids.
+        :param lengths: Dictionary mapping level to an [N] array of sentence lengths.
+        :param labels: Dictionary mapping level to an [N] array of command labels.
+        :param max_len: Length of the longest sentence across all levels.
+        :param counts: Optional dictionary mapping level to an [N] array of the number of examples each row
+                       stands for (see compact()). Defaults to one per row.
+        """
+        self.id2word, self.commands, self.max_len = id2word, commands, max_len
+        self.word2id = {id2word[i]: i for i in range(len(id2word))}
+        self.ids, self.lengths, self.labels = ids, lengths, labels
+        self.levels = sorted(commands)
+        if counts is None:
+            counts = {lvl: np.ones(len(labels[lvl]), dtype=np.int32) for lvl in self.levels}
+        self.counts = counts
+
+    def save(self, path):
+        """
+        Write the dataset to the directory at path, one .npy file per array.
+        """
+        os.makedirs(path)
+        for lvl in self.levels:
+            np.save(os.path.join(path, lvl + '.ids.npy'), self.ids[lvl])
+            np.save(os.path.join(path, lvl + '.lengths.npy'), self.lengths[lvl])
+            np.save(os.path.join(path, lvl + '.labels.npy'), self.labels[lvl])
+            np.save(os.path.join(path, lvl + '.counts.npy'), self.counts[lvl])
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'id2word': self.id2word, 'commands': self.commands, 'max_len': self.max_len}, f)
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """
+        Open a dataset written by save(), memory-mapping the arrays.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        commands = {str(lvl): [[str(w) for w in c] for c in cmds] for lvl, cmds in meta['commands'].items()}
+        arrays = [{lvl: np.load(os.path.join(path, '%s.%s.npy' % (lvl, name)), mmap_mode=mmap_mode)
+                   for lvl in commands} for name in ['ids', 'lengths', 'labels']]
+        counts = None
+        if all(os.path.exists(os.path.join(path, lvl + '.counts.npy')) for lvl in commands):
+            counts = {lvl: np.load(os.path.join(path, lvl + '.counts.npy'), mmap_mode=mmap_mode) for lvl in commands}
+        return cls([str(w) for w in meta['id2word']], commands, arrays[0], arrays[1], arrays[2], meta['max_len'],
+                   counts)
+
+    def word_counts(self):
+        """
+        Count the occurrences of every word over all levels.
+
+        :return: Dictionary mapping word to count.
+        """
+        counts = np.zeros(len(self.id2word), dtype=np.int64)
+        for lvl in self.levels:
+            mask = np.arange(self.ids[lvl].shape[1]) < np.asarray(self.lengths[lvl])[:, None]
+            counts += np.bincount(np.asarray(self.ids[lvl])[mask], minlength=len(self.id2word))
+        return dict(zip(self.id2word, counts))
+
+    def encoder(self, size=None, hashed=False):
+        """
+        Encoder for a model trained on the dataset: over the dataset's own vocabulary, or with a fixed size,
+        built from the dataset's word counts (see Encoder.build()).
+        """
+        if size is None:
+            return Encoder(self.id2word)
+        return Encoder.from_counts(self.word_counts(), size, hashed)
+
+    def encoded(self, encoder, level):
+        """
+        Id matrix of a level, in the ids of the given encoder (the cached matrix itself, if the encoder has
+        the dataset's vocabulary).
+        """
+        if encoder.id2word == self.id2word and not encoder.hashed:
+            return self.ids[level]
+        return encoder.remap(self.id2word)[self.ids[level]]
+
+    def subset(self, indices):
+        """
+        Select examples from each level, keeping the vocabulary, label sets and max_len.
+
+        :param indices: Dictionary mapping level to an array of example indices.
+        :return: Dataset holding copies of the selected rows.
+        """
+        return Dataset(self.id2word, self.commands, {lvl: self.ids[lvl][indices[lvl]] for lvl in self.levels},
+                       {lvl: self.lengths[lvl][indices[lvl]] for lvl in self.levels},
+                       {lvl: self.labels[lvl][indices[lvl]] for lvl in self.levels}, self.max_len,
+                       {lvl: self.counts[lvl][indices[lvl]] for lvl in self.levels})
+
+    def compact(self):
+        """
+        Merge the rows of each level that have the same word ids and label into one row, keeping the first
+        occurrence, and add up their counts.
+
+        :return: Dataset of the distinct rows, with their counts.
+        """
+        ids, lengths, labels, counts = {}, {}, {}, {}
+        for lvl in self.levels:
+            keys = np.column_stack([np.asarray(self.labels[lvl]), np.asarray(self.ids[lvl])])
+            _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+            order = np.argsort(first)
+            merged = np.bincount(inverse, weights=self.counts[lvl], minlength=len(first))
+            ids[lvl], lengths[lvl] = self.ids[lvl][first[order]], self.lengths[lvl][first[order]]
+            labels[lvl], counts[lvl] = self.labels[lvl][first[order]], merged[order].astype(np.int32)
+        return Dataset(self.id2word, self.commands, ids, lengths, labels, self.max_len, counts)
+
+    def weights(self, level):
+        """
+        Loss weight of each row of a level: its count, divided by the level's mean count, so that a
+        uniformly sampled batch of rows has the same expected loss as a batch of the uncompacted examples.
+
+        :return: [N] float32 array (all ones if the level has no merged rows).
+        """
+        counts = np.asarray(self.counts[level], dtype=np.float32)
+        return counts / np.mean(counts) if len(counts) else counts
+
+    def compaction(self):
+        """
+        Report how much compaction saves on each level of a compacted dataset.
+
+        :return: Dictionary mapping level to a dictionary with the number of examples (the sum of the counts),
+                 the number of rows, the rows saved, and the speedup (examples per row: the ratio of training
+                 steps per epoch before and after compaction).
+        """
+        report = {}
+        for lvl in self.levels:
+            examples, rows = int(np.sum(self.counts[lvl])), len(self.labels[lvl])
+            report[lvl] = {'examples': examples, 'rows': rows, 'rows_saved': examples - rows,
+                           'speedup': examples / float(max(rows, 1))}
+        return report
+
+    def split(self, fraction, seed=0):
+        """
+        Randomly split each level's examples into two datasets, e.g. for training and validation.
+
+        :param fraction: Fraction of each level's examples placed in the second dataset.
+        :return: Tuple of (first, second) datasets.
+        """
+        rng, first, second = np.random.RandomState(seed), {}, {}
+        for lvl in self.levels:
+            order = rng.permutation(len(self.labels[lvl]))
+            n = int(round(len(order) * fraction))
+            first[lvl], second[lvl] = np.sort(order[n:]), np.sort(order[:n])
+        return self.subset(first), self.subset(second)
+
+    def sentences(self, level):
+        """
+        Decode the id matrix of a level back into lists of tokens, e.g. to score them with a model.
+        """
+        return [[self.id2word[i] for i in row[:n]] for row, n in zip(self.ids[level], self.lengths[level])]
+
+    def targets(self, level):
+        """
+        Look up the command (list of tokens) labelling each example of a level.
+        """
+        return [self.commands[level][y] for y in self.labels[level]]
+
+
+def vectorize(levels, data_dir=DATA_DIR, vocab=None):
+    """
+    Read and vectorize the corpora for the given levels.
+
+    :param vocab: Optional list of words (indexed by id) to encode with. If not given, the vocabulary is
+                  built from all the levels' source sentences, in sorted order.
+    :return: Dataset.
+    """
+    corpora = {lvl: list(read_pairs(lvl, data_dir)) for lvl in levels}
+    commands = {lvl: read_commands(lvl, corpora[lvl], data_dir) for lvl in levels}
+    if vocab is None:
+        encoder = Encoder.build(nl for lvl in levels for nl, _ in corpora[lvl])
+    else:
+        encoder = Encoder(vocab)
+
+    max_len = max(len(nl) for lvl in levels for nl, _ in corpora[lvl])
+    ids, lengths, labels = {}, {}, {}
+    for lvl in levels:
+        label_ids = {" ".join(c): i for i, c in enumerate(commands[lvl])}
+        ids[lvl], lengths[lvl] = encoder.encode([nl for nl, _ in corpora[lvl]], max_len)
+        labels[lvl] = np.array([label_ids[" ".join(ml)] for _, ml in corpora[lvl]], dtype=np.int32)
+    return Dataset(encoder.id2word, commands, ids, lengths, labels, max_len)
+
+
+def load_dataset(levels=DUAL_LEVELS, data_dir=DATA_DIR, cache_dir=None, vocab=None):
+    """
+    Load the vectorized corpora for the given levels, from the on-disk cache if possible.
+
+    :param levels: Levels to load (DUAL_LEVELS for the dual models, SINGLE_LEVELS for RNNClassifier).
+    :param cache_dir: Directory holding cached datasets. If None, nothing is cached.
+    :param vocab: Optional list of words (indexed by id) to encode with, e.g. a trained model's id2word.
+    :return: Dataset, with memory-mapped arrays if it came from the cache.
+    """
+    if cache_dir is None:
+        return vectorize(levels, data_dir, vocab)
+
+    path = os.path.join(cache_dir, content_hash(levels, data_dir, vocab))
+    if not os.path.exists(path):
+        # Write to a temporary directory, then rename, so concurrent processes never see a partial cache
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        vectorize(levels, data_dir, vocab).save(os.path.join(tmp, 'dataset'))
+        try:
+            os.rename(os.path.join(tmp, 'dataset'), path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+        finally:
+            shutil.rmtree(tmp)
+    return Dataset.open(path)
@@ -0,0 +1,160 @@
+"""
+distill.py
+
+Knowledge distillation from RNNDual into NNDual. A trained RNNDual teacher scores the training commands
+(plus, optionally, noisy copies of them and extra unlabeled commands), and an NNDual student, which
+encodes a command with a single bag-of-words layer instead of a GRU step per token, is trained to match
+the teacher's level-selection and per-level command distributions. The student, the teacher, and an
+NNDual of the same shape trained on the hard labels are then compared on held-out commands, for
+accuracy and scoring latency.
+
+Usage:
+    python distill.py --teacher-epochs 10 --out checkpoints/student
+    python distill.py --teacher checkpoints/rnn --params '{"h1_size": 30}' --unlabeled commands.txt
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from corpus import DUAL_LEVELS, load_dataset
+from dual_nn import NNDual
+from dual_rnn import RNNDual
+
+
+def augment(sentences, copies=1, drop=0.1, replace=0.1, seed=0):
+    """
+    Make noisy copies of commands, as extra unlabeled distillation data. Each token is dropped with
+    probability drop, or replaced by a random token from the commands with probability replace; every
+    copy keeps at least one token.
+
+    :return: List of copies * len(sentences) token lists.
+    """
+    rng, words = np.random.RandomState(seed), sorted(set(w for s in sentences for w in s))
+    noisy = []
+    for _ in range(copies):
+        for sentence in sentences:
+            draws = rng.uniform(size=len(sentence))
+            copy = [w if u >= drop + replace else words[rng.randint(len(words))]
+                    for w, u in zip(sentence, draws) if u >= drop]
+            noisy.append(copy or sentence[:1])
+    return noisy
+
+
+def soften(probs, temperature):
+    """
+    Raise the temperature of a batch of distributions: equivalent to dividing the logits by it.
+    """
+    if temperature == 1.0:
+        return probs
+    logits = np.log(np.maximum(probs, 1e-20)) / temperature
+    e = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+
+def soft_targets(teacher, sentences, temperature=1.0, batch_size=512):
+    """
+    Score commands with the teacher, in batches.
+
+    :return: Tuple of the softened [N, 3] level-selection probabilities and the list of the three
+             softened per-level head probabilities.
+    """
+    batches = [teacher.probs(sentences[i:i + batch_size]) for i in range(0, len(sentences), batch_size)]
+    lvl = soften(np.concatenate([b[0] for b in batches]), temperature)
+    heads = [soften(np.concatenate([b[1][k] for b in batches]), temperature) for k in range(3)]
+    return lvl, heads
+
+
+def distill(teacher, dataset, params=None, copies=0, unlabeled=(), temperature=2.0, epochs=None, seed=0,
+            callbacks=None):
+    """
+    Train an NNDual student on the teacher's distributions over a dataset's commands.
+
+    :param teacher: Trained RNNDual (or any model with the dual probs() method).
+    :param dataset: corpus.Dataset with L0, L1 and L2 levels, whose commands are distilled.
+    :param params: Student hyperparameters, as for NNDual.from_dataset().
+    :param copies: Number of noisy copies of every command added (see augment()).
+    :param unlabeled: Extra token lists to distill on, e.g. commands collected without labels.
+    :param temperature: Softmax temperature of the soft targets and the student.
+    :param epochs: Number of passes over the distillation commands. Defaults to the student's epochs.
+    :return: The trained student.
+    """
+    student = NNDual.from_dataset(dataset, **(params or {}))
+    sentences = [s for lvl in dataset.levels for s in dataset.sentences(lvl)]
+    sentences += augment(sentences, copies, seed=seed) + list(unlabeled)
+    student.distill(sentences, soft_targets(teacher, sentences, temperature), epochs, temperature,
+                    callbacks=callbacks)
+    return student
+
+
+def evaluate(model, dataset, latency_samples=200, batch_size=64, seed=0):
+    """
+    Score a dataset's commands with a model.
+
+    :return: Dictionary with the command and level-selection accuracy, the median and 95th percentile
+             latency of scoring one command, and the batched scoring throughput.
+    """
+    sentences = [s for lvl in dataset.levels for s in dataset.sentences(lvl)]
+    targets = [t for lvl in dataset.levels for t in dataset.targets(lvl)]
+    levels = [k for k, lvl in enumerate(dataset.levels) for _ in dataset.labels[lvl]]
+    predictions = model.score_batch(sentences)
+    result = {'accuracy': np.mean([p[0] == t for p, t in zip(predictions, targets)]),
+              'level_accuracy': np.mean([p[2] == k for p, k in zip(predictions, levels)])}
+
+    # Single-Command Latency, after a warm-up call
+    model.score(sentences[0])
+    latencies = []
+    for j in np.random.RandomState(seed).choice(len(sentences), latency_samples):
+        start = time.time()
+        model.score(sentences[j])
+        latencies.append((time.time() - start) * 1000)
+    result['score_p50_ms'], result['score_p95_ms'] = np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+    start = time.time()
+    for i in range(0, len(sentences), batch_size):
+        model.score_batch(sentences[i:i + batch_size])
+    result['batch_commands_per_sec'] = len(sentences) / (time.time() - start)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distill RNNDual into an NNDual student.')
+    parser.add_argument('--teacher', default=None, help='Checkpoint path of a saved RNNDual. If not given, '
+                                                         'a teacher is trained on the training split.')
+    parser.add_argument('--teacher-epochs', type=int, default=10)
+    parser.add_argument('--params', default='{}', help='JSON dictionary of student hyperparameters')
+    parser.add_argument('--epochs', type=int, default=20, help='Distillation epochs')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--copies', type=int, default=2, help='Noisy copies of each training command')
+    parser.add_argument('--unlabeled', default=None, help='File of extra commands, one per line')
+    parser.add_argument('--validation', type=float, default=0.2, help='Fraction of each level held out')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--out', default=None, help='Checkpoint path to save the student to')
+    args = parser.parse_args()
+
+    train, valid = load_dataset(DUAL_LEVELS, cache_dir=args.cache_dir).split(args.validation, args.seed)
+    if args.teacher is not None:
+        teacher = RNNDual.load(args.teacher)
+    else:
+        teacher = RNNDual.from_dataset(train, epochs=args.teacher_epochs, seed=args.seed)
+        teacher.fit(100000, shuffle=True)
+
+    params = dict(json.loads(args.params), seed=args.seed)
+    unlabeled = []
+    if args.unlabeled is not None:
+        with open(args.unlabeled) as f:
+            unlabeled = [line.split() for line in f if line.strip()]
+    student = distill(teacher, train, params, args.copies, unlabeled, args.temperature, args.epochs, args.seed)
+    if args.out is not None:
+        student.save(args.out)
+    baseline = NNDual.from_dataset(train, **params)
+    baseline.fit(100000, shuffle=True)
+
+    print '%-10s %9s %9s %9s %9s %14s' % ('model', 'accuracy', 'level', 'p50_ms', 'p95_ms', 'commands/sec')
+    for name, model in [('teacher', teacher), ('student', student), ('baseline', baseline)]:
+        r = evaluate(model, valid, seed=args.seed)
+        print '%-10s %9.4f %9.4f %9.3f %9.3f %14.1f' % (name, r['accuracy'], r['level_accuracy'],
+                                                         r['score_p50_ms'], r['score_p95_ms'],
+                                                         r['batch_commands_per_sec'])
@@ -4,15 +4,22 @@ dual_nn.py
 Dual Model with a vanilla feed-forward encoder. Has multiple heads for each of the three levels, as 
 well as a head for level selection.
 """
+import os
+import time
+
 import numpy as np
 import tensorflow as tf
 
-PAD, PAD_ID = "<<PAD>>", 0
-UNK, UNK_ID = "<<UNK>>", 1
+from base import DualModel, saved_examples
+from callbacks import CallbackList
+from encoder import Encoder, bag_of_words, bag_of_words_ids
+from pipeline import BatchPipeline
+from predictor import collect_weights
 
-class NNDual():
+class NNDual(DualModel):
     def __init__(self, l0_corpus, l1_corpus, l2_corpus, l0_commands, l1_commands, l2_commands,
-                 embedding_size=30, h1_size=60, h2_size=50, epochs=10, batch_size=16):
+                 embedding_size=30, h1_size=60, h2_size=50, epochs=10, batch_size=16, sparse=False,
+                 fused=False, seed=None, vocab_size=None, hash_vocab=False, spare_words=0, session_config=None):
         """
         Instantiates and Trains Model using the given set of parallel corpora.
 
@@ -20,105 +27,204 @@ class NNDual():
                     1) List of source sentence tokens
                     2) List of target sentence tokens
         :param <lvl>_commands: List of Lists, where each element is one of the possible commands (labels)
+        :param sparse: If True, represent each command as a sparse bag of (word id, count) pairs instead
+                       of a dense [|vocab|] count vector.
+        :param fused: If True, train on mixed batches holding examples from all three levels, with one
+                      optimizer step over the masked head losses and the level-selection loss, instead of
+                      one step per level. Every example is used, even when the levels differ in size.
+        :param seed: Optional graph-level random seed, for reproducible initialization and dropout.
+        :param vocab_size: If given, fix the number of word ids (and so the embedding size): keep only the
+                           vocab_size - 2 most frequent words, mapping the rest to UNK.
+        :param hash_vocab: If True (with a vocab_size), hash every word into vocab_size - 2 buckets instead,
+                           so no word is out of vocabulary and ids are stable across corpora and retrains.
+        :param spare_words: Number of embedding rows to reserve past the end of the vocabulary (unless it has a
+                            vocab_size), so that partial_fit() can add new words without rebuilding the graph.
+                            By default none are reserved, and new words grow the embedding instead.
+        :param session_config: Optional tf.ConfigProto for the model's session (see sessions.session_config).
         """
         self.l0_pc, self.l1_pc, self.l2_pc = l0_corpus, l1_corpus, l2_corpus
+        self.configure(l0_commands, l1_commands, l2_commands, embedding_size, h1_size, h2_size, epochs,
+                       batch_size, sparse, fused, seed, vocab_size, hash_vocab, spare_words)
+
+        # Build Vocabulary
+        self.set_encoder(self.build_vocabulary())
+
+        # Vectorize Parallel Corpus
+        self.train_x, self.train_y = self.vectorize()
+        self.train_w = {lvl: np.ones(len(self.train_y[lvl]), dtype=np.float32) for lvl in self.lvl_dict}
+
+        # Build Graph, and Initialize all variables
+        self.build_graph(session_config=session_config)
+
+    def configure(self, l0_commands, l1_commands, l2_commands, embedding_size=30, h1_size=60, h2_size=50,
+                  epochs=10, batch_size=16, sparse=False, fused=False, seed=None, vocab_size=None, hash_vocab=False,
+                  spare_words=0):
+        """
+        Set up the label maps and hyperparameters, shared by the constructor, from_dataset() and load().
+        """
         self.l0_commands, self.l0_labels = l0_commands, {" ".join(x): i for (i, x) in enumerate(l0_commands)}
         self.l1_commands, self.l1_labels = l1_commands, {" ".join(x): i for (i, x) in enumerate(l1_commands)}
-        self.l2_commands, self.l2_labels = l2_commands, {" ".join(x): i for (i, x) in enumerate(l2_commands)}        
-        
-        self.epochs, self.bsz = epochs, batch_size
+        self.l2_commands, self.l2_labels = l2_commands, {" ".join(x): i for (i, x) in enumerate(l2_commands)}
+
+        self.epochs, self.bsz, self.sparse, self.fused, self.seed = epochs, batch_size, sparse, fused, seed
         self.embedding_sz, self.h1_sz, self.h2_sz = embedding_size, h1_size, h2_size
-        self.init = tf.truncated_normal_initializer(stddev=0.5)
+        self.vocab_size, self.hash_vocab, self.spare_words = vocab_size, hash_vocab, spare_words
+        self.hparams = {'embedding_size': embedding_size, 'h1_size': h1_size, 'h2_size': h2_size,
+                        'epochs': epochs, 'batch_size': batch_size, 'sparse': sparse, 'fused': fused,
+                        'seed': seed, 'vocab_size': vocab_size, 'hash_vocab': hash_vocab,
+                        'spare_words': spare_words}
+        self.init, self.epochs_done = tf.truncated_normal_initializer(stddev=0.5), 0
+        self.score_cache, self.metrics, self.model_version = None, None, 0
 
         # Build Level Dictionary
-        self.lvl_dict = {'L0': (self.l0_commands, self.l0_pc, self.l0_labels), 
-                         'L1': (self.l1_commands, self.l1_pc, self.l1_labels), 
+        self.lvl_dict = {'L0': (self.l0_commands, self.l0_pc, self.l0_labels),
+                         'L1': (self.l1_commands, self.l1_pc, self.l1_labels),
                          'L2': (self.l2_commands, self.l2_pc, self.l2_labels)}
 
-        # Build Vocabulary
-        self.word2id, self.id2word = self.build_vocabulary()
+    def build_graph(self, training=True, session_config=None):
+        """
+        Build the placeholders, inference graph and losses in a new graph owned by the model, and initialize
+        all variables in a new session.
 
-        # Vectorize Parallel Corpus
-        self.train_x, self.train_y = self.vectorize()
+        :param training: If False, skip the optimizer, which build_training() adds on the first fit().
+        :param session_config: Optional tf.ConfigProto for the session (e.g. to limit its thread pools).
+        """
+        self.graph, self.session_config = tf.Graph(), session_config
+        self.graph.seed = self.seed
+        with self.graph.as_default():
+            # Setup Placeholders
+            if self.sparse:
+                self.X = tf.sparse_placeholder(tf.float32, name='NL_Command')
+            else:
+                self.X = tf.placeholder(tf.float32, shape=[None, len(self.encoder)], name='NL_Command')
+            self.L0_Y = tf.placeholder(tf.int32, shape=[None], name='L0_ML_Command')
+            self.L1_Y = tf.placeholder(tf.int32, shape=[None], name='L1_ML_Command')
+            self.L2_Y = tf.placeholder(tf.int32, shape=[None], name='L2_ML_Command')
+            self.LVL_Y = tf.placeholder(tf.int32, shape=[None], name='Level_Label')
+            self.CMD_Y = tf.placeholder(tf.int32, shape=[None], name='ML_Command')
+            self.W = tf.placeholder_with_default(tf.ones_like(self.LVL_Y, dtype=tf.float32), shape=[None],
+                                                 name='Example_Weight')
+            self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
+            self.L0_P = tf.placeholder(tf.float32, shape=[None, len(self.l0_commands)], name='L0_Soft_Targets')
+            self.L1_P = tf.placeholder(tf.float32, shape=[None, len(self.l1_commands)], name='L1_Soft_Targets')
+            self.L2_P = tf.placeholder(tf.float32, shape=[None, len(self.l2_commands)], name='L2_Soft_Targets')
+            self.LVL_P = tf.placeholder(tf.float32, shape=[None, 3], name='Level_Soft_Targets')
+            self.temperature = tf.placeholder_with_default(1.0, shape=[], name='Temperature')
+
+            # Build Inference Graph
+            self.l0_logits, self.l1_logits, self.l2_logits, self.lvl_logits = self.inference()
+            if self.sparse:
+                self.word_h1, self.update_word_h1, scoring_logits = self.sparse_inference()
+                self.word_h1_stale = True
+            else:
+                scoring_logits = self.l0_logits, self.l1_logits, self.l2_logits, self.lvl_logits
+            self.l0_probs, self.l1_probs = tf.nn.softmax(scoring_logits[0]), tf.nn.softmax(scoring_logits[1])
+            self.l2_probs, self.lvl_probs = tf.nn.softmax(scoring_logits[2]), tf.nn.softmax(scoring_logits[3])
+
+            # Build Loss Computations, weighting each example (e.g. by its count in a compacted corpus)
+            self.l0_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l0_logits,
+                                                                                                  self.L0_Y))
+            self.l1_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l1_logits,
+                                                                                                  self.L1_Y))
+            self.l2_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l2_logits,
+                                                                                                  self.L2_Y))
+            self.lvl_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.lvl_logits,
+                                                                                                   self.LVL_Y))
+
+            # Masked Loss over Mixed-Level Batches: each head only counts the examples from its own level
+            self.fused_loss = self.lvl_loss
+            head_logits = [self.l0_logits, self.l1_logits, self.l2_logits]
+            for k, (lvl, logits) in enumerate(zip(['L0', 'L1', 'L2'], head_logits)):
+                mask = tf.to_float(tf.equal(self.LVL_Y, k))
+                labels = tf.minimum(self.CMD_Y, len(self.lvl_dict[lvl][0]) - 1)
+                xent = tf.nn.sparse_softmax_cross_entropy_with_logits(logits, labels)
+                self.fused_loss += tf.reduce_sum(mask * self.W * xent) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+            # Distillation Loss: cross-entropy against a teacher's softened distributions, with each head's
+            # examples weighted by the teacher's probability of that head's level
+            xent = tf.nn.softmax_cross_entropy_with_logits(self.lvl_logits / self.temperature, self.LVL_P)
+            self.distill_loss = tf.reduce_mean(xent)
+            for k, (logits, targets) in enumerate(zip(head_logits, [self.L0_P, self.L1_P, self.L2_P])):
+                weight = self.LVL_P[:, k]
+                xent = tf.nn.softmax_cross_entropy_with_logits(logits / self.temperature, targets)
+                self.distill_loss += tf.reduce_sum(weight * xent) / tf.maximum(tf.reduce_sum(weight), 1e-6)
+            self.distill_loss *= self.temperature ** 2
 
-        # Setup Placeholders
-        self.X = tf.placeholder(tf.float32, shape=[None, len(self.word2id)], name='NL_Command')
-        self.L0_Y = tf.placeholder(tf.int32, shape=[None], name='L0_ML_Command')
-        self.L1_Y = tf.placeholder(tf.int32, shape=[None], name='L1_ML_Command')
-        self.L2_Y = tf.placeholder(tf.int32, shape=[None], name='L2_ML_Command')
-        self.LVL_Y = tf.placeholder(tf.int32, shape=[None], name='Level_Label')
-        self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
-
-        # Build Inference Graph
-        self.l0_logits, self.l1_logits, self.l2_logits, self.lvl_logits = self.inference()
-        self.l0_probs, self.l1_probs = tf.nn.softmax(self.l0_logits), tf.nn.softmax(self.l1_logits)
-        self.l2_probs, self.lvl_probs = tf.nn.softmax(self.l2_logits), tf.nn.softmax(self.lvl_logits)
-
-        # Build Loss Computations
-        self.l0_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l0_logits,
-                                                                                     self.L0_Y))
-        self.l1_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l1_logits,
-                                                                                     self.L1_Y))
-        self.l2_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l2_logits,
-                                                                                     self.L2_Y))
-        self.lvl_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.lvl_logits,
-                                                                                      self.LVL_Y))
-
-        # Build Training Operations
-        self.opt = tf.train.AdamOptimizer()
-        self.l0_train_op = self.opt.minimize(self.l0_loss + self.lvl_loss)
-        self.l1_train_op = self.opt.minimize(self.l1_loss + self.lvl_loss)
-        self.l2_train_op = self.opt.minimize(self.l2_loss + self.lvl_loss)
-
-        # Initialize all variables
-        self.session = tf.Session()
+            # Build Training Operations, and Saver
+            if training:
+                self.build_training()
+            else:
+                self.opt, self.saver = None, tf.train.Saver(tf.trainable_variables())
+            self.distill_op = None
+
+            # Initialize all variables
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            self.session.run(tf.global_variables_initializer())
+
+    def build_training(self):
+        """
+        Build the training operations, and a saver covering the optimizer state.
+        """
+        self.learning_rate = tf.placeholder_with_default(0.001, shape=[], name='Learning_Rate')
+        self.opt = tf.train.AdamOptimizer(self.learning_rate)
+        if self.fused:
+            self.train_op = self.opt.minimize(self.fused_loss)
+        else:
+            self.l0_total_loss = self.l0_loss + self.lvl_loss
+            self.l1_total_loss = self.l1_loss + self.lvl_loss
+            self.l2_total_loss = self.l2_loss + self.lvl_loss
+            self.l0_train_op = self.opt.minimize(self.l0_total_loss)
+            self.l1_train_op = self.opt.minimize(self.l1_total_loss)
+            self.l2_train_op = self.opt.minimize(self.l2_total_loss)
         self.saver = tf.train.Saver()
-        self.session.run(tf.global_variables_initializer())
 
     def build_vocabulary(self):
         """
         Builds the vocabulary from the parallel corpus, adding the UNK ID.
 
-        :return: Tuple of Word2Id, Id2Word Dictionaries.
+        :return: Encoder holding the vocabulary.
         """
-        vocab = set()
-        for lvl in self.lvl_dict:
-            for n, _ in self.lvl_dict[lvl][1]:
-                for word in n:
-                    vocab.add(word)
-
-        id2word = [PAD, UNK] + list(vocab)
-        word2id = {id2word[i]: i for i in range(len(id2word))}
-        return word2id, id2word
+        return Encoder.build((n for lvl in self.lvl_dict for n, _ in self.lvl_dict[lvl][1]), self.vocab_size,
+                             self.hash_vocab)
 
     def vectorize(self):
         """
-        Step through the Parallel Corpus, and convert each sequence to vectors.
+        Step through the Parallel Corpus, and convert each sequence to vectors: a dense [|vocab|] count
+        vector, or in sparse mode a tuple of (sorted unique word ids, counts).
         """
         x, y = {}, {}
         for lvl in self.lvl_dict:
-            x[lvl], y[lvl] = [], []
-            for nl, ml in self.lvl_dict[lvl][1]:
-                nvec, mlab = np.zeros((len(self.word2id)), dtype=np.int32), self.lvl_dict[lvl][2][" ".join(ml)]
-                for w in nl:
-                    nvec[self.word2id.get(w, UNK_ID)] += 1
-                x[lvl].append(nvec)
-                y[lvl].append(mlab)
-        
-        for lvl in self.lvl_dict:
-            x[lvl] = np.array(x[lvl], dtype=np.int32)
-            y[lvl] = np.array(y[lvl], dtype=np.int32)
+            x[lvl] = self.encoder.bag_of_words([nl for nl, _ in self.lvl_dict[lvl][1]], self.sparse)
+            y[lvl] = np.array([self.lvl_dict[lvl][2][" ".join(ml)] for _, ml in self.lvl_dict[lvl][1]],
+                              dtype=np.int32)
         return x, y
 
+    def feed_x(self, rows):
+        """
+        Build the value fed to the input placeholder for a batch of bag-of-words rows.
+        """
+        if not self.sparse:
+            return rows
+        indices = np.zeros((sum(len(ids) for ids, _ in rows), 2), dtype=np.int64)
+        values, start = np.zeros((len(indices)), dtype=np.float32), 0
+        for j, (ids, counts) in enumerate(rows):
+            indices[start:start + len(ids), 0], indices[start:start + len(ids), 1] = j, ids
+            values[start:start + len(ids)] = counts
+            start += len(ids)
+        return tf.SparseTensorValue(indices, values, np.array([len(rows), len(self.encoder)], dtype=np.int64))
+
     def inference(self):
         """
         Compile the LSTM Classifier, taking the input placeholder, generating the softmax
         distribution over all possible reward functions.
         """
         # Shared Embedding
-        E = tf.get_variable("Embedding", shape=[len(self.word2id), self.embedding_sz],
+        E = tf.get_variable("Embedding", shape=[len(self.encoder), self.embedding_sz],
                             dtype=tf.float32, initializer=self.init)
-        embedding = tf.matmul(self.X, E)
+        if self.sparse:
+            embedding = tf.sparse_tensor_dense_matmul(self.X, E)
+        else:
+            embedding = tf.matmul(self.X, E)
         embedding = tf.nn.dropout(embedding, self.keep_prob)
 
         # Shared ReLU Layer
@@ -127,7 +233,26 @@ class NNDual():
         H1_B = tf.get_variable("Hidden_B1", shape=[self.h1_sz], dtype=tf.float32,
                                initializer=self.init)
         h1 = tf.nn.relu(tf.matmul(embedding, H1_W) + H1_B)
-        
+        return self.heads(h1)
+
+    def sparse_inference(self):
+        """
+        Compile the sparse scoring path. Without dropout, the embedding and shared ReLU layer fold into
+        a single [|vocab|, h1_sz] table of per-word products with Hidden_W1, so the shared layer is a
+        weighted sum of a handful of rows. The table is refreshed from the trained weights on demand.
+
+        :return: Tuple of (table variable, table update op, head logits computed from the table).
+        """
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            E, H1_W, H1_B = tf.get_variable("Embedding"), tf.get_variable("Hidden_W1"), tf.get_variable("Hidden_B1")
+            word_h1 = tf.Variable(tf.zeros([len(self.encoder), self.h1_sz]), trainable=False, name="Word_Hidden1")
+            h1 = tf.nn.relu(tf.sparse_tensor_dense_matmul(self.X, word_h1) + H1_B)
+            return word_h1, tf.assign(word_h1, tf.matmul(E, H1_W)), self.heads(h1)
+
+    def heads(self, h1):
+        """
+        Compile the level-specific and level-selection layers on top of the shared ReLU layer.
+        """
         # Level-Specific Layers
         outputs = {}
         for i in ['L0', 'L1', 'L2']:
@@ -160,63 +285,287 @@ class NNDual():
 
         return outputs['L0'], outputs['L1'], outputs['L2'], output
 
-    def fit(self, chunk_size):
+    def batches(self, chunk_size, rng=None):
+        """
+        Generate the training batches for one epoch, over the first chunk_size examples of each level.
+
+        :param rng: If given, a numpy RandomState used to shuffle the examples.
+        :return: Generator of steps, where each step is a dictionary mapping level to a tuple of (input
+                 feed, labels, level labels, example weights). Levels that have run out of batches are
+                 absent. If fused, each step instead holds a single mixed-level batch, under 'L_ALL'.
+        """
+        if self.fused:
+            for step in self.fused_batches(chunk_size, rng):
+                yield step
+            return
+
+        n, orders = len(self.train_x['L0'][:chunk_size]), {}
+        for lvl in self.lvl_dict:
+            m = min(n, len(self.train_x[lvl]))
+            orders[lvl] = np.arange(m) if rng is None else rng.permutation(m)
+
+        for start, end in zip(range(0, n - self.bsz, self.bsz), range(self.bsz, n, self.bsz)):
+            step = {}
+            for k, lvl in enumerate(['L0', 'L1', 'L2']):
+                if end < len(self.train_x[lvl]):
+                    idx = orders[lvl][start:end]
+                    rows = [self.train_x[lvl][i] for i in idx] if self.sparse else self.train_x[lvl][idx]
+                    step[lvl] = (self.feed_x(rows), self.train_y[lvl][idx], np.zeros([len(idx)], dtype=np.int32) + k,
+                                 self.train_w[lvl][idx])
+            yield step
+
+    def fused_batches(self, chunk_size, rng=None):
+        """
+        Generate mixed-level training batches for one epoch, over the first chunk_size examples of each
+        level. Each batch holds up to batch_size examples from every level, and no examples are dropped.
+        """
+        sizes = [min(chunk_size, len(self.train_x[lvl])) for lvl in ['L0', 'L1', 'L2']]
+        offsets = np.cumsum([0] + sizes)
+        if self.sparse:
+            x = [row for lvl, n in zip(['L0', 'L1', 'L2'], sizes) for row in self.train_x[lvl][:n]]
+        else:
+            x = np.concatenate([self.train_x[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        y = np.concatenate([self.train_y[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        w = np.concatenate([self.train_w[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        lvl_y = np.repeat(np.arange(3, dtype=np.int32), sizes)
+
+        level_batches = []
+        for k, n in enumerate(sizes):
+            order = offsets[k] + (np.arange(n) if rng is None else rng.permutation(n))
+            level_batches.append([order[i:i + self.bsz] for i in range(0, n, self.bsz)])
+
+        for i in range(max(len(b) for b in level_batches)):
+            idx = np.concatenate([b[i] for b in level_batches if i < len(b)])
+            rows = [x[j] for j in idx] if self.sparse else x[idx]
+            yield {'L_ALL': (self.feed_x(rows), y[idx], lvl_y[idx], w[idx])}
+
+    def fit(self, chunk_size, shuffle=False, prefetch=8, checkpoint=None, resume=False, callbacks=None):
         """
         Train the model, with the specified batch size and number of epochs.
+
+        :param shuffle: Whether to shuffle each level's examples every epoch (reproducibly, if the model has a
+                        seed).
+        :param prefetch: Number of batches prepared ahead of time on the background input thread.
+        :param checkpoint: If given, path the model is saved to after every epoch.
+        :param resume: If True, continue from the last completed epoch, restoring from checkpoint if one
+                       has been written.
+        :param callbacks: List of callbacks.Callback instances, receiving per-step timings and per-epoch
+                          loss and throughput. Defaults to printing the average loss every epoch.
         """
+        if self.opt is None:
+            self.resume_training()
+        if resume and checkpoint is not None and os.path.exists(checkpoint + '.json'):
+            self.restore(checkpoint)
+        first_epoch = self.epochs_done if resume else 0
+
+        level_ops = self.level_ops()
+
         # Run through epochs
-        for e in range(self.epochs):
-            curr_loss, batches = 0.0, 0.0
-            for start, end in zip(range(0, len(self.train_x['L0'][:chunk_size]) - self.bsz, self.bsz),
-                                  range(self.bsz, len(self.train_x['L0'][:chunk_size]), self.bsz)):
-                l0_loss, l1_loss, l2_loss = 0, 0, 0
-                if end < len(self.train_x['L0']):
-                    l0_loss, _ = self.session.run([self.l0_loss + self.lvl_loss, self.l0_train_op],
-                                                feed_dict={self.X: self.train_x['L0'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L0_Y: self.train_y['L0'][start:end],
-                                                            self.LVL_Y: np.zeros([self.bsz]) + 0})
-                if end < len(self.train_x['L1']):
-                    l1_loss, _ = self.session.run([self.l1_loss + self.lvl_loss, self.l1_train_op],
-                                                feed_dict={self.X: self.train_x['L1'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L1_Y: self.train_y['L1'][start:end],
-                                                            self.LVL_Y: np.zeros([self.bsz]) + 1})
-                if end < len(self.train_x['L2']):
-                    l2_loss, _ = self.session.run([self.l2_loss + self.lvl_loss, self.l2_train_op],
-                                                feed_dict={self.X: self.train_x['L2'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L2_Y: self.train_y['L2'][start:end],
-                                                            self.LVL_Y: np.zeros([self.bsz]) + 2})
-                curr_loss += l0_loss + l1_loss + l2_loss
-                batches += 1
-            print 'Epoch %s Average Loss:' % str(e), curr_loss / batches
-
-    def score(self, nl_command):
-        """
-        Given a natural language command, return predicted output and score.
-
-        :return: List of tokens representing predicted command, and score.
-        """
-        seq = np.zeros((len(self.word2id)), dtype=np.int32)
-        for w in nl_command:
-            seq[self.word2id.get(w, UNK_ID)] += 1
-        
-        lvl = self.session.run(self.lvl_probs, feed_dict={self.X: [seq], self.keep_prob: 1.0})
-        [pred_level] = np.argmax(lvl, axis=1)
-
-        if pred_level == 0:
-            y = self.session.run(self.l0_probs, feed_dict={self.X: [seq], self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l0_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
-        elif pred_level == 1:
-            y = self.session.run(self.l1_probs, feed_dict={self.X: [seq], self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l1_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
-        elif pred_level == 2:
-            y = self.session.run(self.l2_probs, feed_dict={self.X: [seq], self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l2_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
-        else:
-            raise UnicodeError()
-    
\ No newline at end of file
+        self.word_h1_stale = True
+        pipeline = BatchPipeline(lambda rng: self.batches(chunk_size, rng), self.epochs - first_epoch, prefetch,
+                                 shuffle, self.seed)
+        callbacks = CallbackList(callbacks)
+        callbacks.begin_train(self)
+        try:
+            for e in range(first_epoch, self.epochs):
+                callbacks.begin_epoch(self, e)
+                for step in pipeline.epoch():
+                    losses, examples = [0, 0, 0], 0
+                    for k, (lvl, Y, loss, train_op) in enumerate(level_ops):
+                        if lvl in step:
+                            x, y, lvl_y, w = step[lvl]
+                            losses[k], _ = callbacks.run(self.session, [loss, train_op],
+                                                         feed_dict={self.X: x, self.keep_prob: 0.5, Y: y,
+                                                                    self.LVL_Y: lvl_y, self.W: w}, tag=lvl)
+                            examples += len(y)
+                    callbacks.end_step(self, sum(losses), examples)
+                callbacks.end_epoch(self)
+                self.epochs_done = e + 1
+                if checkpoint is not None:
+                    self.save(checkpoint)
+        finally:
+            pipeline.close()
+            self.new_version()
+        callbacks.end_train(self)
+
+    def add_examples(self, new_pairs):
+        """
+        Append new labeled examples to the training data (see partial_fit()). If the vocabulary has grown
+        past the width of the dense count vectors, the old ones are padded to it.
+
+        :param new_pairs: Dictionary mapping level to a list of (source tokens, target tokens) tuples.
+        """
+        for lvl in self.lvl_dict:
+            if self.sparse:
+                self.train_x[lvl] = list(self.train_x[lvl])
+            elif self.train_x[lvl].shape[1] < len(self.encoder):
+                width = len(self.encoder) - self.train_x[lvl].shape[1]
+                self.train_x[lvl] = np.pad(self.train_x[lvl], ((0, 0), (0, width)), 'constant')
+            if lvl in new_pairs:
+                x = self.encoder.bag_of_words([nl for nl, _ in new_pairs[lvl]], self.sparse)
+                y = np.array([self.lvl_dict[lvl][2][" ".join(ml)] for _, ml in new_pairs[lvl]], dtype=np.int32)
+                self.train_x[lvl] = self.train_x[lvl] + x if self.sparse else np.concatenate([self.train_x[lvl], x])
+                self.train_y[lvl] = np.concatenate([self.train_y[lvl], y])
+                self.train_w[lvl] = np.concatenate([self.train_w[lvl], np.ones(len(y), dtype=np.float32)])
+
+    def input_feed(self, parts):
+        """
+        Feed for the input placeholder of a batch of training examples.
+
+        :param parts: List of (level, example indices) tuples, concatenated in order.
+        """
+        if self.sparse:
+            return {self.X: self.feed_x([self.train_x[lvl][i] for lvl, idx in parts for i in idx])}
+        return {self.X: np.concatenate([self.train_x[lvl][idx] for lvl, idx in parts])}
+
+    def soft_batches(self, x, soft_targets, rng=None):
+        """
+        Generate the distillation batches for one epoch, over all examples.
+
+        :return: Generator of (input feed, list of the four soft target arrays) tuples.
+        """
+        order = np.arange(len(x)) if rng is None else rng.permutation(len(x))
+        for start in range(0, len(x), self.bsz):
+            idx = order[start:start + self.bsz]
+            rows = [x[i] for i in idx] if self.sparse else x[idx]
+            yield self.feed_x(rows), [p[idx] for p in soft_targets]
+
+    def distill(self, nl_commands, soft_targets, epochs=None, temperature=1.0, keep_prob=1.0, shuffle=True,
+                prefetch=8, callbacks=None):
+        """
+        Train the model to match a teacher's output distributions on a set of commands, which need not be
+        labelled (knowledge distillation). All three heads and the level selector are trained on every
+        command.
+
+        :param soft_targets: Tuple of the teacher's [N, 3] level-selection probabilities and the list of its
+                             three per-level head probabilities (as returned by RNNDual.probs()).
+        :param epochs: Number of passes over the commands. Defaults to the model's epochs.
+        :param temperature: Softmax temperature of the student's logits. The teacher's distributions should
+                            be softened with the same temperature; the loss is scaled by its square.
+        :param keep_prob: Dropout keep probability. Matching soft targets already regularizes the student,
+                          and with dropout it tends to collapse onto the most frequent commands.
+        :param callbacks: List of callbacks.Callback instances, as for fit().
+        """
+        if self.opt is None:
+            self.resume_training()
+        if self.distill_op is None:
+            with self.graph.as_default():
+                existing = set(tf.global_variables())
+                self.distill_op = self.opt.minimize(self.distill_loss)
+                self.session.run(tf.variables_initializer([v for v in tf.global_variables() if v not in existing]))
+
+        lvl, heads = soft_targets
+        x, targets = self.encoder.bag_of_words(nl_commands, self.sparse), list(heads) + [lvl]
+        placeholders = [self.L0_P, self.L1_P, self.L2_P, self.LVL_P]
+        epochs = self.epochs if epochs is None else epochs
+
+        self.word_h1_stale = True
+        pipeline = BatchPipeline(lambda rng: self.soft_batches(x, targets, rng), epochs, prefetch, shuffle,
+                                 self.seed)
+        callbacks = CallbackList(callbacks)
+        callbacks.begin_train(self)
+        try:
+            for e in range(epochs):
+                callbacks.begin_epoch(self, e)
+                for feed_x, batch_targets in pipeline.epoch():
+                    feed_dict = dict(zip(placeholders, batch_targets))
+                    feed_dict.update({self.X: feed_x, self.keep_prob: keep_prob, self.temperature: temperature})
+                    loss, _ = callbacks.run(self.session, [self.distill_loss, self.distill_op], feed_dict,
+                                            tag='distill')
+                    callbacks.end_step(self, loss, len(batch_targets[0]))
+                callbacks.end_epoch(self)
+        finally:
+            pipeline.close()
+            self.new_version()
+        callbacks.end_train(self)
+
+    def checkpoint_meta(self):
+        """
+        Model-specific checkpoint metadata: the label maps and replay sample.
+        """
+        return {'commands': [self.l0_commands, self.l1_commands, self.l2_commands],
+                'replay': self.replay_meta([(lvl, self.train_y[lvl], self.train_w[lvl])
+                                            for lvl in ['L0', 'L1', 'L2']])}
+
+    def example_ids(self, lvl, idx):
+        """
+        Word ids of the given training examples of a level, each word repeated by its count (in id order).
+        """
+        if self.sparse:
+            return [np.repeat(self.train_x[lvl][i][0], self.train_x[lvl][i][1].astype(np.int64)) for i in idx]
+        return [np.repeat(np.arange(self.train_x[lvl].shape[1]), self.train_x[lvl][i]) for i in idx]
+
+    def use_dataset(self, dataset, **hparams):
+        """
+        Configure the model, and take its vocabulary and training data from a corpus.Dataset with L0, L1 and
+        L2 levels (see from_dataset()).
+        """
+        self.l0_pc, self.l1_pc, self.l2_pc = [], [], []
+        self.configure(dataset.commands['L0'], dataset.commands['L1'], dataset.commands['L2'], **hparams)
+
+        self.set_encoder(dataset.encoder(self.vocab_size, self.hash_vocab))
+        self.train_x = {lvl: bag_of_words_ids(dataset.encoded(self.encoder, lvl), dataset.lengths[lvl],
+                                              len(self.encoder), self.sparse) for lvl in self.lvl_dict}
+        self.train_y = {lvl: dataset.labels[lvl] for lvl in self.lvl_dict}
+        self.train_w = {lvl: dataset.weights(lvl) for lvl in self.lvl_dict}
+
+    def use_checkpoint(self, meta, **hparams):
+        """
+        Configure the model from a checkpoint's metadata, with its replay sample as the training data (see
+        load()).
+        """
+        self.l0_pc, self.l1_pc, self.l2_pc = [], [], []
+        self.configure(*[[[str(w) for w in c] for c in lvl_commands] for lvl_commands in meta['commands']],
+                       **hparams)
+
+        self.set_encoder(self.checkpoint_encoder(meta))
+        self.train_x, self.train_y, self.train_w = {}, {}, {}
+        for lvl in self.lvl_dict:
+            flat, lengths, self.train_y[lvl], self.train_w[lvl] = saved_examples(meta, lvl)
+            self.train_x[lvl] = bag_of_words(np.repeat(np.arange(len(lengths)), lengths), flat, len(lengths),
+                                             len(self.encoder), self.sparse)
+
+    def new_version(self):
+        """
+        Mark the weights as changed, invalidating any cached predictions and the sparse scoring table.
+        """
+        super(NNDual, self).new_version()
+        self.word_h1_stale = True
+
+    def probs(self, nl_commands):
+        """
+        Compute the output distributions for a batch of commands.
+
+        :return: Tuple of the [batch, 3] level-selection probabilities and the list of the three per-level
+                 head probabilities, each of shape [batch, len(<lvl>_commands)].
+        """
+        start = time.time()
+        flat, lengths = self.encoder.lookup(nl_commands)
+        seqs = bag_of_words(np.repeat(np.arange(len(lengths)), lengths), flat, len(lengths), len(self.encoder),
+                            self.sparse)
+        encoded = time.time()
+        if self.sparse and self.word_h1_stale:
+            self.session.run(self.update_word_h1)
+            self.word_h1_stale = False
+
+        lvl, l0, l1, l2 = self.session.run([self.lvl_probs, self.l0_probs, self.l1_probs, self.l2_probs],
+                                           feed_dict={self.X: self.feed_x(seqs), self.keep_prob: 1.0})
+        if self.metrics is not None:
+            self.metrics.record_forward(encoded - start, time.time() - encoded,
+                                        *self.encoder.count_unknown(flat))
+        return lvl, [l0, l1, l2]
+
+    def export_numpy(self, path):
+        """
+        Dump the trained weights, vocabulary and label maps to a single .npz file, which can be scored
+        without TensorFlow by predictor.Predictor.
+
+        :param path: Path of the .npz file to write.
+        """
+        with self.graph.as_default():
+            weights = collect_weights(self.session, tf.trainable_variables())
+        np.savez(path, model='NNDual', max_len=0, id2word=np.array(self.id2word),
+                 vocab_size=len(self.encoder), hash_vocab=self.hash_vocab,
+                 l0_commands=np.array([" ".join(x) for x in self.l0_commands]),
+                 l1_commands=np.array([" ".join(x) for x in self.l1_commands]),
+                 l2_commands=np.array([" ".join(x) for x in self.l2_commands]), **weights)
@@ -4,15 +4,26 @@ dual_rnn.py
 Dual Model with a recurrent neural network encoder. Has multiple heads for each of the three levels, 
 as well as a head for level selection.
 """
+import os
+import time
+
 import numpy as np
 import tensorflow as tf
 
-PAD, PAD_ID = "<<PAD>>", 0
-UNK, UNK_ID = "<<UNK>>", 1
+from base import DualModel, saved_examples
+from batching import bucket_batches, pad_batch
+from callbacks import CallbackList
+from cells import check_cell, checkpoint_names, encode, output, state_size, step
+from encoder import Encoder, PAD_ID, pad_ids
+from pipeline import BatchPipeline
+from predictor import collect_weights
+from streaming import Stream
 
-class RNNDual():
+class RNNDual(DualModel):
     def __init__(self, l0_corpus, l1_corpus, l2_corpus, l0_commands, l1_commands, l2_commands,
-                 embedding_size=30, rnn_size=50, h1_size=60, h2_size=50, epochs=10, batch_size=16):
+                 embedding_size=30, rnn_size=50, h1_size=60, h2_size=50, epochs=10, batch_size=16,
+                 buckets=None, fused=False, seed=None, vocab_size=None, hash_vocab=False, cell='gru',
+                 spare_words=0, session_config=None):
         """
         Instantiates and Trains Model using the given set of parallel corpora.
 
@@ -20,81 +31,158 @@ class RNNDual():
                     1) List of source sentence tokens
                     2) List of target sentence tokens
         :param <lvl>_commands: List of Lists, where each element is one of the possible commands (labels)
+        :param buckets: Optional sorted list of sentence length boundaries. If given, training and scoring
+                        batches are drawn from a single length bucket, and padded only to their own
+                        longest sentence.
+        :param fused: If True, train on mixed batches holding examples from all three levels, with one
+                      optimizer step over the masked head losses and the level-selection loss, instead of
+                      one step per level. Every example is used, even when the levels differ in size.
+        :param seed: Optional graph-level random seed, for reproducible initialization and dropout.
+        :param vocab_size: If given, fix the number of word ids (and so the embedding size): keep only the
+                           vocab_size - 2 most frequent words, mapping the rest to UNK.
+        :param hash_vocab: If True (with a vocab_size), hash every word into vocab_size - 2 buckets instead,
+                           so no word is out of vocabulary and ids are stable across corpora and retrains.
+        :param cell: Encoder backend: 'gru', 'gru_block', 'lstm_block' or 'lstm_fused' (see cells.py).
+        :param spare_words: Number of embedding rows to reserve past the end of the vocabulary (unless it has a
+                            vocab_size), so that partial_fit() can add new words without rebuilding the graph.
+                            By default none are reserved, and new words grow the embedding instead.
+        :param session_config: Optional tf.ConfigProto for the model's session (see sessions.session_config).
         """
         self.l0_pc, self.l1_pc, self.l2_pc = l0_corpus, l1_corpus, l2_corpus
+        self.configure(l0_commands, l1_commands, l2_commands, embedding_size, rnn_size, h1_size, h2_size,
+                       epochs, batch_size, buckets, fused, seed, vocab_size, hash_vocab, cell, spare_words)
+
+        # Build Vocabulary
+        encoder, self.max_len, self.lengths = self.build_vocabulary()
+        self.set_encoder(encoder)
+
+        # Vectorize Parallel Corpus
+        self.train_x, self.train_y = self.vectorize()
+        self.train_w = {lvl: np.ones(len(self.train_y[lvl]), dtype=np.float32) for lvl in self.lvl_dict}
+
+        # Build Graph, and Initialize all variables
+        self.build_graph(session_config=session_config)
+
+    def configure(self, l0_commands, l1_commands, l2_commands, embedding_size=30, rnn_size=50, h1_size=60,
+                  h2_size=50, epochs=10, batch_size=16, buckets=None, fused=False, seed=None,
+                  vocab_size=None, hash_vocab=False, cell='gru', spare_words=0):
+        """
+        Set up the label maps and hyperparameters, shared by the constructor, from_dataset() and load().
+        """
         self.l0_commands, self.l0_labels = l0_commands, {" ".join(x): i for (i, x) in enumerate(l0_commands)}
         self.l1_commands, self.l1_labels = l1_commands, {" ".join(x): i for (i, x) in enumerate(l1_commands)}
-        self.l2_commands, self.l2_labels = l2_commands, {" ".join(x): i for (i, x) in enumerate(l2_commands)}        
-        
-        self.epochs, self.bsz = epochs, batch_size
+        self.l2_commands, self.l2_labels = l2_commands, {" ".join(x): i for (i, x) in enumerate(l2_commands)}
+
+        self.epochs, self.bsz, self.buckets, self.fused, self.seed = epochs, batch_size, buckets, fused, seed
         self.embedding_sz, self.rnn_sz, self.h1_sz, self.h2_sz = embedding_size, rnn_size, h1_size, h2_size
-        self.init = tf.truncated_normal_initializer(stddev=0.5)
+        check_cell(cell)
+        self.vocab_size, self.hash_vocab, self.cell, self.spare_words = vocab_size, hash_vocab, cell, spare_words
+        self.state_sz = state_size(cell, rnn_size)
+        self.hparams = {'embedding_size': embedding_size, 'rnn_size': rnn_size, 'h1_size': h1_size,
+                        'h2_size': h2_size, 'epochs': epochs, 'batch_size': batch_size, 'buckets': buckets,
+                        'fused': fused, 'seed': seed, 'vocab_size': vocab_size, 'hash_vocab': hash_vocab,
+                        'cell': cell, 'spare_words': spare_words}
+        self.init, self.epochs_done = tf.truncated_normal_initializer(stddev=0.5), 0
+        self.score_cache, self.metrics, self.model_version = None, None, 0
 
         # Build Level Dictionary
-        self.lvl_dict = {'L0': (self.l0_commands, self.l0_pc, self.l0_labels), 
-                         'L1': (self.l1_commands, self.l1_pc, self.l1_labels), 
+        self.lvl_dict = {'L0': (self.l0_commands, self.l0_pc, self.l0_labels),
+                         'L1': (self.l1_commands, self.l1_pc, self.l1_labels),
                          'L2': (self.l2_commands, self.l2_pc, self.l2_labels)}
 
-        # Build Vocabulary
-        self.word2id, self.id2word, self.max_len, self.lengths = self.build_vocabulary()
+    def build_graph(self, training=True, session_config=None):
+        """
+        Build the placeholders, inference graph and losses in a new graph owned by the model, and initialize
+        all variables in a new session.
 
-        # Vectorize Parallel Corpus
-        self.train_x, self.train_y = self.vectorize()
+        :param training: If False, skip the optimizer, which build_training() adds on the first fit().
+        :param session_config: Optional tf.ConfigProto for the session (e.g. to limit its thread pools).
+        """
+        self.graph, self.session_config = tf.Graph(), session_config
+        self.graph.seed = self.seed
+        with self.graph.as_default():
+            # Setup Placeholders
+            self.X = tf.placeholder(tf.int32, shape=[None, None], name='NL_Command')
+            self.X_len = tf.placeholder(tf.int32, shape=[None], name='NL_Length')
+            self.L0_Y = tf.placeholder(tf.int32, shape=[None], name='L0_ML_Command')
+            self.L1_Y = tf.placeholder(tf.int32, shape=[None], name='L1_ML_Command')
+            self.L2_Y = tf.placeholder(tf.int32, shape=[None], name='L2_ML_Command')
+            self.LVL_Y = tf.placeholder(tf.int32, shape=[None], name='Level_Label')
+            self.CMD_Y = tf.placeholder(tf.int32, shape=[None], name='ML_Command')
+            self.W = tf.placeholder_with_default(tf.ones_like(self.LVL_Y, dtype=tf.float32), shape=[None],
+                                                 name='Example_Weight')
+            self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
+
+            # Build Inference Graph
+            self.l0_logits, self.l1_logits, self.l2_logits, self.lvl_logits = self.inference()
+            self.l0_probs, self.l1_probs = tf.nn.softmax(self.l0_logits), tf.nn.softmax(self.l1_logits)
+            self.l2_probs, self.lvl_probs = tf.nn.softmax(self.l2_logits), tf.nn.softmax(self.lvl_logits)
 
-        # Setup Placeholders
-        self.X = tf.placeholder(tf.int32, shape=[None, self.max_len], name='NL_Command')
-        self.X_len = tf.placeholder(tf.int32, shape=[None], name='NL_Length')
-        self.L0_Y = tf.placeholder(tf.int32, shape=[None], name='L0_ML_Command')
-        self.L1_Y = tf.placeholder(tf.int32, shape=[None], name='L1_ML_Command')
-        self.L2_Y = tf.placeholder(tf.int32, shape=[None], name='L2_ML_Command')
-        self.LVL_Y = tf.placeholder(tf.int32, shape=[None], name='Level_Label')
-        self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
-
-        # Build Inference Graph
-        self.l0_logits, self.l1_logits, self.l2_logits, self.lvl_logits = self.inference()
-        self.l0_probs, self.l1_probs = tf.nn.softmax(self.l0_logits), tf.nn.softmax(self.l1_logits)
-        self.l2_probs, self.lvl_probs = tf.nn.softmax(self.l2_logits), tf.nn.softmax(self.lvl_logits)
-
-        # Build Loss Computations
-        self.l0_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l0_logits,
-                                                                                     self.L0_Y))
-        self.l1_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l1_logits,
-                                                                                     self.L1_Y))
-        self.l2_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.l2_logits,
-                                                                                     self.L2_Y))
-        self.lvl_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.lvl_logits,
-                                                                                      self.LVL_Y))
-
-        # Build Training Operations
-        self.opt = tf.train.AdamOptimizer()
-        self.l0_train_op = self.opt.minimize(self.l0_loss + self.lvl_loss)
-        self.l1_train_op = self.opt.minimize(self.l1_loss + self.lvl_loss)
-        self.l2_train_op = self.opt.minimize(self.l2_loss + self.lvl_loss)
-
-        # Initialize all variables
-        self.session = tf.Session()
-        self.saver = tf.train.Saver()
-        self.session.run(tf.global_variables_initializer())
+            # Build Streaming Graph, advancing the encoder state one token at a time
+            self.step_x = tf.placeholder(tf.int32, shape=[None], name='Step_Word')
+            self.step_h = tf.placeholder(tf.float32, shape=[None, self.state_sz], name='Step_State')
+            self.step_state, step_logits, state_logits = self.stream_inference()
+            self.step_probs = [tf.nn.softmax(step_logits[3])] + [tf.nn.softmax(l) for l in step_logits[:3]]
+            self.state_probs = [tf.nn.softmax(state_logits[3])] + [tf.nn.softmax(l) for l in state_logits[:3]]
+
+            # Build Loss Computations, weighting each example (e.g. by its count in a compacted corpus)
+            self.l0_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l0_logits,
+                                                                                                  self.L0_Y))
+            self.l1_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l1_logits,
+                                                                                                  self.L1_Y))
+            self.l2_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.l2_logits,
+                                                                                                  self.L2_Y))
+            self.lvl_loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.lvl_logits,
+                                                                                                   self.LVL_Y))
+
+            # Masked Loss over Mixed-Level Batches: each head only counts the examples from its own level
+            self.fused_loss = self.lvl_loss
+            head_logits = [self.l0_logits, self.l1_logits, self.l2_logits]
+            for k, (lvl, logits) in enumerate(zip(['L0', 'L1', 'L2'], head_logits)):
+                mask = tf.to_float(tf.equal(self.LVL_Y, k))
+                labels = tf.minimum(self.CMD_Y, len(self.lvl_dict[lvl][0]) - 1)
+                xent = tf.nn.sparse_softmax_cross_entropy_with_logits(logits, labels)
+                self.fused_loss += tf.reduce_sum(mask * self.W * xent) / tf.maximum(tf.reduce_sum(mask), 1.0)
+
+            # Build Training Operations, and Saver
+            if training:
+                self.build_training()
+            else:
+                self.opt, self.saver = None, tf.train.Saver(checkpoint_names(tf.trainable_variables()))
+
+            # Initialize all variables
+            self.session = tf.Session(graph=self.graph, config=session_config)
+            self.session.run(tf.global_variables_initializer())
+
+    def build_training(self):
+        """
+        Build the training operations, and a saver covering the optimizer state.
+        """
+        self.learning_rate = tf.placeholder_with_default(0.001, shape=[], name='Learning_Rate')
+        self.opt = tf.train.AdamOptimizer(self.learning_rate)
+        if self.fused:
+            self.train_op = self.opt.minimize(self.fused_loss)
+        else:
+            self.l0_total_loss = self.l0_loss + self.lvl_loss
+            self.l1_total_loss = self.l1_loss + self.lvl_loss
+            self.l2_total_loss = self.l2_loss + self.lvl_loss
+            self.l0_train_op = self.opt.minimize(self.l0_total_loss)
+            self.l1_train_op = self.opt.minimize(self.l1_total_loss)
+            self.l2_train_op = self.opt.minimize(self.l2_total_loss)
+        self.saver = tf.train.Saver(checkpoint_names(tf.global_variables()))
 
     def build_vocabulary(self):
         """
         Builds the vocabulary from the parallel corpus, adding the UNK ID.
 
-        :return: Tuple of Word2Id, Id2Word Dictionaries.
+        :return: Tuple of Encoder, maximum sentence length, and dictionary of per-level sentence lengths.
         """
-        vocab, max_length, lengths = set(), 0, {"L0": [], "L1": [], "L2": []}
-        for lvl in self.lvl_dict:
-            for n, _ in self.lvl_dict[lvl][1]:
-                if len(n) > max_length:
-                    max_length = len(n)
-                lengths[lvl].append(len(n))
-                for word in n:
-                    vocab.add(word)
-
-        id2word = [PAD, UNK] + list(vocab)
-        word2id = {id2word[i]: i for i in range(len(id2word))}
-        print 'VOCAB LEN', len(word2id)
-        return word2id, id2word, max_length, lengths
+        encoder = Encoder.build((n for lvl in self.lvl_dict for n, _ in self.lvl_dict[lvl][1]), self.vocab_size,
+                                self.hash_vocab)
+        lengths = {lvl: [len(n) for n, _ in self.lvl_dict[lvl][1]] for lvl in self.lvl_dict}
+        max_length = max([0] + [l for lvl in lengths for l in lengths[lvl]])
+        print 'VOCAB LEN', len(encoder)
+        return encoder, max_length, lengths
 
     def vectorize(self):
         """
@@ -102,17 +190,9 @@ class RNNDual():
         """
         x, y = {}, {}
         for lvl in self.lvl_dict:
-            x[lvl], y[lvl] = [], []
-            for nl, ml in self.lvl_dict[lvl][1]:
-                nvec, mlab = np.zeros((self.max_len), dtype=np.int32), self.lvl_dict[lvl][2][" ".join(ml)]
-                for i in range(len(nl)):
-                    nvec[i] = self.word2id.get(nl[i], UNK_ID)
-                x[lvl].append(nvec)
-                y[lvl].append(mlab)
-        
-        for lvl in self.lvl_dict:
-            x[lvl] = np.array(x[lvl], dtype=np.int32)
-            y[lvl] = np.array(y[lvl], dtype=np.int32)
+            x[lvl] = self.encoder.encode([nl for nl, _ in self.lvl_dict[lvl][1]], self.max_len)[0]
+            y[lvl] = np.array([self.lvl_dict[lvl][2][" ".join(ml)] for _, ml in self.lvl_dict[lvl][1]],
+                              dtype=np.int32)
         return x, y
 
     def inference(self):
@@ -121,16 +201,34 @@ class RNNDual():
         distribution over all possible reward functions.
         """
         # Shared Embedding
-        E = tf.get_variable("Embedding", shape=[len(self.word2id), self.embedding_sz],
+        E = tf.get_variable("Embedding", shape=[len(self.encoder), self.embedding_sz],
                             dtype=tf.float32, initializer=self.init)
         embedding = tf.nn.embedding_lookup(E, self.X)
         embedding = tf.nn.dropout(embedding, self.keep_prob)      # Shape: [None, max_len, embed_sz]
 
         # RNN Encoder
-        cell = tf.nn.rnn_cell.GRUCell(self.rnn_sz)
-        _, state = tf.nn.dynamic_rnn(cell, embedding, sequence_length=self.X_len, dtype=tf.float32)
-        h_state = state                                           # Shape: [None, rnn_sz]
+        state = encode(self.cell, embedding, self.X_len, self.rnn_sz)
+        h_state = output(self.cell, state, self.rnn_sz)           # Shape: [None, rnn_sz]
+        return self.heads(h_state)
+
+    def stream_inference(self):
+        """
+        Compile the streaming graph: a single encoder step from a given state, sharing its weights,
+        and the heads on both the given state and the stepped state.
+
+        :return: Tuple of (stepped state, head logits on the stepped state, head logits on the given state).
+        """
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            embedding = tf.nn.embedding_lookup(tf.get_variable("Embedding"), self.step_x)
+            state = step(self.cell, embedding, self.step_h, self.rnn_sz)
+            stepped, given = [output(self.cell, h, self.rnn_sz) for h in [state, self.step_h]]
+            return state, self.heads(stepped), self.heads(given)
 
+    def heads(self, h_state):
+        """
+        Compile the shared ReLU layer, and the level-specific and level-selection layers, on top of the
+        encoder state.
+        """
         # Shared ReLU Layer
         H1_W = tf.get_variable("Hidden_W1", shape=[self.rnn_sz, self.h1_sz], dtype=tf.float32,
                                initializer=self.init)
@@ -170,73 +268,268 @@ class RNNDual():
 
         return outputs['L0'], outputs['L1'], outputs['L2'], output
 
-    def fit(self, chunk_size):
+    def batches(self, chunk_size, rng=None):
+        """
+        Generate the training batches for one epoch, over the first chunk_size examples of each level.
+
+        :param rng: If given, a numpy RandomState used to shuffle the examples.
+        :return: Generator of steps, where each step is a dictionary mapping level to a tuple of (padded
+                 commands, lengths, labels, level labels, example weights). Levels that have run out of
+                 batches are absent. If fused, each step instead holds a single mixed-level batch, under
+                 'L_ALL'.
+        """
+        if self.fused:
+            for step in self.fused_batches(chunk_size, rng):
+                yield step
+            return
+
+        level_batches, lengths = {}, {lvl: np.array(self.lengths[lvl], dtype=np.int32) for lvl in self.lvl_dict}
+        for lvl in self.lvl_dict:
+            n = min(chunk_size, len(self.train_x[lvl]))
+            if self.buckets is None:
+                order = np.arange(n) if rng is None else rng.permutation(n)
+                level_batches[lvl] = [order[start:end] for start, end in
+                                      zip(range(0, chunk_size - self.bsz, self.bsz), range(self.bsz, chunk_size, self.bsz))
+                                      if end < len(self.train_x[lvl])]
+            else:
+                level_batches[lvl] = bucket_batches(lengths[lvl][:n], self.buckets, self.bsz, rng)
+
+        for i in range(max(len(b) for b in level_batches.values())):
+            step = {}
+            for k, lvl in enumerate(['L0', 'L1', 'L2']):
+                if i < len(level_batches[lvl]):
+                    idx = level_batches[lvl][i]
+                    x, x_len = self.train_x[lvl][idx], lengths[lvl][idx]
+                    if self.buckets is not None:
+                        x = pad_batch(x, x_len)
+                    step[lvl] = (x, x_len, self.train_y[lvl][idx], np.zeros([len(idx)], dtype=np.int32) + k,
+                                 self.train_w[lvl][idx])
+            yield step
+
+    def fused_batches(self, chunk_size, rng=None):
+        """
+        Generate mixed-level training batches for one epoch, over the first chunk_size examples of each
+        level. Each batch holds up to batch_size examples from every level (or with buckets, up to
+        3 * batch_size examples of similar length from any level), and no examples are dropped.
+        """
+        sizes = [min(chunk_size, len(self.train_x[lvl])) for lvl in ['L0', 'L1', 'L2']]
+        offsets = np.cumsum([0] + sizes)
+        x = np.concatenate([self.train_x[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        y = np.concatenate([self.train_y[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        lengths = np.concatenate([np.array(self.lengths[lvl][:n], dtype=np.int32)
+                                  for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        w = np.concatenate([self.train_w[lvl][:n] for lvl, n in zip(['L0', 'L1', 'L2'], sizes)])
+        lvl_y = np.repeat(np.arange(3, dtype=np.int32), sizes)
+
+        if self.buckets is None:
+            level_batches = []
+            for k, n in enumerate(sizes):
+                order = offsets[k] + (np.arange(n) if rng is None else rng.permutation(n))
+                level_batches.append([order[i:i + self.bsz] for i in range(0, n, self.bsz)])
+            steps = [np.concatenate([b[i] for b in level_batches if i < len(b)])
+                     for i in range(max(len(b) for b in level_batches))]
+        else:
+            steps = bucket_batches(lengths, self.buckets, 3 * self.bsz, rng)
+
+        for idx in steps:
+            x_len = lengths[idx]
+            batch_x = x[idx] if self.buckets is None else pad_batch(x[idx], x_len)
+            yield {'L_ALL': (batch_x, x_len, y[idx], lvl_y[idx], w[idx])}
+
+    def fit(self, chunk_size, shuffle=False, prefetch=8, checkpoint=None, resume=False, callbacks=None):
         """
         Train the model, with the specified batch size and number of epochs.
+
+        :param shuffle: Whether to shuffle each level's examples every epoch (reproducibly, if the model has a
+                        seed).
+        :param prefetch: Number of batches prepared ahead of time on the background input thread.
+        :param checkpoint: If given, path the model is saved to after every epoch.
+        :param resume: If True, continue from the last completed epoch, restoring from checkpoint if one
+                       has been written.
+        :param callbacks: List of callbacks.Callback instances, receiving per-step timings and per-epoch
+                          loss and throughput. Defaults to printing the average loss every epoch.
         """
+        if self.opt is None:
+            self.resume_training()
+        if resume and checkpoint is not None and os.path.exists(checkpoint + '.json'):
+            self.restore(checkpoint)
+        first_epoch = self.epochs_done if resume else 0
+
+        level_ops = self.level_ops()
+
         # Run through epochs
-        z, l0_len, l1_len, l2_len = np.zeros([self.bsz]), len(self.train_x['L0']), len(self.train_x['L1']), len(self.train_x['L2'])
-        l0_loss, l1_loss, l2_loss = 0, 0, 0
-        for e in range(self.epochs):
-            curr_loss, batches = 0.0, 0.0
-            for start, end in zip(range(0, chunk_size - self.bsz, self.bsz),
-                                  range(self.bsz, chunk_size, self.bsz)):
-                if end < l0_len:
-                    l0_loss, _ = self.session.run([self.l0_loss + self.lvl_loss, self.l0_train_op],
-                                                feed_dict={self.X: self.train_x['L0'][start:end],
-                                                            self.X_len: self.lengths['L0'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L0_Y: self.train_y['L0'][start:end],
-                                                            self.LVL_Y: z + 0})
-                if end < l1_len:
-                    l1_loss, _ = self.session.run([self.l1_loss + self.lvl_loss, self.l1_train_op],
-                                                feed_dict={self.X: self.train_x['L1'][start:end],
-                                                            self.X_len: self.lengths['L1'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L1_Y: self.train_y['L1'][start:end],
-                                                            self.LVL_Y: z + 1})
-                if end < l2_len:
-                    l2_loss, _ = self.session.run([self.l2_loss + self.lvl_loss, self.l2_train_op],
-                                                feed_dict={self.X: self.train_x['L2'][start:end],
-                                                            self.X_len: self.lengths['L2'][start:end],
-                                                            self.keep_prob: 0.5,
-                                                            self.L2_Y: self.train_y['L2'][start:end],
-                                                            self.LVL_Y: z + 2})
-                curr_loss += l0_loss + l1_loss + l2_loss
-                batches += 1
-            print 'Epoch %s Average Loss:' % str(e), curr_loss / batches
-
-    def score(self, nl_command):
-        """
-        Given a natural language command, return predicted output and score.
-
-        :return: List of tokens representing predicted command, and score.
-        """
-        seq = np.zeros((self.max_len), dtype=np.int32)
-        for i in range(min(len(nl_command), self.max_len)):
-            seq[i] = self.word2id.get(nl_command[i], UNK_ID)
-        
-        lvl = self.session.run(self.lvl_probs, feed_dict={self.X: [seq], self.X_len: [len(nl_command)],
-                                                          self.keep_prob: 1.0})
-        [pred_level] = np.argmax(lvl, axis=1)
-
-        if pred_level == 0:
-            y = self.session.run(self.l0_probs, feed_dict={self.X: [seq], self.X_len: [len(nl_command)],
-                                                           self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l0_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
-        elif pred_level == 1:
-            y = self.session.run(self.l1_probs, feed_dict={self.X: [seq], self.X_len: [len(nl_command)],
-                                                           self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l1_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
-        elif pred_level == 2:
-            y = self.session.run(self.l2_probs, feed_dict={self.X: [seq], self.X_len: [len(nl_command)],
-                                                           self.keep_prob: 1.0})
-            [pred_command] = np.argmax(y, axis=1)
-            return self.l2_commands[pred_command], y[0][pred_command], pred_level, lvl[0][pred_level]
+        pipeline = BatchPipeline(lambda rng: self.batches(chunk_size, rng), self.epochs - first_epoch, prefetch,
+                                 shuffle, self.seed)
+        callbacks, losses = CallbackList(callbacks), [0, 0, 0]
+        callbacks.begin_train(self)
+        try:
+            for e in range(first_epoch, self.epochs):
+                callbacks.begin_epoch(self, e)
+                for step in pipeline.epoch():
+                    examples = 0
+                    for k, (lvl, Y, loss, train_op) in enumerate(level_ops):
+                        if lvl in step:
+                            x, x_len, y, lvl_y, w = step[lvl]
+                            losses[k], _ = callbacks.run(self.session, [loss, train_op],
+                                                         feed_dict={self.X: x, self.X_len: x_len,
+                                                                    self.keep_prob: 0.5, Y: y,
+                                                                    self.LVL_Y: lvl_y, self.W: w}, tag=lvl)
+                            examples += len(y)
+                    callbacks.end_step(self, sum(losses), examples)
+                callbacks.end_epoch(self)
+                self.epochs_done = e + 1
+                if checkpoint is not None:
+                    self.save(checkpoint)
+        finally:
+            pipeline.close()
+            self.new_version()
+        callbacks.end_train(self)
+
+    def add_examples(self, new_pairs):
+        """
+        Append new labeled examples to the training data (see partial_fit()). If they are longer than any
+        seen so far, max_len grows, and the old examples are padded to it.
+
+        :param new_pairs: Dictionary mapping level to a list of (source tokens, target tokens) tuples.
+        """
+        self.max_len = max([self.max_len] + [len(nl) for pairs in new_pairs.values() for nl, _ in pairs])
+        for lvl in self.lvl_dict:
+            width = self.train_x[lvl].shape[1]
+            if width < self.max_len:
+                self.train_x[lvl] = np.pad(self.train_x[lvl], ((0, 0), (0, self.max_len - width)), 'constant',
+                                           constant_values=PAD_ID)
+            if lvl in new_pairs:
+                x, x_len = self.encoder.encode([nl for nl, _ in new_pairs[lvl]], self.max_len)
+                y = np.array([self.lvl_dict[lvl][2][" ".join(ml)] for _, ml in new_pairs[lvl]], dtype=np.int32)
+                self.train_x[lvl] = np.concatenate([self.train_x[lvl], x])
+                self.train_y[lvl] = np.concatenate([self.train_y[lvl], y])
+                self.train_w[lvl] = np.concatenate([self.train_w[lvl], np.ones(len(y), dtype=np.float32)])
+                self.lengths[lvl] = np.concatenate([np.asarray(self.lengths[lvl], dtype=np.int32), x_len])
+
+    def input_feed(self, parts):
+        """
+        Feed for the input placeholders of a batch of training examples, padded to its longest sentence.
+
+        :param parts: List of (level, example indices) tuples, concatenated in order.
+        """
+        x = np.concatenate([self.train_x[lvl][idx] for lvl, idx in parts])
+        x_len = np.concatenate([np.asarray(self.lengths[lvl], dtype=np.int32)[idx] for lvl, idx in parts])
+        return {self.X: pad_batch(x, x_len), self.X_len: x_len}
+
+    def checkpoint_meta(self):
+        """
+        Model-specific checkpoint metadata: the label maps, maximum sentence length and replay sample.
+        """
+        return {'max_len': self.max_len, 'commands': [self.l0_commands, self.l1_commands, self.l2_commands],
+                'replay': self.replay_meta([(lvl, self.train_y[lvl], self.train_w[lvl])
+                                            for lvl in ['L0', 'L1', 'L2']])}
+
+    def example_ids(self, lvl, idx):
+        """
+        Word ids of the given training examples of a level, without padding.
+        """
+        lengths = np.asarray(self.lengths[lvl])
+        return [self.train_x[lvl][i, :lengths[i]] for i in idx]
+
+    def use_dataset(self, dataset, **hparams):
+        """
+        Configure the model, and take its vocabulary and training data from a corpus.Dataset with L0, L1 and
+        L2 levels (see from_dataset()).
+        """
+        self.l0_pc, self.l1_pc, self.l2_pc = [], [], []
+        self.configure(dataset.commands['L0'], dataset.commands['L1'], dataset.commands['L2'], **hparams)
+
+        self.set_encoder(dataset.encoder(self.vocab_size, self.hash_vocab))
+        self.max_len, self.lengths = dataset.max_len, {lvl: dataset.lengths[lvl] for lvl in self.lvl_dict}
+        self.train_x = {lvl: dataset.encoded(self.encoder, lvl) for lvl in self.lvl_dict}
+        self.train_y = {lvl: dataset.labels[lvl] for lvl in self.lvl_dict}
+        self.train_w = {lvl: dataset.weights(lvl) for lvl in self.lvl_dict}
+
+    def use_checkpoint(self, meta, **hparams):
+        """
+        Configure the model from a checkpoint's metadata, with its replay sample as the training data (see
+        load()).
+        """
+        self.l0_pc, self.l1_pc, self.l2_pc = [], [], []
+        self.configure(*[[[str(w) for w in c] for c in lvl_commands] for lvl_commands in meta['commands']],
+                       **hparams)
+
+        self.set_encoder(self.checkpoint_encoder(meta))
+        self.max_len, self.lengths, self.train_x, self.train_y, self.train_w = meta['max_len'], {}, {}, {}, {}
+        for lvl in self.lvl_dict:
+            flat, lengths, self.train_y[lvl], self.train_w[lvl] = saved_examples(meta, lvl)
+            self.train_x[lvl], self.lengths[lvl] = pad_ids(flat, lengths, self.max_len)
+
+    def stream(self, threshold=None):
+        """
+        Start scoring a command incrementally, as its tokens arrive.
+
+        :param threshold: If given, the first prediction whose confidence (command score times level
+                          score) reaches this value is kept as the stream's provisional prediction.
+        :return: streaming.Stream.
+        """
+        return Stream(self, threshold)
+
+    def step(self, word_ids, states):
+        """
+        Advance a batch of encoder states by one token each, and predict from the new states.
+
+        :param word_ids: Array of shape [batch] with the next word id of each stream.
+        :param states: Array of shape [batch, rnn_size] with the current states.
+        :return: Tuple of (new states, list of (command tokens, score, level, level score) tuples).
+        """
+        state, lvl, l0, l1, l2 = self.session.run([self.step_state] + self.step_probs,
+                                                  feed_dict={self.step_x: word_ids, self.step_h: states,
+                                                             self.keep_prob: 1.0})
+        return state, self.pick_predictions(lvl, [l0, l1, l2])
+
+    def predict_state(self, states):
+        """
+        Predict from a batch of encoder states, without stepping them.
+        """
+        lvl, l0, l1, l2 = self.session.run(self.state_probs, feed_dict={self.step_h: states, self.keep_prob: 1.0})
+        return self.pick_predictions(lvl, [l0, l1, l2])
+
+    def probs(self, nl_commands):
+        """
+        Compute the output distributions for a batch of commands (e.g. as soft targets for distillation).
+
+        :return: Tuple of the [batch, 3] level-selection probabilities and the list of the three per-level
+                 head probabilities, each of shape [batch, len(<lvl>_commands)].
+        """
+        start = time.time()
+        flat, lengths = self.encoder.lookup(nl_commands)
+        seqs, seq_lens = pad_ids(flat, lengths, self.max_len)
+        encoded = time.time()
+        if self.buckets is None:
+            groups = [np.arange(len(nl_commands))]
         else:
-            raise UnicodeError()
-    
-    
-        
\ No newline at end of file
+            groups = bucket_batches(seq_lens, self.buckets)
+
+        lvl = np.zeros([len(nl_commands), 3], dtype=np.float32)
+        heads = [np.zeros([len(nl_commands), len(c)], dtype=np.float32)
+                 for c in [self.l0_commands, self.l1_commands, self.l2_commands]]
+        for idx in groups:
+            x = seqs[idx] if self.buckets is None else pad_batch(seqs[idx], seq_lens[idx])
+            lvl[idx], heads[0][idx], heads[1][idx], heads[2][idx] = self.session.run(
+                [self.lvl_probs, self.l0_probs, self.l1_probs, self.l2_probs],
+                feed_dict={self.X: x, self.X_len: seq_lens[idx], self.keep_prob: 1.0})
+        if self.metrics is not None:
+            self.metrics.record_forward(encoded - start, time.time() - encoded,
+                                        *self.encoder.count_unknown(flat))
+        return lvl, heads
+
+    def export_numpy(self, path):
+        """
+        Dump the trained weights, vocabulary and label maps to a single .npz file, which can be scored
+        without TensorFlow by predictor.Predictor.
+
+        :param path: Path of the .npz file to write.
+        """
+        with self.graph.as_default():
+            weights = collect_weights(self.session, tf.trainable_variables())
+        np.savez(path, model='RNNDual', max_len=self.max_len, id2word=np.array(self.id2word),
+                 vocab_size=len(self.encoder), hash_vocab=self.hash_vocab,
+                 l0_commands=np.array([" ".join(x) for x in self.l0_commands]),
+                 l1_commands=np.array([" ".join(x) for x in self.l1_commands]),
+                 l2_commands=np.array([" ".join(x) for x in self.l2_commands]), **weights)
@@ -0,0 +1,202 @@
+"""
+encoder.py
+
+Vocabulary and sequence encoding shared by all models. The vocabulary is built in one pass, whole
+corpora are encoded into id/length arrays with bulk NumPy operations, and the vocabulary can be
+extended with new words without changing (and so without re-encoding) the ids of existing ones.
+
+The number of ids (and so the embedding size) can be fixed, either by keeping only the most frequent
+words, or by hashing words into buckets; a fixed-size vocabulary keeps the same shape across retrains.
+"""
+import collections
+import zlib
+
+import numpy as np
+
+PAD, PAD_ID = "<<PAD>>", 0
+UNK, UNK_ID = "<<UNK>>", 1
+
+
+class Encoder(object):
+    def __init__(self, id2word=None, size=None, hashed=False):
+        """
+        Instantiates an encoder with the given vocabulary.
+
+        :param id2word: List of words indexed by id, starting with PAD and UNK. Defaults to just those two.
+        :param size: Fixed number of ids, at least len(id2word). Defaults to the length of the vocabulary.
+        :param hashed: If True, words missing from id2word are hashed (with CRC32, so ids are the same in
+                       every process and run) into the ids past the end of id2word, rather than mapped to
+                       UNK. Requires a size.
+        """
+        self.id2word = list(id2word) if id2word is not None else [PAD, UNK]
+        self.word2id = {self.id2word[i]: i for i in range(len(self.id2word))}
+        self.size, self.hashed = size, hashed
+        if size is not None and size < len(self.id2word) + hashed:
+            raise ValueError("Vocabulary of %d words does not fit in %d ids" % (len(self.id2word), size))
+        if hashed and size is None:
+            raise ValueError("A hashed vocabulary needs a size")
+
+    @classmethod
+    def build(cls, sentences, size=None, hashed=False):
+        """
+        Build the vocabulary from an iterable of token lists, in one pass, with words in sorted order.
+
+        :param size: If given, fix the number of ids. Only the size - 2 most frequent words (ties broken
+                     alphabetically) are kept, and the rest map to UNK; or if hashed, every word other than
+                     PAD and UNK is hashed into one of size - 2 buckets.
+        """
+        if hashed:
+            return cls(size=size, hashed=True)
+        counts = collections.Counter()
+        for sentence in sentences:
+            counts.update(sentence)
+        return cls.from_counts(counts, size)
+
+    @classmethod
+    def from_counts(cls, counts, size=None, hashed=False):
+        """
+        Build the vocabulary from a dictionary of word counts, as for build().
+        """
+        if hashed:
+            return cls(size=size, hashed=True)
+        vocab = [w for w in counts if w not in (PAD, UNK)]
+        if size is not None:
+            vocab = sorted(vocab, key=lambda w: (-counts[w], w))[:size - 2]
+        return cls([PAD, UNK] + sorted(vocab), size)
+
+    def __len__(self):
+        return self.size if self.size is not None else len(self.id2word)
+
+    def word_id(self, word):
+        """
+        Look up the id of a single word.
+        """
+        word_id = self.word2id.get(word)
+        if word_id is not None:
+            return word_id
+        if self.hashed:
+            return len(self.id2word) + (zlib.crc32(word) & 0xffffffff) % (self.size - len(self.id2word))
+        return UNK_ID
+
+    def extend(self, sentences):
+        """
+        Add any new words in the given token lists to the end of the vocabulary. Existing ids are
+        unchanged, so previously encoded data stays valid. With a fixed size, words are only added while
+        there are unused ids (in sorted order), and hashed vocabularies are never extended.
+
+        :return: Number of words added.
+        """
+        if self.hashed:
+            return 0
+        new = self.unknown(sentences)
+        new = new[:len(self) - len(self.id2word)] if self.size is not None else new
+        for word in new:
+            self.word2id[word] = len(self.id2word)
+            self.id2word.append(word)
+        return len(new)
+
+    def unknown(self, sentences):
+        """
+        Sorted list of the words in the given token lists that are not in the vocabulary.
+        """
+        new = set()
+        for sentence in sentences:
+            new.update(w for w in sentence if w not in self.word2id)
+        return sorted(new)
+
+    def count_unknown(self, flat):
+        """
+        Count the tokens in the flat word ids of some commands (as returned by lookup()), and those that are
+        out of vocabulary (encoded as UNK). A hashed vocabulary gives every word an id of its own bucket, so
+        it has no count of unknown tokens.
+
+        :return: Tuple of (tokens, unknown tokens), or (0, None) if hashed.
+        """
+        if self.hashed:
+            return 0, None
+        return len(flat), int(np.count_nonzero(flat == UNK_ID))
+
+    def remap(self, id2word):
+        """
+        Array mapping the ids of another vocabulary (e.g. a corpus.Dataset's) to this encoder's ids.
+        """
+        return self.lookup([id2word])[0]
+
+    def lookup(self, sentences):
+        """
+        Look up the ids of every token in a list of token lists.
+
+        :return: Tuple of (flat [total tokens] array of ids, [N] array of sentence lengths).
+        """
+        lengths = np.fromiter((len(s) for s in sentences), dtype=np.int32, count=len(sentences))
+        if self.hashed:
+            word_id = self.word_id
+            flat = np.fromiter((word_id(w) for s in sentences for w in s), dtype=np.int32, count=lengths.sum())
+        else:
+            get = self.word2id.get
+            flat = np.fromiter((get(w, UNK_ID) for s in sentences for w in s), dtype=np.int32,
+                               count=lengths.sum())
+        return flat, lengths
+
+    def encode(self, sentences, max_len=None):
+        """
+        Encode a list of token lists as a padded id matrix.
+
+        :param max_len: Width of the matrix; longer sentences are truncated. Defaults to the longest sentence.
+        :return: Tuple of ([N, max_len] int32 id matrix, [N] int32 array of (truncated) lengths).
+        """
+        return pad_ids(*self.lookup(sentences), max_len=max_len)
+
+    def bag_of_words(self, sentences, sparse=False):
+        """
+        Encode a list of token lists as bag-of-words counts.
+
+        :return: [N, |vocab|] int32 count matrix, or if sparse, a list of (word ids, counts) tuples.
+        """
+        flat, lengths = self.lookup(sentences)
+        rows = np.repeat(np.arange(len(sentences)), lengths)
+        return bag_of_words(rows, flat, len(sentences), len(self), sparse)
+
+
+def pad_ids(flat, lengths, max_len=None):
+    """
+    Pack the flat word ids of a list of sentences (as returned by Encoder.lookup()) into a padded id matrix,
+    as for Encoder.encode().
+    """
+    width = max_len if max_len is not None else max(np.max(lengths) if len(lengths) else 0, 1)
+    clipped = np.minimum(lengths, width)
+
+    # Position of every token within its sentence, so truncated tokens can be dropped
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ids = np.zeros((len(lengths), width), dtype=np.int32)
+    ids[np.arange(width) < clipped[:, None]] = flat[np.arange(len(flat)) - offsets < width]
+    return ids, clipped
+
+
+def bag_of_words(rows, words, n, vocab_size, sparse=False):
+    """
+    Count flat (row, word id) pairs, sorted by row, into bag-of-words rows.
+
+    :param n: Number of rows.
+    :param vocab_size: Width of the dense count matrix.
+    :return: [n, vocab_size] int32 count matrix, or if sparse, a list of n (sorted unique word ids as int64,
+             counts as float32) tuples.
+    """
+    if not sparse:
+        counts = np.zeros((n, vocab_size), dtype=np.int32)
+        np.add.at(counts, (rows, words), 1)
+        return counts
+
+    bags = []
+    for row_words in np.split(words, np.searchsorted(rows, np.arange(1, n))) if n else []:
+        ids, counts = np.unique(row_words.astype(np.int64), return_counts=True)
+        bags.append((ids, counts.astype(np.float32)))
+    return bags
+
+
+def bag_of_words_ids(ids, lengths, vocab_size, sparse=False):
+    """
+    Convert a padded id matrix (as returned by Encoder.encode()) to bag-of-words rows.
+    """
+    rows, cols = np.nonzero(np.arange(ids.shape[1]) < np.asarray(lengths)[:, None])
+    return bag_of_words(rows, np.asarray(ids)[rows, cols], len(ids), vocab_size, sparse)
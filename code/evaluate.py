@@ -0,0 +1,171 @@
+"""
+evaluate.py
+
+K-fold cross-validation and learning curves. The corpus is vectorized once into the on-disk cache, and
+every (training size, fold) pair is trained and scored in a worker process, in its own graph, on
+memory-mapped slices of that cache. Held-out sets are scored in batches, and each run reports per-level
+command accuracy, level-selection accuracy (for the dual models), and training and scoring times. With
+--compact, each training fold is compacted first (see corpus.Dataset.compact()); held-out folds are always
+scored in full.
+
+Usage:
+    python evaluate.py RNNDual --folds 5 --chunk-sizes 100 200 400 800 --out curves/rnn.tsv
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from corpus import load_dataset
+from models import MODELS
+from sessions import session_config
+
+
+def folds(dataset, k, seed=0):
+    """
+    Split each level's examples into k folds.
+
+    :return: List of k (train indices, test indices) tuples, each a dictionary mapping level to an array.
+    """
+    rng, parts = np.random.RandomState(seed), {}
+    for lvl in dataset.levels:
+        parts[lvl] = np.array_split(rng.permutation(len(dataset.labels[lvl])), k)
+    return [({lvl: np.sort(np.concatenate(parts[lvl][:f] + parts[lvl][f + 1:])) for lvl in dataset.levels},
+             {lvl: np.sort(parts[lvl][f]) for lvl in dataset.levels}) for f in range(k)]
+
+
+def score_levels(model, dataset):
+    """
+    Score every example of a dataset in batches.
+
+    :return: Dictionary mapping each level to its command accuracy, and (for the dual models) 'LVL' to the
+             level-selection accuracy over all levels.
+    """
+    scores, level_correct, total = {}, 0, 0
+    for k, lvl in enumerate(dataset.levels):
+        predictions = model.score_batch(dataset.sentences(lvl))
+        scores[lvl] = np.mean([p[0] == t for p, t in zip(predictions, dataset.targets(lvl))])
+        if len(dataset.levels) > 1:
+            level_correct += sum(p[2] == k for p in predictions)
+            total += len(predictions)
+    if total:
+        scores['LVL'] = level_correct / float(total)
+    return scores
+
+
+def run_fold(task):
+    """
+    Train a model on one fold's training examples (up to chunk_size per level) and score it on the
+    held-out fold. Run in a worker process.
+
+    :param task: Tuple of (model name, hyperparameters, chunk size, fold, number of folds, seed, cache
+                 directory, number of TF threads, whether to compact the training fold).
+    :return: Result dictionary.
+    """
+    name, params, chunk_size, fold, k, seed, cache_dir, threads, compact = task
+    model_cls, levels = MODELS[name]
+    dataset = load_dataset(levels, cache_dir=cache_dir)
+    train_idx, test_idx = folds(dataset, k, seed)[fold]
+    train = dataset.subset(train_idx).compact() if compact else dataset.subset(train_idx)
+    model = model_cls.from_dataset(train, session_config=session_config(threads, threads), **params)
+    start = time.time()
+    model.fit(chunk_size, shuffle=True)
+    train_seconds, start = time.time() - start, time.time()
+    scores = score_levels(model, dataset.subset(test_idx))
+    score_seconds = time.time() - start
+    model.session.close()
+
+    result = {'model': name, 'chunk_size': chunk_size, 'fold': fold, 'train_seconds': train_seconds,
+              'score_seconds': score_seconds}
+    result.update(('accuracy_' + lvl, score) for lvl, score in scores.items())
+    return result
+
+
+def evaluate(name, chunk_sizes, k=5, params=None, processes=None, threads=1, seed=0, cache_dir=None,
+             compact=False):
+    """
+    Run k-fold cross-validation for every training size, in parallel.
+
+    :param name: Model to evaluate: 'RNNDual', 'NNDual' or 'RNNClassifier'.
+    :param chunk_sizes: Training sizes (examples per level, as for fit()) of the learning-curve points.
+    :param k: Number of folds.
+    :param params: Hyperparameters passed to from_dataset().
+    :param processes: Number of worker processes. Defaults to the number of CPUs divided by threads.
+    :param threads: Number of intra- and inter-op threads for each worker's session.
+    :param cache_dir: Directory for the vectorized corpus cache, shared by all workers. Defaults to a
+                      temporary directory, removed afterwards.
+    :param compact: If True, train on the compacted training folds (chunk sizes then count distinct rows).
+    :return: List of result dictionaries, one per (chunk size, fold), sorted.
+    """
+    tmp = tempfile.mkdtemp() if cache_dir is None else None
+    cache_dir = cache_dir or tmp
+    load_dataset(MODELS[name][1], cache_dir=cache_dir)
+    processes = processes or max(multiprocessing.cpu_count() // threads, 1)
+    tasks = [(name, params or {}, chunk_size, fold, k, seed, cache_dir, threads, compact)
+             for chunk_size, fold in itertools.product(chunk_sizes, range(k))]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = list(pool.imap_unordered(run_fold, tasks))
+    finally:
+        pool.close()
+        pool.join()
+        if tmp is not None:
+            shutil.rmtree(tmp)
+    return sorted(results, key=lambda r: (r['chunk_size'], r['fold']))
+
+
+def summarize(results):
+    """
+    Average each metric over the folds of every training size.
+
+    :return: List of dictionaries, one per chunk size, holding the mean of every metric.
+    """
+    summary = []
+    for chunk_size, rows in itertools.groupby(results, key=lambda r: r['chunk_size']):
+        rows = list(rows)
+        metrics = sorted(m for m in rows[0] if m.startswith('accuracy_') or m.endswith('_seconds'))
+        summary.append(dict([('chunk_size', chunk_size), ('folds', len(rows))] +
+                            [(m, np.mean([r[m] for r in rows])) for m in metrics]))
+    return summary
+
+
+def write_table(rows, path):
+    """
+    Write a list of result dictionaries to a tab-separated file, one column per key.
+    """
+    columns = sorted(set(c for r in rows for c in r))
+    with open(path, 'w') as f:
+        f.write("\t".join(columns) + "\n")
+        for r in rows:
+            f.write("\t".join(str(r.get(c, '')) for c in columns) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='K-fold learning-curve evaluation.')
+    parser.add_argument('model', choices=sorted(MODELS))
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', required=True)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--params', default='{}', help='JSON dictionary of hyperparameters')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--compact', action='store_true', help='Compact each training fold')
+    parser.add_argument('--out', default=None, help='Path of the per-fold results table')
+    args = parser.parse_args()
+
+    start = time.time()
+    results = evaluate(args.model, args.chunk_sizes, args.folds, json.loads(args.params), args.processes,
+                       args.threads, args.seed, args.cache_dir, args.compact)
+    if args.out is not None:
+        write_table(results, args.out)
+        write_table(summarize(results), os.path.splitext(args.out)[0] + '.summary.tsv')
+    for row in summarize(results):
+        print "\t".join('%s=%.4g' % (m, row[m]) for m in sorted(row))
+    print 'Total time: %.1fs' % (time.time() - start)
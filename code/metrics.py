@@ -0,0 +1,175 @@
+"""
+metrics.py
+
+Runtime metrics for the models' scoring path. A Metrics collector, attached with <Model>.enable_metrics(),
+records the latency and size of every score() / score_batch() call, how long each forward pass spends
+encoding commands and in session.run, which level is selected and how confidently, and how many tokens are
+out of vocabulary (mapped to UNK): the main sign of drift between the training corpora and live traffic.
+Tokens are counted from the ids each forward pass has already encoded, so commands answered from the score
+cache are not encoded or counted again. Models with a hashed vocabulary have no out-of-vocabulary words, and
+do not count tokens.
+
+Every update takes the collector's lock, so one collector can be written by scoring threads while it is
+read by a metrics endpoint. snapshot() and reset() read and clear it, and prometheus() renders it in the
+Prometheus text exposition format (served by server.py at GET /metrics).
+"""
+import bisect
+import threading
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+CONFIDENCE_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+# Histograms recorded by Metrics: (name, bucket upper bounds, help text)
+HISTOGRAMS = [('call_seconds', LATENCY_BUCKETS, 'Latency of score() and score_batch() calls.'),
+              ('call_commands', SIZE_BUCKETS, 'Number of commands per score() or score_batch() call.'),
+              ('encode_seconds', LATENCY_BUCKETS, 'Time each forward pass spends encoding its commands.'),
+              ('run_seconds', LATENCY_BUCKETS, 'Time each forward pass spends in session.run.'),
+              ('command_confidence', CONFIDENCE_BUCKETS, 'Score of each predicted command.'),
+              ('level_confidence', CONFIDENCE_BUCKETS, 'Probability of each selected level (dual models).')]
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        """
+        Counts of observations in buckets with the given sorted upper bounds (plus one bucket for larger
+        values), and their sum. Not locked itself: Metrics guards every update.
+        """
+        self.bounds = list(bounds)
+        self.counts, self.sum = [0] * (len(self.bounds) + 1), 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile, interpolating linearly within its bucket. Quantiles in the last bucket are
+        reported as the largest bound.
+        """
+        rank, seen = q * sum(self.counts), 0
+        for i, count in enumerate(self.counts[:-1]):
+            if count and seen + count >= rank:
+                low = self.bounds[i - 1] if i else 0.0
+                return low + (self.bounds[i] - low) * (rank - seen) / float(count)
+            seen += count
+        return self.bounds[-1] if seen < rank else 0.0
+
+    def snapshot(self):
+        """
+        :return: Dictionary with the bucket bounds and (non-cumulative) counts, the sum and number of
+                 observations, and estimated 50th, 95th and 99th percentiles.
+        """
+        return {'bounds': list(self.bounds), 'counts': list(self.counts), 'sum': self.sum,
+                'count': sum(self.counts), 'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Thread-safe collector of scoring metrics (see the module docstring).
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all metrics.
+        """
+        with self.lock:
+            self.histograms = {name: Histogram(bounds) for name, bounds, _ in HISTOGRAMS}
+            self.levels, self.tokens, self.unknown_tokens = {}, 0, 0
+
+    def record_call(self, seconds, predictions):
+        """
+        Record one score() or score_batch() call.
+
+        :param predictions: The call's predictions: (command, score) tuples, or for the dual models
+                            (command, score, level, level score) tuples.
+        """
+        with self.lock:
+            self.histograms['call_seconds'].observe(seconds)
+            self.histograms['call_commands'].observe(len(predictions))
+            for prediction in predictions:
+                self.histograms['command_confidence'].observe(prediction[1])
+                if len(prediction) == 4:
+                    self.levels[prediction[2]] = self.levels.get(prediction[2], 0) + 1
+                    self.histograms['level_confidence'].observe(prediction[3])
+
+    def record_forward(self, encode_seconds, run_seconds, tokens=0, unknown_tokens=None):
+        """
+        Record the time one forward pass spent encoding its commands, and in session.run, and the tokens of
+        its commands.
+
+        :param tokens: Number of tokens in the commands.
+        :param unknown_tokens: Number of those tokens that are out of vocabulary. If None (e.g. for a hashed
+                               vocabulary), the tokens are not counted.
+        """
+        with self.lock:
+            self.histograms['encode_seconds'].observe(encode_seconds)
+            self.histograms['run_seconds'].observe(run_seconds)
+            if unknown_tokens is not None:
+                self.tokens += tokens
+                self.unknown_tokens += unknown_tokens
+
+    def snapshot(self):
+        """
+        :return: Dictionary with a snapshot of every histogram (under 'histograms'), the number of times
+                 each level was selected ('levels'), and the token and out-of-vocabulary token counts and
+                 rate ('tokens', 'unknown_tokens', 'unknown_rate'). The rate is None until a token is counted.
+        """
+        with self.lock:
+            return {'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+                    'levels': dict(self.levels), 'tokens': self.tokens, 'unknown_tokens': self.unknown_tokens,
+                    'unknown_rate': self.unknown_tokens / float(self.tokens) if self.tokens else None}
+
+    def prometheus(self, prefix='command_model', labels=None):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        :param prefix: Prefix of every metric name.
+        :param labels: Optional dictionary of labels added to every sample (e.g. the model name).
+        """
+        snapshot, labels = self.snapshot(), labels or {}
+        families = []
+        for name, _, description in HISTOGRAMS:
+            h, samples, cumulative = snapshot['histograms'][name], [], 0
+            for bound, count in zip(h['bounds'] + ['+Inf'], h['counts']):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=str(bound)), cumulative))
+            samples += [('_sum', labels, h['sum']), ('_count', labels, h['count'])]
+            families.append(format_metric('%s_%s' % (prefix, name), 'histogram', description, samples))
+        families.append(format_metric(prefix + '_level_selected_total', 'counter', 'Number of times each level '
+                                      'was selected.', [('', dict(labels, level=str(level)), count)
+                                                        for level, count in sorted(snapshot['levels'].items())]))
+        families.append(format_metric(prefix + '_tokens_total', 'counter', 'Tokens in scored commands (not counted '
+                                      'for hashed vocabularies).',
+                                      [('', labels, snapshot['tokens'])]))
+        families.append(format_metric(prefix + '_unknown_tokens_total', 'counter', 'Out-of-vocabulary tokens '
+                                      'in scored commands.', [('', labels, snapshot['unknown_tokens'])]))
+        rate = [('', labels, snapshot['unknown_rate'])] if snapshot['unknown_rate'] is not None else []
+        families.append(format_metric(prefix + '_unknown_token_ratio', 'gauge', 'Fraction of scored tokens '
+                                      'that are out of vocabulary.', rate))
+        return ''.join(families)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+
+
+def format_metric(name, kind, description, samples):
+    """
+    Render one metric family in the Prometheus text exposition format.
+
+    :param kind: Metric type: 'counter', 'gauge' or 'histogram'.
+    :param samples: List of (name suffix, labels dictionary, value) tuples.
+    """
+    lines = ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind)]
+    for suffix, labels, value in samples:
+        value = str(value) if isinstance(value, (int, long)) else repr(float(value))
+        lines.append('%s%s%s %s' % (name, suffix, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
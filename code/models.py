@@ -0,0 +1,13 @@
+"""
+models.py
+
+Registry of the model classes, by name, with the corpus levels each is trained on. Used by the command-line
+tools (sweep, evaluate, benchmark, server) to pick a model.
+"""
+from corpus import DUAL_LEVELS, SINGLE_LEVELS
+from dual_nn import NNDual
+from dual_rnn import RNNDual
+from single_rnn import RNNClassifier
+
+MODELS = {'RNNDual': (RNNDual, DUAL_LEVELS), 'NNDual': (NNDual, DUAL_LEVELS),
+          'RNNClassifier': (RNNClassifier, SINGLE_LEVELS)}
@@ -0,0 +1,80 @@
+"""
+pipeline.py
+
+Background input pipeline for training. A producer thread owns the epoch shuffle and batching, and
+keeps a bounded buffer of feed-ready batches, so session.run never waits on Python batch construction.
+"""
+import Queue
+import sys
+import threading
+
+import numpy as np
+
+STEP, EPOCH_END, ERROR = 0, 1, 2
+
+
+class BatchPipeline(object):
+    def __init__(self, make_epoch, epochs, capacity=8, shuffle=False, seed=None):
+        """
+        Starts a producer thread that prepares batches for all epochs ahead of the training loop.
+
+        :param make_epoch: Function taking a numpy RandomState (or None, if not shuffling), and returning
+                           an iterable over the feed-ready batches of one epoch.
+        :param epochs: Number of epochs to produce.
+        :param capacity: Maximum number of prepared batches held in the buffer.
+        :param shuffle: Whether to shuffle the examples each epoch.
+        :param seed: Seed for the shuffle.
+        """
+        self.make_epoch, self.epochs = make_epoch, epochs
+        self.rng = np.random.RandomState(seed) if shuffle else None
+        self.queue, self.stopped = Queue.Queue(maxsize=capacity), threading.Event()
+        self.thread = threading.Thread(target=self.produce, name='BatchPipeline')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        """
+        Producer loop, run on the background thread.
+        """
+        try:
+            for _ in range(self.epochs):
+                for batch in self.make_epoch(self.rng):
+                    if not self.put((STEP, batch)):
+                        return
+                if not self.put((EPOCH_END, None)):
+                    return
+        except Exception:
+            self.put((ERROR, sys.exc_info()))
+
+    def put(self, item):
+        """
+        Block until there is room in the buffer, or the pipeline is closed.
+
+        :return: False if the pipeline was closed before the item could be added.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def epoch(self):
+        """
+        Generate the prepared batches of the next epoch, re-raising any error from the producer.
+        """
+        while True:
+            kind, value = self.queue.get()
+            if kind == EPOCH_END:
+                return
+            elif kind == ERROR:
+                raise value[0], value[1], value[2]
+            yield value
+
+    def close(self):
+        """
+        Stop the producer thread, discarding any batches that have not been consumed.
+        """
+        self.stopped.set()
+        self.thread.join()
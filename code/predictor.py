@@ -0,0 +1,211 @@
+"""
+predictor.py
+
+TensorFlow-free inference for trained RNNDual, NNDual, and RNNClassifier models. Weights are dumped
+by each model's export_numpy() method into a single .npz file, and scored here with plain NumPy.
+"""
+import numpy as np
+
+from encoder import Encoder
+
+# TensorFlow encoder variables (relative to the RNN scope) of every cells.py backend, and their names in the
+# exported file. Backends computing the same function export the same weights.
+RNN_WEIGHTS = {"GRUCell/Gates/Linear/Matrix": "GRU_Gates_W", "GRUCell/Gates/Linear/Bias": "GRU_Gates_B",
+               "GRUCell/Candidate/Linear/Matrix": "GRU_Candidate_W",
+               "GRUCell/Candidate/Linear/Bias": "GRU_Candidate_B",
+               "GRUBlockCell/w_ru": "GRU_Gates_W", "GRUBlockCell/b_ru": "GRU_Gates_B",
+               "GRUBlockCell/w_c": "GRU_Candidate_W", "GRUBlockCell/b_c": "GRU_Candidate_B",
+               "LSTMCell/W_0": "LSTM_W", "LSTMCell/B": "LSTM_B"}
+# Constants of the TensorFlow block LSTM kernels
+LSTM_FORGET_BIAS, LSTM_CELL_CLIP = 1.0, 3.0
+META = {'model', 'max_len', 'id2word', 'vocab_size', 'hash_vocab', 'commands', 'l0_commands', 'l1_commands',
+        'l2_commands'}
+
+
+def collect_weights(session, variables):
+    """
+    Fetch the values of the given (trainable) variables, keyed by their export name.
+
+    :param session: Session holding the trained variable values.
+    :param variables: List of TensorFlow variables to export.
+    :return: Dictionary mapping export name to NumPy array.
+    """
+    weights = {}
+    for var, value in zip(variables, session.run(variables)):
+        name = var.op.name
+        if name.startswith("RNN/"):
+            name = RNN_WEIGHTS[name[len("RNN/"):]]
+        weights[name] = value
+    return weights
+
+
+def fold_embedding(weights):
+    """
+    Product of the NNDual embedding and first hidden layer weights: one row of first-layer
+    pre-activations per word.
+    """
+    return np.dot(weights['Embedding'], weights['Hidden_W1'])
+
+
+def softmax(logits):
+    """
+    Numerically stable row-wise softmax.
+    """
+    e = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+class Predictor(object):
+    def __init__(self, path):
+        """
+        Loads an exported model for scoring.
+
+        :param path: Path to the .npz file written by <Model>.export_numpy().
+        """
+        data = np.load(path)
+        self.configure(data)
+        self.weights = {k: data[k] for k in data.files if k not in META}
+
+        # Fold the NNDual embedding into the shared ReLU layer, so encoding is a sum of per-word rows
+        if self.model == 'NNDual':
+            self.weights['Word_H1'] = fold_embedding(self.weights)
+
+    def configure(self, meta):
+        """
+        Set up the vocabulary and label maps from the exported metadata (an .npz file or a dictionary).
+        """
+        self.model, self.max_len = str(meta['model']), int(meta['max_len'])
+        size = int(meta['vocab_size']) if 'vocab_size' in meta else None
+        self.encoder = Encoder([str(w) for w in meta['id2word']], size, size is not None and bool(meta['hash_vocab']))
+        self.word2id, self.id2word = self.encoder.word2id, self.encoder.id2word
+
+        if self.model == 'RNNClassifier':
+            self.commands = [str(c).split() for c in meta['commands']]
+        else:
+            self.level_commands = [[str(c).split() for c in meta['%s_commands' % lvl]]
+                                   for lvl in ['l0', 'l1', 'l2']]
+
+    def matmul(self, x, name):
+        """
+        Multiply a batch of activations by the named weight matrix.
+        """
+        return np.dot(x, self.weights[name])
+
+    def lookup(self, name, ids):
+        """
+        Gather rows of the named weight matrix (e.g. word embeddings).
+        """
+        return self.weights[name][ids]
+
+    def encode(self, nl_commands):
+        """
+        Encode a list of token lists as the model's input: a padded id matrix plus lengths for the
+        recurrent models, or flat (row, word id) arrays with one entry per token for NNDual.
+        """
+        if self.model == 'NNDual':
+            ids, lengths = self.encoder.lookup(nl_commands)
+            return np.repeat(np.arange(len(nl_commands)), lengths), ids
+        return self.encoder.encode(nl_commands, self.max_len)
+
+    def rnn(self, seqs, seq_lens):
+        """
+        Run the exported model's encoder over a padded batch, returning the encoding the heads read.
+        """
+        return self.lstm(seqs, seq_lens) if 'LSTM_W' in self.weights else self.gru(seqs, seq_lens)
+
+    def gru(self, seqs, seq_lens):
+        """
+        Run the GRU encoder over a padded batch, returning the state after each sequence's last token.
+        """
+        w = self.weights
+        inputs, n_units = self.lookup('Embedding', seqs), w['GRU_Candidate_B'].shape[0]
+        state = np.zeros((len(seqs), n_units), dtype=np.float32)
+        for t in range(seqs.shape[1] if len(seqs) else 0):
+            x = inputs[:, t]
+            gates = sigmoid(self.matmul(np.concatenate([x, state], 1), 'GRU_Gates_W') + w['GRU_Gates_B'])
+            r, u = gates[:, :n_units], gates[:, n_units:]
+            c = np.tanh(self.matmul(np.concatenate([x, r * state], 1), 'GRU_Candidate_W') + w['GRU_Candidate_B'])
+            new_state = u * state + (1 - u) * c
+            state = np.where((t < seq_lens)[:, None], new_state, state)
+        return state
+
+    def lstm(self, seqs, seq_lens):
+        """
+        Run the LSTM encoder over a padded batch, returning the output after each sequence's last token.
+        """
+        w = self.weights
+        inputs, n_units = self.lookup('Embedding', seqs), w['LSTM_B'].shape[0] // 4
+        cs = h = np.zeros((len(seqs), n_units), dtype=np.float32)
+        for t in range(seqs.shape[1] if len(seqs) else 0):
+            gates = self.matmul(np.concatenate([inputs[:, t], h], 1), 'LSTM_W') + w['LSTM_B']
+            i, ci, f, o = [gates[:, k * n_units:(k + 1) * n_units] for k in range(4)]
+            new_cs = np.clip(sigmoid(i) * np.tanh(ci) + sigmoid(f + LSTM_FORGET_BIAS) * cs, -LSTM_CELL_CLIP,
+                             LSTM_CELL_CLIP)
+            new_h = sigmoid(o) * np.tanh(new_cs)
+            active = (t < seq_lens)[:, None]
+            cs, h = np.where(active, new_cs, cs), np.where(active, new_h, h)
+        return h
+
+    def probs(self, nl_commands):
+        """
+        Compute the output distributions for a batch of commands.
+
+        :return: Array of command probabilities for RNNClassifier, else a tuple of the level-selection
+                 probabilities and the list of the three per-level head probabilities.
+        """
+        w = self.weights
+        if self.model == 'RNNClassifier':
+            h1 = relu(self.matmul(self.rnn(*self.encode(nl_commands)), 'H1_W') + w['H1_B'])
+            hidden = relu(self.matmul(h1, 'H2_W') + w['H2_B'])
+            return softmax(self.matmul(hidden, 'Output_W') + w['Output_B'])
+
+        if self.model == 'NNDual':
+            rows, ids = self.encode(nl_commands)
+            h1 = np.zeros((len(nl_commands), w['Word_H1'].shape[1]), dtype=np.float32)
+            np.add.at(h1, rows, self.lookup('Word_H1', ids))
+            h1 = relu(h1 + w['Hidden_B1'])
+        else:
+            h1 = relu(self.matmul(self.rnn(*self.encode(nl_commands)), 'Hidden_W1') + w['Hidden_B1'])
+
+        heads = []
+        for i in ['L0', 'L1', 'L2']:
+            hidden = relu(self.matmul(h1, 'Hidden_W_%s' % i) + w['Hidden_B_%s' % i])
+            heads.append(softmax(self.matmul(hidden, 'Output_W_%s' % i) + w['Output_B_%s' % i]))
+        hidden = relu(self.matmul(h1, 'Hidden_W_LVL') + w['Hidden_B_LVL'])
+        lvl = softmax(self.matmul(hidden, 'Output_W_LVL') + w['Output_B_LVL'])
+        return lvl, heads
+
+    def score(self, nl_command):
+        """
+        Given a natural language command, return predicted output and score.
+
+        :return: Same tuple as the exported model's score().
+        """
+        return self.score_batch([nl_command])[0]
+
+    def score_batch(self, nl_commands):
+        """
+        Given a list of natural language commands, return the predicted output and score for each.
+
+        :return: List of the same tuples as the exported model's score_batch().
+        """
+        if len(nl_commands) == 0:
+            return []
+
+        if self.model == 'RNNClassifier':
+            y = self.probs(nl_commands)
+            return [(self.commands[c], y[j][c]) for j, c in enumerate(np.argmax(y, axis=1))]
+
+        lvl, head_probs = self.probs(nl_commands)
+        pred_levels = np.argmax(lvl, axis=1)
+        pred_commands = np.array([np.argmax(p, axis=1) for p in head_probs])[pred_levels, np.arange(len(lvl))]
+        return [(self.level_commands[k][c], head_probs[k][j][c], k, lvl[j][k])
+                for j, (k, c) in enumerate(zip(pred_levels, pred_commands))]
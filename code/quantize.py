@@ -0,0 +1,193 @@
+"""
+quantize.py
+
+Compact serving format for exported models. A model's .npz export (see <Model>.export_numpy()) is
+rewritten as one flat binary file: a small JSON header (vocabulary, label maps, and the dtype, shape,
+offset and scale of every tensor), followed by the tensors themselves, each aligned to a 64-byte boundary.
+Weight matrices are optionally stored as float16, or as int8 with one scale per matrix; biases are kept as
+float32. The NNDual embedding is stored pre-multiplied into its first hidden layer.
+
+QuantizedPredictor maps the file read-only and scores straight from the mapped buffers, so every worker
+process on a machine shares a single copy of the weights through the page cache.
+
+Usage:
+    python quantize.py export checkpoints/rnn.npz checkpoints/rnn.int8.bin --dtype int8
+    python quantize.py report checkpoints/rnn.npz
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from corpus import DUAL_LEVELS, SINGLE_LEVELS, load_dataset
+from predictor import META, Predictor, fold_embedding
+
+MAGIC, VERSION, ALIGN = 'CMDQ', 1, 64
+PREAMBLE = struct.Struct('<4sII')
+DTYPES = {'float32': '<f4', 'float16': '<f2', 'int8': 'i1'}
+
+
+def align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def quantize(array, dtype):
+    """
+    Convert a weight matrix to the storage dtype. Vectors (biases) are always kept as float32.
+
+    :return: Tuple of the stored array and its scale (the stored values times the scale approximate the
+             original weights).
+    """
+    array = np.asarray(array, dtype=np.float32)
+    if array.ndim < 2 or dtype == 'float32':
+        return array, 1.0
+    if dtype == 'float16':
+        return array.astype(np.float16), 1.0
+    scale = float(np.max(np.abs(array))) / 127 or 1.0
+    return np.clip(np.round(array / scale), -127, 127).astype(np.int8), scale
+
+
+def write(path, meta, weights, dtype='int8'):
+    """
+    Write metadata and weights to a quantized model file.
+
+    :param meta: Dictionary of JSON-serializable metadata (model name, max_len, vocabulary, label maps).
+    :param weights: Dictionary mapping tensor name to float32 array.
+    :param dtype: Storage dtype of the weight matrices: 'float32', 'float16' or 'int8'.
+    """
+    if dtype not in DTYPES:
+        raise ValueError("Unknown dtype %r, expected one of %s" % (dtype, sorted(DTYPES)))
+    stored, tensors = {}, {}
+    for name in sorted(weights):
+        stored[name], scale = quantize(weights[name], dtype)
+        tensors[name] = {'dtype': stored[name].dtype.name, 'shape': list(stored[name].shape), 'scale': scale}
+
+    # Tensor offsets are relative to the (aligned) end of the header
+    offset = 0
+    for name in sorted(stored):
+        tensors[name]['offset'] = offset
+        offset = align(offset + stored[name].nbytes)
+    header = json.dumps(dict(meta, dtype=dtype, tensors=tensors))
+    start = align(PREAMBLE.size + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for name in sorted(stored):
+            f.write('\0' * (start + tensors[name]['offset'] - f.tell()))
+            f.write(stored[name].astype(DTYPES[tensors[name]['dtype']]).tobytes())
+
+
+def export(npz_path, path, dtype='int8'):
+    """
+    Convert an .npz file written by <Model>.export_numpy() to a quantized model file.
+    """
+    data = np.load(npz_path)
+    meta = {k: data[k].tolist() for k in data.files if k in META}
+    weights = {k: data[k] for k in data.files if k not in META}
+    if meta['model'] == 'NNDual':
+        weights['Word_H1'] = fold_embedding(weights)
+        del weights['Embedding'], weights['Hidden_W1']
+    write(path, meta, weights, dtype)
+
+
+class QuantizedPredictor(Predictor):
+    def __init__(self, path):
+        """
+        Maps a quantized model file for scoring. The weights are read-only views of the mapping, and are
+        dequantized on the fly, one matrix (or for lookups, one set of rows) at a time.
+
+        :param path: Path to a file written by export().
+        """
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_len = PREAMBLE.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d quantized model file" % (path, VERSION))
+        header = json.loads(self.buffer[PREAMBLE.size:PREAMBLE.size + header_len])
+        start = align(PREAMBLE.size + header_len)
+
+        self.configure(header)
+        self.dtype, self.weights, self.scales = header['dtype'], {}, {}
+        for name, tensor in header['tensors'].items():
+            name, shape = str(name), tuple(tensor['shape'])
+            self.weights[name] = np.frombuffer(self.buffer, DTYPES[tensor['dtype']], int(np.prod(shape)),
+                                               start + tensor['offset']).reshape(shape)
+            self.scales[name] = np.float32(tensor['scale'])
+
+    def dequantize(self, values, name):
+        if values.dtype == np.float32:
+            return values
+        return values.astype(np.float32) * self.scales[name]
+
+    def matmul(self, x, name):
+        return np.dot(x, self.dequantize(self.weights[name], name))
+
+    def lookup(self, name, ids):
+        return self.dequantize(self.weights[name][ids], name)
+
+    def close(self):
+        self.weights = {}
+        self.buffer.close()
+
+
+def report(npz_path, dtypes=('float32', 'float16', 'int8'), cache_dir=None):
+    """
+    Compare quantized versions of an exported model with the float32 .npz on the bundled corpora.
+
+    :return: List of result dictionaries, one per dtype, with the file size, command accuracy, agreement
+             with the float32 predictions, and the largest difference in the predicted command's score.
+    """
+    reference = Predictor(npz_path)
+    dataset = load_dataset(SINGLE_LEVELS if reference.model == 'RNNClassifier' else DUAL_LEVELS,
+                           cache_dir=cache_dir)
+    sentences = [s for lvl in dataset.levels for s in dataset.sentences(lvl)]
+    targets = [t for lvl in dataset.levels for t in dataset.targets(lvl)]
+    expected = reference.score_batch(sentences)
+
+    results = [{'dtype': 'npz', 'bytes': os.path.getsize(npz_path), 'agreement': 1.0, 'max_score_diff': 0.0,
+                'accuracy': np.mean([p[0] == t for p, t in zip(expected, targets)])}]
+    out_dir = tempfile.mkdtemp()
+    try:
+        for dtype in dtypes:
+            path = os.path.join(out_dir, 'model.%s.bin' % dtype)
+            export(npz_path, path, dtype)
+            predictor = QuantizedPredictor(path)
+            predictions = predictor.score_batch(sentences)
+            predictor.close()
+            results.append({'dtype': dtype, 'bytes': os.path.getsize(path),
+                            'accuracy': np.mean([p[0] == t for p, t in zip(predictions, targets)]),
+                            'agreement': np.mean([p[0] == e[0] for p, e in zip(predictions, expected)]),
+                            'max_score_diff': max(abs(p[1] - e[1]) for p, e in zip(predictions, expected))})
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Quantized, memory-mapped model files.')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='Convert an exported .npz model')
+    export_parser.add_argument('npz', help='File written by <Model>.export_numpy()')
+    export_parser.add_argument('out', help='Quantized model file to write')
+    export_parser.add_argument('--dtype', choices=sorted(DTYPES), default='int8')
+    report_parser = commands.add_parser('report', help='Compare quantized and float32 accuracy')
+    report_parser.add_argument('npz', help='File written by <Model>.export_numpy()')
+    report_parser.add_argument('--dtypes', nargs='+', choices=sorted(DTYPES),
+                               default=['float32', 'float16', 'int8'])
+    report_parser.add_argument('--cache-dir', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args.npz, args.out, args.dtype)
+        print 'Wrote %s (%d bytes)' % (args.out, os.path.getsize(args.out))
+    else:
+        print '%-8s %10s %9s %10s %15s' % ('dtype', 'bytes', 'accuracy', 'agreement', 'max_score_diff')
+        for r in report(args.npz, args.dtypes, args.cache_dir):
+            print '%-8s %10d %9.4f %10.4f %15.6f' % (r['dtype'], r['bytes'], r['accuracy'], r['agreement'],
+                                                      r['max_score_diff'])
@@ -0,0 +1,341 @@
+"""
+server.py
+
+Local inference server. Loads a saved model once, and serves it over HTTP on a TCP port or a Unix socket.
+Concurrent requests are coalesced into micro-batches (up to a maximum batch size, waiting at most a
+maximum delay for a batch to fill), each scored with a single batched forward pass on one thread. The
+request queue is bounded: when it is full, requests are rejected with 503 rather than queueing without
+limit.
+
+Endpoints:
+    POST /score   {"command": "go to the red room"} or {"commands": [...]}, with commands given as strings
+                  or token lists. Returns {"prediction": {...}} or {"predictions": [...]}, with the command
+                  tokens, score, and for the dual models the level and level probability.
+    GET  /health  Model name, queue depth and batching counters.
+    GET  /metrics Scoring latency, batch size, level-selection, confidence and out-of-vocabulary metrics
+                  (see metrics.py), and the batching counters, in the Prometheus text format.
+
+Usage:
+    python server.py serve RNNDual checkpoints/rnn --port 8000
+    python server.py client http://localhost:8000 "go to the red room"
+"""
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+from metrics import format_metric
+
+FIELDS = {2: ['command', 'score'], 4: ['command', 'score', 'level', 'level_prob']}
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Request(object):
+    def __init__(self, tokens):
+        """
+        A command waiting to be scored, and (once done) its prediction or error. A cancelled request (whose
+        caller has given up on it) is dropped without being scored.
+        """
+        self.tokens, self.done, self.cancelled = tokens, threading.Event(), False
+        self.prediction, self.error = None, None
+
+
+class MicroBatcher(object):
+    def __init__(self, score_batch, max_batch=32, max_delay=0.005, max_queue=256):
+        """
+        Starts a worker thread that scores queued commands in batches.
+
+        :param score_batch: Function from a list of token lists to a list of predictions (e.g. a model's
+                            score_batch). Only ever called from the worker thread.
+        :param max_batch: Maximum number of commands per batch.
+        :param max_delay: Maximum seconds to wait, after the first command of a batch arrives, for the
+                          batch to fill.
+        :param max_queue: Maximum number of commands waiting to be scored.
+        """
+        self.score_batch, self.max_batch, self.max_delay = score_batch, max_batch, max_delay
+        self.queue, self.max_queue, self.stopped = Queue.Queue(), max_queue, threading.Event()
+        self.batches, self.scored, self.rejected, self.lock = 0, 0, 0, threading.Lock()
+        self.thread = threading.Thread(target=self.work, name='MicroBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, commands):
+        """
+        Queue a list of commands for scoring, all together or (if they do not all fit) not at all.
+
+        :return: List of Requests, whose done events are set once they have been scored.
+        :raises Overloaded: If the queue does not have room for every command.
+        """
+        requests = [Request(tokens) for tokens in commands]
+        with self.lock:
+            if self.queue.qsize() + len(requests) > self.max_queue:
+                self.rejected += len(requests)
+                raise Overloaded("Scoring queue is full (%d commands)" % self.max_queue)
+            for request in requests:
+                self.queue.put_nowait(request)
+        return requests
+
+    def score(self, commands, timeout=None):
+        """
+        Score a list of commands, queueing them individually so they can share batches with other callers.
+
+        :param timeout: Seconds to wait for all the predictions, after which the remaining commands are
+                        cancelled.
+        :raises Overloaded: If the queue is full, or the predictions are not ready before the timeout.
+        """
+        requests = self.submit(commands)
+        deadline = time.time() + timeout if timeout is not None else None
+        for request in requests:
+            if not request.done.wait(max(deadline - time.time(), 0) if deadline is not None else None):
+                for waiting in requests:
+                    waiting.cancelled = True
+                raise Overloaded("Timed out waiting for a prediction")
+            if request.error is not None:
+                raise request.error
+        return [request.prediction for request in requests]
+
+    def stats(self):
+        """
+        :return: Dictionary with the queue depth, and the batch, scored and rejected command counts.
+        """
+        with self.lock:
+            return {'queue': self.queue.qsize(), 'batches': self.batches, 'scored': self.scored,
+                    'rejected': self.rejected}
+
+    def work(self):
+        """
+        Worker loop: take the first waiting command, gather more until the batch is full or the delay has
+        passed, and score them all in one call.
+        """
+        while not self.stopped.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except Queue.Empty:
+                continue
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except Queue.Empty:
+                    break
+            batch = [request for request in batch if not request.cancelled]
+            if not batch:
+                continue
+
+            try:
+                predictions = self.score_batch([request.tokens for request in batch])
+                for request, prediction in zip(batch, predictions):
+                    request.prediction = prediction
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            with self.lock:
+                self.batches, self.scored = self.batches + 1, self.scored + len(batch)
+            for request in batch:
+                request.done.set()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def to_json(prediction):
+    """
+    Convert a prediction tuple to a JSON-serializable dictionary.
+    """
+    fields = dict(zip(FIELDS[len(prediction)], prediction))
+    result = {'command': list(fields.pop('command'))}
+    result.update((field, int(value) if field == 'level' else float(value)) for field, value in fields.items())
+    return result
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            return self.send(200, self.metrics(), 'text/plain; version=0.0.4')
+        if self.path != '/health':
+            return self.reply(404, {'error': 'Not found'})
+        health = {'status': 'ok', 'model': self.server.model_name}
+        health.update(self.server.batcher.stats())
+        self.reply(200, health)
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self.reply(404, {'error': 'Not found'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            single = 'command' in body
+            commands = [body['command']] if single else body['commands']
+            commands = [c.split() if isinstance(c, basestring) else [str(w) for w in c] for c in commands]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.reply(400, {'error': 'Expected a JSON object with "command" or "commands"'})
+
+        try:
+            predictions = [to_json(p) for p in self.server.batcher.score(commands, self.server.timeout)]
+        except Overloaded as e:
+            return self.reply(503, {'error': str(e)})
+        except Exception as e:
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, {'prediction': predictions[0]} if single else {'predictions': predictions})
+
+    def metrics(self):
+        """
+        Render the model's metrics and the batching counters in the Prometheus text format.
+        """
+        stats, labels = self.server.batcher.stats(), {'model': self.server.model_name}
+        text = self.server.metrics.prometheus('command_model', labels)
+        text += format_metric('command_server_queue_depth', 'gauge', 'Commands waiting to be scored.',
+                              [('', labels, stats['queue'])])
+        for name, description in [('batches', 'Micro-batches scored.'), ('scored', 'Commands scored.'),
+                                  ('rejected', 'Commands rejected with a full queue.')]:
+            text += format_metric('command_server_%s_total' % name, 'counter', description,
+                                  [('', labels, stats[name])])
+        return text
+
+    def reply(self, code, body):
+        self.send(code, json.dumps(body), 'application/json')
+
+    def send(self, code, data, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads, request_queue_size = True, 128
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads, request_queue_size = True, 128
+
+
+def make_server(model, model_name, port=8000, host='127.0.0.1', unix_socket=None, max_batch=32,
+                max_delay=0.005, max_queue=256, timeout=30.0, verbose=False):
+    """
+    Create a server for a loaded model. Call serve_forever() to run it, and shutdown() (from another thread)
+    then server.batcher.close() to stop it.
+
+    :param unix_socket: If given, listen on this Unix socket path instead of a TCP port.
+    :param timeout: Seconds a request waits for its prediction before failing with 503.
+    """
+    if unix_socket is not None:
+        server = ThreadingUnixHTTPServer(unix_socket, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+    server.metrics = model.metrics if model.metrics is not None else model.enable_metrics()
+    server.batcher = MicroBatcher(model.score_batch, max_batch, max_delay, max_queue)
+    server.model_name, server.timeout, server.verbose = model_name, timeout, verbose
+    return server
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class Client(object):
+    def __init__(self, address, timeout=30.0):
+        """
+        Minimal client for the server.
+
+        :param address: Server URL (e.g. http://localhost:8000), or the path of its Unix socket.
+        """
+        self.address, self.timeout = address, timeout
+
+    def connection(self):
+        if self.address.startswith('http://'):
+            url = urlparse.urlparse(self.address)
+            return httplib.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+        return UnixHTTPConnection(self.address, self.timeout)
+
+    def request(self, method, path, body=None):
+        """
+        :return: Tuple of (HTTP status, decoded JSON response).
+        """
+        conn = self.connection()
+        try:
+            conn.request(method, path, json.dumps(body) if body is not None else None,
+                         {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def score(self, command):
+        """
+        Score one command (a string or list of tokens), returning the prediction dictionary.
+        """
+        status, body = self.request('POST', '/score', {'command': command})
+        if status != 200:
+            raise RuntimeError("Server returned %d: %s" % (status, body.get('error')))
+        return body['prediction']
+
+    def health(self):
+        return self.request('GET', '/health')[1]
+
+
+if __name__ == "__main__":
+    # Imported here so the batcher and client can be used without loading TensorFlow
+    from models import MODELS
+
+    parser = argparse.ArgumentParser(description='Micro-batching inference server.')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='Load a saved model and serve it')
+    serve_parser.add_argument('model', choices=sorted(MODELS))
+    serve_parser.add_argument('path', help='Checkpoint path the model was saved to')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--unix-socket', default=None)
+    serve_parser.add_argument('--max-batch', type=int, default=32)
+    serve_parser.add_argument('--max-delay', type=float, default=0.005, help='Seconds')
+    serve_parser.add_argument('--max-queue', type=int, default=256)
+    serve_parser.add_argument('--verbose', action='store_true')
+    client_parser = commands.add_parser('client', help='Score commands against a running server')
+    client_parser.add_argument('address', help='Server URL, or Unix socket path')
+    client_parser.add_argument('nl_commands', nargs='*', help='Commands to score (default: /health)')
+    args = parser.parse_args()
+
+    if args.command == 'client':
+        client = Client(args.address)
+        if not args.nl_commands:
+            print json.dumps(client.health())
+        for nl_command in args.nl_commands:
+            print json.dumps(client.score(nl_command))
+        sys.exit(0)
+
+    server = make_server(MODELS[args.model][0].load(args.path), args.model, args.port, args.host,
+                         args.unix_socket, args.max_batch, args.max_delay, args.max_queue, verbose=args.verbose)
+    print 'Serving %s on %s' % (args.model, args.unix_socket or '%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
@@ -0,0 +1,50 @@
+"""
+sessions.py
+
+Session configuration for the models. Every model owns its own tf.Graph and tf.Session, so several can be
+hosted in one process; these options pin each session's CPU budget. Also moves variable values into a
+rebuilt graph, e.g. when a model grows its vocabulary.
+"""
+import tensorflow as tf
+
+
+def session_config(intra_op_threads=0, inter_op_threads=0, shared_pool=False, jit=False):
+    """
+    Build a tf.ConfigProto for a model's session.
+
+    :param intra_op_threads: Threads used to parallelize a single op (e.g. a matmul). 0 lets TF choose
+                             (one per core).
+    :param inter_op_threads: Threads used to run independent ops concurrently. 0 lets TF choose.
+    :param shared_pool: If True, run ops on the process-wide inter-op pool shared by every session that
+                        sets this, rather than on a pool owned by this session. The shared pool is sized
+                        by the first session to create it.
+    :param jit: If True, turn on XLA JIT compilation of the graph. Raises ValueError if this TensorFlow
+                build does not support it.
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads,
+                            use_per_session_threads=not shared_pool)
+    if jit:
+        optimizer_options = config.graph_options.optimizer_options
+        if not hasattr(optimizer_options, 'global_jit_level'):
+            raise ValueError("TensorFlow %s does not support XLA JIT compilation" % tf.__version__)
+        optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def load_variables(session, variables, values):
+    """
+    Assign saved values to variables. A value with fewer rows than its variable (e.g. an embedding, after
+    growing the vocabulary) fills the leading rows, and the remaining rows keep their initial values.
+    Variables without a saved value are left as initialized.
+
+    :param values: Dictionary mapping variable (op) name to NumPy array.
+    """
+    for var in variables:
+        value = values.get(var.op.name)
+        if value is None:
+            continue
+        if value.shape != tuple(var.get_shape().as_list()):
+            value, rows = session.run(var), value
+            value[:len(rows)] = rows
+        session.run(var.initializer, feed_dict={var.initializer.inputs[1]: value})
@@ -3,16 +3,26 @@ single_rnn.py
 
 Single model with an recurrent neural network encoder.
 """
+import os
+import time
+
 import numpy as np
 import tensorflow as tf
 
-PAD, PAD_ID = "<<PAD>>", 0
-UNK, UNK_ID = "<<UNK>>", 1
+from base import Model, saved_examples
+from batching import bucket_batches, pad_batch, replay_samples, replay_size
+from callbacks import CallbackList
+from cells import check_cell, checkpoint_names, encode, output, state_size, step
+from encoder import Encoder, PAD_ID, pad_ids
+from pipeline import BatchPipeline
+from predictor import collect_weights
+from streaming import Stream
 
 
-class RNNClassifier():
+class RNNClassifier(Model):
     def __init__(self, parallel_corpus, commands, embedding_size=30, rnn_size=50, h1_size=60,
-                 h2_size=50, epochs=10, batch_size=16):
+                 h2_size=50, epochs=10, batch_size=16, buckets=None, seed=None, vocab_size=None, hash_vocab=False,
+                 cell='gru', spare_words=0, session_config=None):
         """
         Instantiates and Trains Model using the given parallel corpus.
 
@@ -20,69 +30,121 @@ class RNNClassifier():
                     1) List of source sentence tokens
                     2) List of target sentence tokens
         :param commands: List of Lists, where each element is one of the possible commands (labels)
+        :param buckets: Optional sorted list of sentence length boundaries. If given, training and scoring
+                        batches are drawn from a single length bucket, and padded only to their own
+                        longest sentence.
+        :param seed: Optional graph-level random seed, for reproducible initialization and dropout.
+        :param vocab_size: If given, fix the number of word ids (and so the embedding size): keep only the
+                           vocab_size - 2 most frequent words, mapping the rest to UNK.
+        :param hash_vocab: If True (with a vocab_size), hash every word into vocab_size - 2 buckets instead,
+                           so no word is out of vocabulary and ids are stable across corpora and retrains.
+        :param cell: Encoder backend: 'gru', 'gru_block', 'lstm_block' or 'lstm_fused' (see cells.py).
+        :param spare_words: Number of embedding rows to reserve past the end of the vocabulary (unless it has a
+                            vocab_size), so that partial_fit() can add new words without rebuilding the graph.
+                            By default none are reserved, and new words grow the embedding instead.
+        :param session_config: Optional tf.ConfigProto for the model's session (see sessions.session_config).
         """
-        self.commands, self.labels = commands, {" ".join(x): i for (i, x) in enumerate(commands)}
-        self.pc, self.epochs, self.bsz = parallel_corpus, epochs, batch_size
-        self.embedding_sz, self.rnn_sz, self.h1_sz, self.h2_sz = embedding_size, rnn_size, h1_size, h2_size
-        self.init = tf.truncated_normal_initializer(stddev=0.5)
-        self.session = tf.Session()
+        self.pc = parallel_corpus
+        self.configure(commands, embedding_size, rnn_size, h1_size, h2_size, epochs, batch_size, buckets, seed,
+                       vocab_size, hash_vocab, cell, spare_words)
 
         # Build Vocabulary
-        self.word2id, self.id2word = self.build_vocabulary()
+        self.set_encoder(self.build_vocabulary())
 
         # Vectorize Parallel Corpus
         self.lengths = [len(n) for n, _ in self.pc]
+        self.max_len = max(self.lengths)
         self.train_x, self.train_y = self.vectorize()
+        self.train_w = np.ones(len(self.train_y), dtype=np.float32)
+
+        # Build Graph, and Initialize all variables
+        self.build_graph(session_config=session_config)
+
+    def configure(self, commands, embedding_size=30, rnn_size=50, h1_size=60, h2_size=50, epochs=10,
+                  batch_size=16, buckets=None, seed=None, vocab_size=None, hash_vocab=False, cell='gru',
+                  spare_words=0):
+        """
+        Set up the label map and hyperparameters, shared by the constructor, from_dataset() and load().
+        """
+        self.commands, self.labels = commands, {" ".join(x): i for (i, x) in enumerate(commands)}
+        self.epochs, self.bsz, self.buckets, self.seed = epochs, batch_size, buckets, seed
+        self.embedding_sz, self.rnn_sz, self.h1_sz, self.h2_sz = embedding_size, rnn_size, h1_size, h2_size
+        check_cell(cell)
+        self.vocab_size, self.hash_vocab, self.cell, self.spare_words = vocab_size, hash_vocab, cell, spare_words
+        self.state_sz = state_size(cell, rnn_size)
+        self.hparams = {'embedding_size': embedding_size, 'rnn_size': rnn_size, 'h1_size': h1_size,
+                        'h2_size': h2_size, 'epochs': epochs, 'batch_size': batch_size, 'buckets': buckets,
+                        'seed': seed, 'vocab_size': vocab_size, 'hash_vocab': hash_vocab, 'cell': cell,
+                        'spare_words': spare_words}
+        self.init, self.epochs_done = tf.truncated_normal_initializer(stddev=0.5), 0
+        self.score_cache, self.metrics, self.model_version = None, None, 0
 
-        # Setup Placeholders
-        self.X = tf.placeholder(tf.int32, shape=[None, self.train_x.shape[-1]], name='NL_Command')
-        self.Y = tf.placeholder(tf.int32, shape=[None], name='ML_Command')
-        self.X_len = tf.placeholder(tf.int32, shape=[None], name='NL_Length')
-        self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
+    def build_graph(self, training=True, session_config=None):
+        """
+        Build the placeholders, inference graph and loss in a new graph owned by the model, and initialize
+        all variables in a new session.
+
+        :param training: If False, skip the optimizer, which build_training() adds on the first fit().
+        :param session_config: Optional tf.ConfigProto for the session (e.g. to limit its thread pools).
+        """
+        self.graph, self.session_config = tf.Graph(), session_config
+        self.graph.seed = self.seed
+        with self.graph.as_default():
+            self.session = tf.Session(graph=self.graph, config=session_config)
 
-        # Build Inference Graph
-        self.logits = self.inference()
-        self.probs = tf.nn.softmax(self.logits)
+            # Setup Placeholders
+            self.X = tf.placeholder(tf.int32, shape=[None, None], name='NL_Command')
+            self.Y = tf.placeholder(tf.int32, shape=[None], name='ML_Command')
+            self.W = tf.placeholder_with_default(tf.ones_like(self.Y, dtype=tf.float32), shape=[None],
+                                                 name='Example_Weight')
+            self.X_len = tf.placeholder(tf.int32, shape=[None], name='NL_Length')
+            self.keep_prob = tf.placeholder(tf.float32, name='Dropout_Prob')
 
-        # Build Loss Computation
-        self.loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(self.logits,
-                                                                                  self.Y))
-        # Build Training Operation
-        self.train_op = tf.train.AdamOptimizer().minimize(self.loss)
+            # Build Inference Graph
+            self.logits = self.inference()
+            self.probs = tf.nn.softmax(self.logits)
 
-        # Build Saver
-        self.saver = tf.train.Saver()
+            # Build Streaming Graph, advancing the encoder state one token at a time
+            self.step_x = tf.placeholder(tf.int32, shape=[None], name='Step_Word')
+            self.step_h = tf.placeholder(tf.float32, shape=[None, self.state_sz], name='Step_State')
+            self.step_state, step_logits, state_logits = self.stream_inference()
+            self.step_probs, self.state_probs = tf.nn.softmax(step_logits), tf.nn.softmax(state_logits)
 
-        # Initialize all variables
-        self.session.run(tf.global_variables_initializer())
+            # Build Loss Computation, weighting each example (e.g. by its count in a compacted corpus)
+            self.loss = tf.reduce_mean(self.W * tf.nn.sparse_softmax_cross_entropy_with_logits(self.logits,
+                                                                                               self.Y))
+            # Build Training Operation, and Saver
+            if training:
+                self.build_training()
+            else:
+                self.opt, self.saver = None, tf.train.Saver(checkpoint_names(tf.trainable_variables()))
+
+            # Initialize all variables
+            self.session.run(tf.global_variables_initializer())
+
+    def build_training(self):
+        """
+        Build the training operation, and a saver covering the optimizer state.
+        """
+        self.learning_rate = tf.placeholder_with_default(0.001, shape=[], name='Learning_Rate')
+        self.opt = tf.train.AdamOptimizer(self.learning_rate)
+        self.train_op = self.opt.minimize(self.loss)
+        self.saver = tf.train.Saver(checkpoint_names(tf.global_variables()))
 
     def build_vocabulary(self):
         """
         Builds the vocabulary from the parallel corpus, adding the UNK ID.
 
-        :return: Tuple of Word2Id, Id2Word Dictionaries.
+        :return: Encoder holding the vocabulary.
         """
-        vocab = set()
-        for n, _ in self.pc:
-            for word in n:
-                vocab.add(word)
-
-        id2word = [PAD, UNK] + list(vocab)
-        word2id = {id2word[i]: i for i in range(len(id2word))}
-        return word2id, id2word
+        return Encoder.build((n for n, _ in self.pc), self.vocab_size, self.hash_vocab)
 
     def vectorize(self):
         """
         Step through the Parallel Corpus, and convert each sequence to vectors.
         """
-        x, y = [], []
-        for nl, ml in self.pc:
-            nvec, mlab = np.zeros((max(self.lengths)), dtype=np.int32), self.labels[" ".join(ml)]
-            for i in range(len(nl)):
-                nvec[i] = self.word2id.get(nl[i], UNK_ID)
-            x.append(nvec)
-            y.append(mlab)
-        return np.array(x, dtype=np.int32), np.array(y, dtype=np.int32)
+        x = self.encoder.encode([nl for nl, _ in self.pc], self.max_len)[0]
+        return x, np.array([self.labels[" ".join(ml)] for _, ml in self.pc], dtype=np.int32)
 
     def inference(self):
         """
@@ -90,16 +152,33 @@ class RNNClassifier():
         distribution over all possible reward functions.
         """
         # Embedding
-        E = tf.get_variable("Embedding", shape=[len(self.word2id), self.embedding_sz],
+        E = tf.get_variable("Embedding", shape=[len(self.encoder), self.embedding_sz],
                             dtype=tf.float32, initializer=self.init)
         embedding = tf.nn.embedding_lookup(E, self.X)               # Shape [None, x_len, embed_sz]
         embedding = tf.nn.dropout(embedding, self.keep_prob)
 
-        # LSTM
-        cell = tf.nn.rnn_cell.GRUCell(self.rnn_sz)
-        _, state = tf.nn.dynamic_rnn(cell, embedding, sequence_length=self.X_len, dtype=tf.float32)
-        h_state = state                                             # Shape [None, lstm_sz]
+        # RNN Encoder
+        state = encode(self.cell, embedding, self.X_len, self.rnn_sz)
+        h_state = output(self.cell, state, self.rnn_sz)             # Shape [None, rnn_sz]
+        return self.heads(h_state)
 
+    def stream_inference(self):
+        """
+        Compile the streaming graph: a single encoder step from a given state, sharing its weights,
+        and the output layers on both the given state and the stepped state.
+
+        :return: Tuple of (stepped state, logits on the stepped state, logits on the given state).
+        """
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            embedding = tf.nn.embedding_lookup(tf.get_variable("Embedding"), self.step_x)
+            state = step(self.cell, embedding, self.step_h, self.rnn_sz)
+            stepped, given = [output(self.cell, h, self.rnn_sz) for h in [state, self.step_h]]
+            return state, self.heads(stepped), self.heads(given)
+
+    def heads(self, h_state):
+        """
+        Compile the ReLU and output layers on top of the encoder state.
+        """
         # ReLU Layer 1
         H1_W = tf.get_variable("H1_W", shape=[self.rnn_sz, self.h1_sz], dtype=tf.float32,
                                initializer=self.init)
@@ -123,34 +202,229 @@ class RNNClassifier():
         output = tf.matmul(hidden, O_W) + O_B
         return output
 
-    def fit(self, chunk_size):
+    def batches(self, chunk_size, rng=None):
+        """
+        Generate the training batches for one epoch, over the first chunk_size examples.
+
+        :param rng: If given, a numpy RandomState used to shuffle the examples.
+        :return: Generator of (padded commands, lengths, labels, example weights) tuples.
+        """
+        lengths, n = np.array(self.lengths, dtype=np.int32), len(self.train_x[:chunk_size])
+        if self.buckets is None:
+            order = np.arange(n) if rng is None else rng.permutation(n)
+            batches = [order[start:end] for start, end in zip(range(0, n - self.bsz, self.bsz),
+                                                              range(self.bsz, n, self.bsz))]
+        else:
+            batches = bucket_batches(lengths[:n], self.buckets, self.bsz, rng)
+
+        for idx in batches:
+            x = self.train_x[idx] if self.buckets is None else pad_batch(self.train_x[idx], lengths[idx])
+            yield x, lengths[idx], self.train_y[idx], self.train_w[idx]
+
+    def fit(self, chunk_size, shuffle=False, prefetch=8, checkpoint=None, resume=False, callbacks=None):
         """
         Train the model, with the specified batch size and number of epochs.
+
+        :param shuffle: Whether to shuffle the examples every epoch (reproducibly, if the model has a seed).
+        :param prefetch: Number of batches prepared ahead of time on the background input thread.
+        :param checkpoint: If given, path the model is saved to after every epoch.
+        :param resume: If True, continue from the last completed epoch, restoring from checkpoint if one
+                       has been written.
+        :param callbacks: List of callbacks.Callback instances, receiving per-step timings and per-epoch
+                          loss and throughput. Defaults to printing the average loss every epoch.
         """
+        if self.opt is None:
+            self.resume_training()
+        if resume and checkpoint is not None and os.path.exists(checkpoint + '.json'):
+            self.restore(checkpoint)
+        first_epoch = self.epochs_done if resume else 0
+
         # Run through epochs
-        for e in range(self.epochs):
-            curr_loss, batches = 0.0, 0.0
-            for start, end in zip(range(0, len(self.train_x[:chunk_size]) - self.bsz, self.bsz),
-                                  range(self.bsz, len(self.train_x[:chunk_size]), self.bsz)):
+        pipeline = BatchPipeline(lambda rng: self.batches(chunk_size, rng), self.epochs - first_epoch, prefetch,
+                                 shuffle, self.seed)
+        callbacks = CallbackList(callbacks)
+        callbacks.begin_train(self)
+        try:
+            for e in range(first_epoch, self.epochs):
+                callbacks.begin_epoch(self, e)
+                for x, x_len, y, w in pipeline.epoch():
+                    loss, _ = callbacks.run(self.session, [self.loss, self.train_op],
+                                            feed_dict={self.X: x, self.X_len: x_len, self.keep_prob: 0.5,
+                                                       self.Y: y, self.W: w})
+                    callbacks.end_step(self, loss, len(y))
+                callbacks.end_epoch(self)
+                self.epochs_done = e + 1
+                if checkpoint is not None:
+                    self.save(checkpoint)
+        finally:
+            pipeline.close()
+            self.new_version()
+        callbacks.end_train(self)
+
+    def partial_fit(self, new_pairs, steps=5, replay=None, learning_rate=0.001, keep_prob=1.0, seed=None):
+        """
+        Learn from a few new labeled commands (e.g. an operator's correction) without retraining. The new
+        examples are added to the training data, growing the vocabulary (into any spare embedding rows) and
+        max_len as needed, and the model takes a few optimizer steps, each on all the new examples plus a
+        sample of the old ones, so that it does not forget them. A model loaded with load() replays the
+        sample of old examples saved with its checkpoint.
+
+        :param new_pairs: List of (source tokens, target tokens) tuples, where each target is one of the
+                          commands.
+        :param steps: Number of optimizer steps.
+        :param replay: Number of old examples replayed in every step. Defaults to 5% of the old examples,
+                       between 64 and 1024 (see batching.replay_size()). The new examples are repeated to
+                       match them, so that a single correction is not drowned out.
+        :param learning_rate: Adam learning rate of the steps. Raising it (or steps) makes a correction take
+                              hold sooner, at the cost of more drift on the old examples.
+        :param keep_prob: Dropout keep probability.
+        :param seed: Optional seed for the replay samples.
+        :return: List of the loss of every step.
+        """
+        new_pairs = list(new_pairs)
+        for _, ml in new_pairs:
+            if " ".join(ml) not in self.labels:
+                raise ValueError("Unknown command: %s" % " ".join(ml))
+        if self.opt is None:
+            self.resume_training()
+
+        # Grow the Vocabulary and Maximum Length, and Append the New Examples
+        self.extend_vocabulary([nl for nl, _ in new_pairs])
+        self.max_len = max([self.max_len] + [len(nl) for nl, _ in new_pairs])
+        if self.train_x.shape[1] < self.max_len:
+            self.train_x = np.pad(self.train_x, ((0, 0), (0, self.max_len - self.train_x.shape[1])), 'constant',
+                                  constant_values=PAD_ID)
+        old = len(self.train_y)
+        x, x_len = self.encoder.encode([nl for nl, _ in new_pairs], self.max_len)
+        self.train_x = np.concatenate([self.train_x, x])
+        self.train_y = np.concatenate([self.train_y, np.array([self.labels[" ".join(ml)] for _, ml in new_pairs],
+                                                              dtype=np.int32)])
+        self.train_w = np.concatenate([self.train_w, np.ones(len(new_pairs), dtype=np.float32)])
+        self.lengths = np.concatenate([np.asarray(self.lengths, dtype=np.int32), x_len])
+
+        # Optimizer Steps on the New Examples, plus a Replayed Sample of the Old Ones
+        rng, losses, new = np.random.RandomState(seed), [], np.arange(old, len(self.train_y))
+        samples = replay_samples(rng, [old], replay_size(old) if replay is None else replay, steps)
+        try:
+            for [sample] in samples:
+                idx = np.concatenate([sample, np.tile(new, max(len(sample) // max(len(new), 1), 1))])
+                if len(idx) == 0:
+                    continue
+                x_len = self.lengths[idx]
                 loss, _ = self.session.run([self.loss, self.train_op],
-                                           feed_dict={self.X: self.train_x[start:end],
-                                                      self.X_len: self.lengths[start:end],
-                                                      self.keep_prob: 0.5,
-                                                      self.Y: self.train_y[start:end]})
-                curr_loss += loss
-                batches += 1
-            print 'Epoch %s Average Loss:' % str(e), curr_loss / batches
-
-    def score(self, nl_command):
-        """
-        Given a natural language command, return predicted output and score.
-
-        :return: List of tokens representing predicted command, and score.
-        """
-        seq, seq_len = np.zeros((max(self.lengths))), len(nl_command)
-        for i in range(min(len(nl_command), len(seq))):
-            seq[i] = self.word2id.get(nl_command[i], UNK_ID)
-        y = self.session.run(self.probs, feed_dict={self.X: [seq], self.X_len: [seq_len],
-                                                    self.keep_prob: 1.0})
-        [pred_command] = np.argmax(y, axis=1)
-        return self.commands[pred_command], y[0][pred_command]
\ No newline at end of file
+                                           feed_dict={self.X: pad_batch(self.train_x[idx], x_len), self.X_len: x_len,
+                                                      self.keep_prob: keep_prob, self.Y: self.train_y[idx],
+                                                      self.W: self.train_w[idx], self.learning_rate: learning_rate})
+                losses.append(loss)
+        finally:
+            self.new_version()
+        return losses
+
+    def checkpoint_meta(self):
+        """
+        Model-specific checkpoint metadata: the label map, maximum sentence length and replay sample.
+        """
+        return {'max_len': self.max_len, 'commands': self.commands,
+                'replay': self.replay_meta([('L_ALL', self.train_y, self.train_w)])}
+
+    def example_ids(self, lvl, idx):
+        """
+        Word ids of the given training examples, without padding (there is a single level, lvl).
+        """
+        lengths = np.asarray(self.lengths)
+        return [self.train_x[i, :lengths[i]] for i in idx]
+
+    def use_dataset(self, dataset, level='L_ALL', **hparams):
+        """
+        Configure the model, and take its vocabulary and training data from one level of a corpus.Dataset
+        (see from_dataset()).
+        """
+        self.pc = []
+        self.configure(dataset.commands[level], **hparams)
+
+        self.set_encoder(dataset.encoder(self.vocab_size, self.hash_vocab))
+        self.max_len, self.lengths = dataset.max_len, dataset.lengths[level]
+        self.train_x, self.train_y = dataset.encoded(self.encoder, level), dataset.labels[level]
+        self.train_w = dataset.weights(level)
+
+    def use_checkpoint(self, meta, **hparams):
+        """
+        Configure the model from a checkpoint's metadata, with its replay sample as the training data (see
+        load()).
+        """
+        self.pc = []
+        self.configure([[str(w) for w in c] for c in meta['commands']], **hparams)
+
+        self.set_encoder(self.checkpoint_encoder(meta))
+        flat, lengths, self.train_y, self.train_w = saved_examples(meta, 'L_ALL')
+        self.max_len = meta['max_len']
+        self.train_x, self.lengths = pad_ids(flat, lengths, self.max_len)
+
+    def stream(self, threshold=None):
+        """
+        Start scoring a command incrementally, as its tokens arrive.
+
+        :param threshold: If given, the first prediction whose score reaches this value is kept as the
+                          stream's provisional prediction.
+        :return: streaming.Stream.
+        """
+        return Stream(self, threshold)
+
+    def step(self, word_ids, states):
+        """
+        Advance a batch of encoder states by one token each, and predict from the new states.
+
+        :param word_ids: Array of shape [batch] with the next word id of each stream.
+        :param states: Array of shape [batch, rnn_size] with the current states.
+        :return: Tuple of (new states, list of (command tokens, score) tuples).
+        """
+        state, y = self.session.run([self.step_state, self.step_probs],
+                                    feed_dict={self.step_x: word_ids, self.step_h: states, self.keep_prob: 1.0})
+        return state, [(self.commands[c], y[r][c]) for r, c in enumerate(np.argmax(y, axis=1))]
+
+    def predict_state(self, states):
+        """
+        Predict from a batch of encoder states, without stepping them.
+        """
+        y = self.session.run(self.state_probs, feed_dict={self.step_h: states, self.keep_prob: 1.0})
+        return [(self.commands[c], y[r][c]) for r, c in enumerate(np.argmax(y, axis=1))]
+
+    def run_batch(self, nl_commands):
+        """
+        Score a batch of commands, bypassing the cache.
+        """
+        start = time.time()
+        flat, lengths = self.encoder.lookup(nl_commands)
+        seqs, seq_lens = pad_ids(flat, lengths, self.max_len)
+        if len(nl_commands) == 0:
+            return []
+        encoded = time.time()
+        if self.buckets is None:
+            groups = [np.arange(len(nl_commands))]
+        else:
+            groups = bucket_batches(seq_lens, self.buckets)
+
+        predictions = [None] * len(nl_commands)
+        for idx in groups:
+            x = seqs[idx] if self.buckets is None else pad_batch(seqs[idx], seq_lens[idx])
+            y = self.session.run(self.probs, feed_dict={self.X: x, self.X_len: seq_lens[idx],
+                                                        self.keep_prob: 1.0})
+            for r, (j, c) in enumerate(zip(idx, np.argmax(y, axis=1))):
+                predictions[j] = (self.commands[c], y[r][c])
+        if self.metrics is not None:
+            self.metrics.record_forward(encoded - start, time.time() - encoded,
+                                        *self.encoder.count_unknown(flat))
+        return predictions
+
+    def export_numpy(self, path):
+        """
+        Dump the trained weights, vocabulary and label maps to a single .npz file, which can be scored
+        without TensorFlow by predictor.Predictor.
+
+        :param path: Path of the .npz file to write.
+        """
+        with self.graph.as_default():
+            weights = collect_weights(self.session, tf.trainable_variables())
+        np.savez(path, model='RNNClassifier', max_len=self.max_len, id2word=np.array(self.id2word),
+                 vocab_size=len(self.encoder), hash_vocab=self.hash_vocab,
+                 commands=np.array([" ".join(x) for x in self.commands]), **weights)
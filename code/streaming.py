@@ -0,0 +1,63 @@
+"""
+streaming.py
+
+Incremental scoring for the recurrent models. A Stream holds the encoder state of one partial command; each
+new token advances it by a single encoder step, so a prediction is available after every token, and
+finishing the command costs no more than its last step.
+"""
+import numpy as np
+
+
+def confidence(prediction):
+    """
+    Confidence of a prediction: the command score, times the level score for the dual models.
+    """
+    return prediction[1] * prediction[3] if len(prediction) == 4 else prediction[1]
+
+
+class Stream(object):
+    def __init__(self, model, threshold=None):
+        """
+        Starts an empty command. Use model.stream() rather than instantiating this directly.
+
+        :param model: RNNDual or RNNClassifier.
+        :param threshold: If given, the first prediction whose confidence reaches this value is kept as
+                          the provisional prediction.
+        """
+        self.model, self.threshold = model, threshold
+        self.state = np.zeros([1, model.state_sz], dtype=np.float32)
+        self.tokens, self.prediction, self.provisional = [], None, None
+
+    def feed(self, tokens):
+        """
+        Advance the stream by one or more tokens. As with score(), tokens past the model's max_len are
+        ignored.
+
+        :param tokens: A token, or a list of tokens.
+        :return: Prediction for the command so far, as from model.score().
+        """
+        for token in [tokens] if isinstance(tokens, basestring) else tokens:
+            self.tokens.append(token)
+            if len(self.tokens) > self.model.max_len:
+                continue
+            word_id = np.array([self.model.encoder.word_id(token)], dtype=np.int32)
+            self.state, predictions = self.model.step(word_id, self.state)
+            self.prediction = predictions[0]
+            if self.provisional is None and self.threshold is not None and \
+                    confidence(self.prediction) >= self.threshold:
+                self.provisional = self.prediction
+        return self.current()
+
+    def current(self):
+        """
+        Prediction for the command so far (for an empty command, from the initial zero state).
+        """
+        if self.prediction is None:
+            self.prediction = self.model.predict_state(self.state)[0]
+        return self.prediction
+
+    def finalize(self, tokens=()):
+        """
+        Feed any remaining tokens, and return the prediction for the whole command.
+        """
+        return self.feed(tokens) if tokens else self.current()
@@ -0,0 +1,164 @@
+"""
+sweep.py
+
+Parallel hyperparameter sweeps. Configurations are trained in a process pool, each in its own graph and
+session with a fixed number of TF threads, and weak configurations are stopped early by successive
+halving: every rung trains the survivors for more epochs (resuming from their checkpoints), scores them
+on a held-out split, and keeps the best 1 / eta of them.
+
+Usage:
+    python sweep.py RNNDual '{"rnn_size": [25, 50, 100], "h1_size": [30, 60]}' --out sweeps/rnn
+"""
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from corpus import load_dataset
+from models import MODELS
+from sessions import session_config
+
+COLUMNS = ['config', 'rung', 'epochs', 'accuracy', 'seconds', 'status', 'params']
+
+# from_dataset() arguments set by the sweep itself, which configurations may not override
+RESERVED = ['epochs', 'session_config']
+
+
+def grid(space):
+    """
+    Expand a dictionary mapping hyperparameter names to lists of values into the list of all combinations.
+    """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+
+def rungs(min_epochs, max_epochs, eta=3):
+    """
+    Epoch budgets of the successive-halving rungs: min_epochs, growing by a factor of eta up to max_epochs.
+    """
+    if min_epochs < 1 or max_epochs < min_epochs:
+        raise ValueError("Need 1 <= min_epochs <= max_epochs, got %r and %r" % (min_epochs, max_epochs))
+    if eta < 2:
+        raise ValueError("eta must be at least 2, got %r" % eta)
+    budgets = [min_epochs]
+    while budgets[-1] < max_epochs:
+        budgets.append(min(budgets[-1] * eta, max_epochs))
+    return budgets
+
+
+def accuracy(model, dataset):
+    """
+    Fraction of a dataset's examples (over all levels) for which the model predicts the right command.
+    """
+    correct, total = 0, 0
+    for lvl in dataset.levels:
+        predictions = model.score_batch(dataset.sentences(lvl))
+        correct += sum(p[0] == t for p, t in zip(predictions, dataset.targets(lvl)))
+        total += len(predictions)
+    return correct / float(max(total, 1))
+
+
+def train_config(task):
+    """
+    Train one configuration up to an epoch budget, continuing from its checkpoint if
+    an earlier rung wrote one, and score it on the validation split. Run in a worker process.
+
+    :param task: Tuple of (model name, config id, hyperparameters, epochs, chunk size, checkpoint path,
+                 cache directory, validation fraction, number of TF threads).
+    :return: Tuple of (config id, validation accuracy, training seconds).
+    """
+    name, config_id, params, epochs, chunk_size, checkpoint, cache_dir, validation, threads = task
+    model_cls, levels = MODELS[name]
+    train, valid = load_dataset(levels, cache_dir=cache_dir).split(validation)
+    model = model_cls.from_dataset(train, session_config=session_config(threads, threads), epochs=epochs,
+                                   **params)
+    start = time.time()
+    model.fit(chunk_size, shuffle=True, checkpoint=checkpoint, resume=True)
+    seconds = time.time() - start
+    score = accuracy(model, valid)
+    model.session.close()
+    return config_id, score, seconds
+
+
+def sweep(name, configs, out_dir, min_epochs=1, max_epochs=27, eta=3, chunk_size=100000, processes=None,
+          threads=1, validation=0.1, cache_dir=None, resume=False):
+    """
+    Run a successive-halving sweep over a list of configurations, writing every rung's results to
+    out_dir/results.tsv as they complete, and each configuration's checkpoint to out_dir/config-<id>.
+
+    :param name: Model to sweep: 'RNNDual', 'NNDual' or 'RNNClassifier'.
+    :param configs: List of hyperparameter dictionaries (e.g. from grid()), passed to from_dataset(). They
+                    may not set epochs (given by the rungs) or session_config (given by threads).
+    :param min_epochs: Epoch budget of the first rung.
+    :param max_epochs: Epoch budget of the last rung.
+    :param eta: Factor by which the budget grows, and the number of configurations shrinks, per rung.
+    :param chunk_size: Number of examples per level trained on, as for fit().
+    :param processes: Number of worker processes. Defaults to the number of CPUs divided by threads.
+    :param threads: Number of intra- and inter-op threads for each worker's session.
+    :param validation: Fraction of each level held out for scoring.
+    :param cache_dir: Directory for the vectorized corpus cache. Defaults to out_dir/cache.
+    :param resume: If True, continue an interrupted sweep of the same configurations from the checkpoints in
+                   out_dir. Otherwise out_dir must not hold any, so that no trial starts from another
+                   sweep's weights.
+    :return: List of result dictionaries, one per configuration per rung it ran.
+    """
+    budgets = rungs(min_epochs, max_epochs, eta)
+    reserved = sorted(set(k for config in configs for k in config if k in RESERVED))
+    if reserved:
+        raise ValueError("Configurations cannot set %s: the sweep sets epochs from its rungs (min_epochs to "
+                         "max_epochs), and session_config from threads" % ", ".join(reserved))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    elif not resume and glob.glob(os.path.join(out_dir, 'config-*')):
+        raise ValueError("%s holds checkpoints from an earlier sweep: use a fresh directory, or resume" % out_dir)
+    cache_dir = cache_dir or os.path.join(out_dir, 'cache')
+    load_dataset(MODELS[name][1], cache_dir=cache_dir)
+    processes = processes or max(multiprocessing.cpu_count() // threads, 1)
+    pool, results, alive = multiprocessing.Pool(processes), [], range(len(configs))
+    try:
+        with open(os.path.join(out_dir, 'results.tsv'), 'w') as f:
+            f.write("\t".join(COLUMNS) + "\n")
+            for rung, epochs in enumerate(budgets):
+                tasks = [(name, i, configs[i], epochs, chunk_size, os.path.join(out_dir, 'config-%03d' % i),
+                          cache_dir, validation, threads) for i in alive]
+                scores = {i: (score, seconds) for i, score, seconds in pool.imap_unordered(train_config, tasks)}
+
+                # Keep the best 1 / eta configurations (at least one) for the next rung
+                ranked = sorted(alive, key=lambda i: -scores[i][0])
+                keep = set(ranked[:max(len(ranked) // eta, 1)])
+                for i in ranked:
+                    row = {'config': i, 'rung': rung, 'epochs': epochs, 'accuracy': scores[i][0],
+                           'seconds': scores[i][1], 'status': 'kept' if i in keep else 'stopped',
+                           'params': json.dumps(configs[i], sort_keys=True)}
+                    results.append(row)
+                    f.write("\t".join(str(row[c]) for c in COLUMNS) + "\n")
+                f.flush()
+                alive = [i for i in ranked if i in keep]
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Successive-halving hyperparameter sweep.')
+    parser.add_argument('model', choices=sorted(MODELS))
+    parser.add_argument('space', help='JSON dictionary mapping hyperparameter names to lists of values')
+    parser.add_argument('--out', required=True, help='Directory for checkpoints and results.tsv')
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--validation', type=float, default=0.1)
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted sweep in --out')
+    args = parser.parse_args()
+
+    results = sweep(args.model, grid(json.loads(args.space)), args.out, args.min_epochs, args.max_epochs,
+                    args.eta, args.chunk_size, args.processes, args.threads, args.validation, resume=args.resume)
+    best = max((r for r in results if r['rung'] == results[-1]['rung']), key=lambda r: r['accuracy'])
+    print 'Best config %d (accuracy %.4f): %s' % (best['config'], best['accuracy'], best['params'])
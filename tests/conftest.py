@@ -0,0 +1,7 @@
+"""
+The modules in code/ import each other by bare name (they are run as scripts), so put code/ on the path.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'code'))
@@ -0,0 +1,35 @@
+import numpy as np
+
+from batching import bucket_batches, pad_batch, replay_samples, replay_size
+
+
+def test_bucket_batches_stay_within_a_bucket():
+    lengths = np.array([1, 5, 2, 6, 3, 9])
+    batches = bucket_batches(lengths, [3, 6], 2)
+    assert [sorted(lengths[b].tolist()) for b in batches] == [[1, 2], [3], [5, 6], [9]]
+
+
+def test_pad_batch_trims_to_the_longest_sentence():
+    x = np.arange(12).reshape(2, 6)
+    assert pad_batch(x, np.array([2, 3])).shape == (2, 3)
+    assert pad_batch(x, np.array([0, 0])).shape == (2, 1)
+
+
+def test_replay_size_scales_with_the_corpus():
+    assert replay_size(10) == 10
+    assert replay_size(1000) == 64
+    assert replay_size(10000) == 500
+    assert replay_size(100000) == 1024
+
+
+def test_replay_samples_mix_levels_in_proportion():
+    rng = np.random.RandomState(0)
+    samples = replay_samples(rng, [100, 0, 900], 200, 50)
+    assert len(samples) == 50
+    for sample in samples:
+        assert sum(len(s) for s in sample) == 200 and len(sample[1]) == 0
+        assert sample[0].min() >= 0 and sample[0].max() < 100 and sample[2].max() < 900
+        assert len(np.unique(sample[2])) == len(sample[2])
+    share = np.mean([len(sample[0]) for sample in samples]) / 200.0
+    assert 0.05 < share < 0.15
+
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from benchmark import compare
+
+
+def test_compare_direction_of_each_metric():
+    baseline = {'results': {'NNDual/16': {'fit_sec': 10.0, 'fit_examples_per_sec': 100.0, 'rows_saved_L0': 40,
+                                          'speedup_L0': 2.0}}}
+    current = {'results': {'NNDual/16': {'fit_sec': 12.0, 'fit_examples_per_sec': 80.0, 'rows_saved_L0': 60,
+                                         'speedup_L0': 3.0}}}
+    regressed = {metric: r for _, metric, _, _, _, r in compare(baseline, current)}
+    assert regressed == {'fit_sec': True, 'fit_examples_per_sec': True, 'rows_saved_L0': False,
+                         'speedup_L0': False}
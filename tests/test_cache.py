@@ -0,0 +1,44 @@
+from cache import LRUCache, ScoreCache
+from encoder import Encoder
+
+
+class FakeModel(object):
+    def __init__(self):
+        self.encoder, self.model_version, self.scored = Encoder.build([['go', 'left', 'right']]), 0, []
+
+    def run_batch(self, nl_commands):
+        self.scored.append([list(c) for c in nl_commands])
+        return [(" ".join(c), len(c)) for c in nl_commands]
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'entries': 2, 'hits': 3, 'misses': 1}
+
+
+def test_repeats_within_a_batch_are_looked_up_and_scored_once():
+    model, cache = FakeModel(), ScoreCache()
+    batch = [['go', 'left'], ['go', 'right'], ['go', 'left'], ['go'], ['go', 'right'], ['go']]
+    predictions = cache.score_batch(model, batch)
+    assert predictions == [(" ".join(c), len(c)) for c in batch]
+    assert model.scored == [[['go', 'left'], ['go', 'right'], ['go']]]
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    assert cache.score_batch(model, batch + [['left']]) == predictions + [('left', 1)]
+    assert model.scored[1:] == [[['left']]]
+    assert (cache.hits, cache.misses) == (3, 4)
+
+
+def test_unknown_words_share_a_key_and_versions_do_not():
+    model, cache = FakeModel(), ScoreCache()
+    cache.score_batch(model, [['go', 'up']])
+    cache.score_batch(model, [['go', 'down']])
+    assert len(model.scored) == 1
+    model.model_version += 1
+    cache.score_batch(model, [['go', 'down']])
+    assert len(model.scored) == 2
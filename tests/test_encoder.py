@@ -0,0 +1,51 @@
+import numpy as np
+
+from encoder import PAD_ID, UNK_ID, Encoder, bag_of_words_ids, pad_ids
+
+
+def test_build_sorts_words_after_pad_and_unk():
+    encoder = Encoder.build([['go', 'to', 'red'], ['go', 'left']])
+    assert encoder.id2word == ['<<PAD>>', '<<UNK>>', 'go', 'left', 'red', 'to']
+    assert len(encoder) == 6
+
+
+def test_encode_pads_and_truncates():
+    encoder = Encoder.build([['a', 'b', 'c']])
+    ids, lengths = encoder.encode([['a'], ['c', 'b', 'a'], ['z', 'a']], max_len=2)
+    assert ids.tolist() == [[2, PAD_ID], [4, 3], [UNK_ID, 2]]
+    assert lengths.tolist() == [1, 2, 2]
+
+
+def test_pad_ids_packs_flat_ids():
+    ids, lengths = pad_ids(np.array([4, 3, 2, 5], dtype=np.int32), np.array([3, 0, 1], dtype=np.int32))
+    assert ids.tolist() == [[4, 3, 2], [PAD_ID, PAD_ID, PAD_ID], [5, PAD_ID, PAD_ID]]
+    assert lengths.tolist() == [3, 0, 1]
+    assert pad_ids(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), 4)[0].shape == (0, 4)
+
+
+def test_extend_keeps_existing_ids_and_fills_reserved_ids():
+    encoder = Encoder(['<<PAD>>', '<<UNK>>', 'b'], size=4)
+    assert encoder.extend([['c', 'b', 'a']]) == 1
+    assert encoder.id2word == ['<<PAD>>', '<<UNK>>', 'b', 'a'] and len(encoder) == 4
+    assert encoder.word_id('c') == UNK_ID
+
+
+def test_count_unknown_counts_unk_ids():
+    encoder = Encoder.build([['go', 'left']], size=3)
+    assert encoder.id2word == ['<<PAD>>', '<<UNK>>', 'go']
+    flat, _ = encoder.lookup([['go', 'left'], ['go', 'up', 'up'], []])
+    assert encoder.count_unknown(flat) == (5, 3)
+
+
+def test_count_unknown_is_off_for_hashed_vocabularies():
+    encoder = Encoder.build([['go', 'left']], size=16, hashed=True)
+    assert encoder.count_unknown(encoder.lookup([['go', 'somewhere', 'new']])[0]) == (0, None)
+    ids, _ = encoder.encode([['go', 'somewhere', 'new']])
+    assert UNK_ID not in ids.tolist()[0]
+
+
+def test_bag_of_words_ids_matches_bag_of_words():
+    encoder = Encoder.build([['a', 'b', 'a']])
+    sentences = [['a', 'b', 'a'], ['b']]
+    ids, lengths = encoder.encode(sentences)
+    assert np.array_equal(bag_of_words_ids(ids, lengths, len(encoder)), encoder.bag_of_words(sentences))
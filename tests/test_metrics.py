@@ -0,0 +1,31 @@
+from encoder import Encoder
+from metrics import Metrics
+
+
+def test_unknown_rate_counts_unk_tokens():
+    metrics, encoder = Metrics(), Encoder.build([['go', 'left']])
+    metrics.record_forward(0.0, 0.001, *encoder.count_unknown(encoder.lookup([['go', 'right']])[0]))
+    snapshot = metrics.snapshot()
+    assert (snapshot['tokens'], snapshot['unknown_tokens'], snapshot['unknown_rate']) == (2, 1, 0.5)
+    assert 'command_model_unknown_token_ratio 0.5' in metrics.prometheus()
+
+
+def test_hashed_vocabularies_report_no_unknown_rate():
+    metrics, encoder = Metrics(), Encoder.build([['go', 'left']], size=8, hashed=True)
+    metrics.record_call(0.001, [(['a'], 0.9, 1, 0.8)])
+    metrics.record_forward(0.0, 0.001, *encoder.count_unknown(encoder.lookup([['go', 'right']])[0]))
+    snapshot = metrics.snapshot()
+    assert (snapshot['tokens'], snapshot['unknown_rate'], snapshot['levels']) == (0, None, {1: 1})
+    samples = [line for line in metrics.prometheus().splitlines() if not line.startswith('#')]
+    assert not [line for line in samples if line.startswith('command_model_unknown_token_ratio')]
+
+
+def test_histogram_snapshot_and_reset():
+    metrics = Metrics()
+    for seconds in [0.0002, 0.003, 0.003, 0.2]:
+        metrics.record_forward(0.0, seconds)
+    h = metrics.snapshot()['histograms']['run_seconds']
+    assert h['count'] == 4 and abs(h['sum'] - 0.2062) < 1e-9
+    assert 0.0025 <= h['p50'] <= 0.005
+    metrics.reset()
+    assert metrics.snapshot()['histograms']['run_seconds']['count'] == 0
@@ -0,0 +1,118 @@
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from dual_nn import NNDual
+from dual_rnn import RNNDual
+from single_rnn import RNNClassifier
+
+COMMANDS = {'L0': [['goto', 'red']], 'L1': [['goto', 'red'], ['goto', 'blue']],
+            'L2': [['goto', 'red'], ['goto', 'blue'], ['stop']]}
+CORPUS = {'L0': [(['go', 'to', 'the', 'red', 'room'], ['goto', 'red'])] * 8,
+          'L1': [(['visit', 'red'], ['goto', 'red']), (['visit', 'blue'], ['goto', 'blue'])] * 8,
+          'L2': [(['red'], ['goto', 'red']), (['blue'], ['goto', 'blue']), (['halt'], ['stop'])] * 8}
+
+
+def dual_model(cls, **hparams):
+    return cls(CORPUS['L0'], CORPUS['L1'], CORPUS['L2'], COMMANDS['L0'], COMMANDS['L1'], COMMANDS['L2'],
+               epochs=1, batch_size=4, seed=0, **hparams)
+
+
+def single_model(**hparams):
+    return RNNClassifier(CORPUS['L2'], COMMANDS['L2'], epochs=1, batch_size=4, seed=0, **hparams)
+
+
+def test_no_spare_rows_unless_asked():
+    assert len(dual_model(NNDual).encoder) == len(dual_model(NNDual).id2word)
+    assert len(single_model().encoder) == len(single_model().id2word)
+    model = single_model(spare_words=4)
+    assert len(model.encoder) == len(model.id2word) + 4
+
+
+@pytest.mark.parametrize('cls', [RNNDual, NNDual])
+def test_new_words_fill_the_spare_rows_without_a_rebuild(cls):
+    model = dual_model(cls, spare_words=4)
+    graph, capacity, ops = model.graph, len(model.encoder), len(model.graph.get_operations())
+    model.partial_fit({'L2': [(['cease', 'now'], ['stop'])]}, seed=0)
+    model.partial_fit({'L2': [(['freeze'], ['stop'])]}, seed=0)
+    assert model.graph is graph and len(model.encoder) == capacity
+    assert len(model.graph.get_operations()) == ops
+    assert all(w in model.word2id for w in ['cease', 'now', 'freeze'])
+
+
+def test_vocabulary_grows_once_the_spare_rows_run_out():
+    model = dual_model(RNNDual, spare_words=0)
+    capacity = len(model.encoder)
+    model.partial_fit({'L2': [(['cease'], ['stop'])]}, seed=0)
+    assert len(model.encoder) == 2 * capacity and 'cease' in model.word2id
+
+
+def test_sentences_longer_than_max_len_are_padded():
+    model = dual_model(RNNDual)
+    longer = ['please', 'go', 'to', 'the', 'big', 'red', 'room', 'now']
+    model.partial_fit({'L0': [(longer, ['goto', 'red'])]}, seed=0)
+    assert model.max_len == len(longer)
+    assert all(model.train_x[lvl].shape[1] == len(longer) for lvl in ['L0', 'L1', 'L2'])
+    assert model.score(longer)[0] in COMMANDS['L0'] + COMMANDS['L1'] + COMMANDS['L2']
+
+    model = single_model()
+    model.partial_fit([(longer, ['goto', 'red'])], seed=0)
+    assert model.max_len == len(longer) and model.train_x.shape == (len(model.train_y), len(longer))
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_replay_keeps_the_old_predictions(fused):
+    model = dual_model(RNNDual, fused=fused)
+    before = model.score_batch([nl for lvl in ['L0', 'L1', 'L2'] for nl, _ in CORPUS[lvl]])
+    losses = model.partial_fit({'L2': [(['freeze'], ['stop'])]}, steps=3, replay=16, seed=0)
+    after = model.score_batch([nl for lvl in ['L0', 'L1', 'L2'] for nl, _ in CORPUS[lvl]])
+    assert len(losses) == 3
+    assert model.train_y['L2'][-1] == 2 and len(model.train_y['L2']) == len(CORPUS['L2']) + 1
+    changed = sum(b[0] != a[0] for b, a in zip(before, after))
+    assert changed <= len(before) // 10
+
+
+def test_a_correction_takes_hold():
+    model = single_model()
+    model.partial_fit([(['freeze'], ['stop'])], steps=30, learning_rate=0.05, seed=0)
+    assert model.score(['freeze'])[0] == ['stop']
+
+
+@pytest.mark.parametrize('cls', [RNNDual, NNDual])
+def test_save_and_load_after_partial_fit(cls, tmpdir):
+    model = dual_model(cls)
+    model.partial_fit({'L1': [(['visit', 'crimson'], ['goto', 'red'])]}, seed=0)
+    path = str(tmpdir.join('model'))
+    model.save(path)
+
+    loaded = cls.load(path)
+    assert loaded.id2word == model.id2word and len(loaded.encoder) == len(model.encoder)
+    commands = [['visit', 'crimson'], ['red'], ['halt']]
+    assert [p[0] for p in loaded.score_batch(commands)] == [p[0] for p in model.score_batch(commands)]
+
+    saved = {lvl: len(loaded.train_y[lvl]) for lvl in ['L0', 'L1', 'L2']}
+    assert sum(saved.values()) == sum(len(model.train_y[lvl]) for lvl in ['L0', 'L1', 'L2'])
+    assert min(saved.values()) > 0
+    loaded.partial_fit({'L2': [(['freeze'], ['stop'])]}, seed=0)
+    assert 'freeze' in loaded.word2id and len(loaded.train_y['L2']) == saved['L2'] + 1
+
+
+def test_a_loaded_model_replays_its_saved_sample(tmpdir):
+    model = single_model()
+    model.partial_fit([(['go', 'to', 'the', 'red', 'room', 'at', 'once'], ['goto', 'red'])], seed=0)
+    path = str(tmpdir.join('model'))
+    model.save(path)
+
+    loaded = RNNClassifier.load(path)
+    assert len(loaded.train_y) == len(model.train_y) and loaded.train_x.shape[1] == model.max_len
+    assert sorted(loaded.lengths.tolist()) == sorted(model.lengths.tolist())
+    before = loaded.train_y.copy()
+    loaded.partial_fit([(['freeze'], ['stop'])], seed=0)
+    assert (loaded.train_y[:-1] == before).all() and loaded.train_y[-1] == 2
+
+
+def test_unknown_commands_are_rejected():
+    with pytest.raises(ValueError):
+        dual_model(NNDual).partial_fit({'L0': [(['halt'], ['stop'])]})
+    with pytest.raises(ValueError):
+        single_model().partial_fit([(['halt'], ['fly'])])
@@ -0,0 +1,43 @@
+import numpy as np
+
+from pipeline import BatchPipeline
+
+
+def orders(seed, epochs=3):
+    pipeline = BatchPipeline(lambda rng: [rng.permutation(10)], epochs, shuffle=True, seed=seed)
+    try:
+        return [list(batch) for _ in range(epochs) for batch in pipeline.epoch()]
+    finally:
+        pipeline.close()
+
+
+def test_seeded_shuffle_is_reproducible():
+    assert orders(7) == orders(7)
+    assert orders(7) != orders(8)
+
+
+def test_unshuffled_epochs_get_no_rng():
+    pipeline = BatchPipeline(lambda rng: [rng], 2)
+    try:
+        assert [batch for _ in range(2) for batch in pipeline.epoch()] == [None, None]
+    finally:
+        pipeline.close()
+
+
+def test_producer_errors_are_raised_in_the_consumer():
+    def make_epoch(rng):
+        yield np.zeros(1)
+        raise ValueError("bad batch")
+
+    pipeline = BatchPipeline(make_epoch, 1)
+    try:
+        batches = pipeline.epoch()
+        next(batches)
+        try:
+            next(batches)
+        except ValueError as e:
+            assert str(e) == "bad batch"
+        else:
+            assert False, "expected the producer's error"
+    finally:
+        pipeline.close()
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+from server import MicroBatcher, Overloaded
+
+
+def echo(commands):
+    return [(command, 1.0) for command in commands]
+
+
+def test_concurrent_commands_share_batches():
+    calls = []
+    batcher = MicroBatcher(lambda commands: calls.append(len(commands)) or echo(commands), max_batch=8,
+                           max_delay=0.05)
+    try:
+        results = {}
+        threads = [threading.Thread(target=lambda i=i: results.update({i: batcher.score([[str(i)]], 5.0)}))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {i: [([str(i)], 1.0)] for i in range(8)}
+        assert sum(calls) == 8 and len(calls) < 8
+        assert batcher.stats()['scored'] == 8 and batcher.stats()['batches'] == len(calls)
+    finally:
+        batcher.close()
+
+
+def test_a_list_that_does_not_fit_is_rejected_whole():
+    release = threading.Event()
+    batcher = MicroBatcher(lambda commands: release.wait() and echo(commands), max_batch=1, max_queue=3)
+    try:
+        blocked = threading.Thread(target=batcher.score, args=([['a']], 5.0))
+        blocked.start()
+        while batcher.stats()['queue']:
+            time.sleep(0.001)
+        batcher.submit([['b'], ['c']])
+        with pytest.raises(Overloaded):
+            batcher.score([['d'], ['e']], 5.0)
+        stats = batcher.stats()
+        assert stats['queue'] == 2 and stats['rejected'] == 2
+        release.set()
+        blocked.join()
+    finally:
+        release.set()
+        batcher.close()
+
+
+def test_timeout_is_for_the_whole_request():
+    def slow(commands):
+        time.sleep(0.05)
+        return echo(commands)
+
+    batcher = MicroBatcher(slow, max_batch=1)
+    try:
+        start = time.time()
+        with pytest.raises(Overloaded):
+            batcher.score([['a'], ['b'], ['c'], ['d']], 0.08)
+        assert time.time() - start < 0.15
+    finally:
+        batcher.close()
+
+
+def test_scoring_errors_are_raised_to_the_caller():
+    def fail(commands):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher(fail)
+    try:
+        with pytest.raises(RuntimeError):
+            batcher.score([['a']], 5.0)
+    finally:
+        batcher.close()
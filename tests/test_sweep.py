@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from sweep import grid, rungs, sweep
+
+
+def test_grid():
+    assert grid({'b': [1, 2], 'a': ['x']}) == [{'a': 'x', 'b': 1}, {'a': 'x', 'b': 2}]
+
+
+def test_rungs():
+    assert rungs(1, 27, 3) == [1, 3, 9, 27]
+    assert rungs(2, 10, 3) == [2, 6, 10]
+    assert rungs(5, 5) == [5]
+
+
+@pytest.mark.parametrize('args', [(0, 27, 3), (-1, 27, 3), (5, 4, 3), (1, 27, 1)])
+def test_rungs_rejects_budgets_that_never_finish(args):
+    with pytest.raises(ValueError):
+        rungs(*args)
+
+
+def test_sweep_refuses_checkpoints_from_an_earlier_sweep(tmpdir):
+    open(os.path.join(str(tmpdir), 'config-000.json'), 'w').close()
+    with pytest.raises(ValueError):
+        sweep('NNDual', [{}], str(tmpdir))
+
+
+@pytest.mark.parametrize('key', ['epochs', 'session_config'])
+def test_sweep_rejects_configs_that_set_what_the_sweep_sets(tmpdir, key):
+    with pytest.raises(ValueError) as error:
+        sweep('NNDual', [{'h1_size': 30}, {key: 3}], str(tmpdir))
+    assert key in str(error.value)
+    assert not tmpdir.listdir()